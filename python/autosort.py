@@ -25,6 +25,13 @@
 
 #
 # Changelog:
+# 3.12:
+#   * Only move the buffers that are out of place when applying the sort order.
+# 3.11:
+#   * Cache sort keys per buffer, only evaluate them again for buffers that changed.
+#   * Move a single changed buffer with a binary search instead of sorting the whole list.
+#   * Report sort time and sort key cache hits in the debug log.
+#   * Fix signal_delay not holding off sorts for signals received during the delay.
 # 3.10:
 #   * Fix exception in `/autosort helpers swap`.
 # 3.9:
@@ -80,6 +87,7 @@
 #
 
 
+import bisect
 import json
 import math
 import re
@@ -89,12 +97,13 @@ import weechat
 
 SCRIPT_NAME     = 'autosort'
 SCRIPT_AUTHOR   = 'Maarten de Vries <maarten@de-vri.es>'
-SCRIPT_VERSION  = '3.10'
+SCRIPT_VERSION  = '3.12'
 SCRIPT_LICENSE  = 'GPL3'
 SCRIPT_DESC     = 'Flexible automatic (or manual) buffer sorting based on eval expressions.'
 
 
 config             = None
+key_cache          = None
 hooks              = []
 signal_delay_timer = None
 sort_limit_timer   = None
@@ -395,14 +404,30 @@ def merge_buffer_list(buffers):
 	for number, buffer in buffers:
 		if number not in result: result[number] = MergedBuffers(number)
 		result[number].append(buffer)
-	return result.values()
+	return sorted(result.values(), key=lambda merged: merged.number)
 
-def sort_buffers(hdata, buffers, rules, helpers, case_sensitive):
-	for merged in buffers:
-		for buffer in merged:
-			name = weechat.hdata_string(hdata, buffer, 'name')
-
-	return sorted(buffers, key=merged_sort_key(rules, helpers, case_sensitive))
+def sort_buffers(buffers, key_cache):
+	'''
+	Sort a list of merged buffers given in their current order.
+	If only one of them has a new sort key and the others are still sorted,
+	it is moved with a binary search insertion instead of sorting everything.
+	'''
+	keys  = []
+	dirty = []
+	for i, merged in enumerate(buffers):
+		misses = key_cache.misses
+		keys.append(key_cache.merged_key(merged))
+		if key_cache.misses != misses: dirty.append(i)
+
+	# Sorting on (key, index) is a stable sort on key.
+	if len(dirty) == 1:
+		moved = dirty[0]
+		order = [(key, i) for i, key in enumerate(keys) if i != moved]
+		if all(order[i][0] <= order[i + 1][0] for i in range(len(order) - 1)):
+			bisect.insort(order, (keys[moved], moved))
+			return [buffers[i] for key, i in order]
+
+	return [buffers[i] for key, i in sorted((key, i) for i, key in enumerate(keys))]
 
 def buffer_sort_key(rules, helpers, case_sensitive):
 	''' Create a sort key function for a list of lists of merged buffers. '''
@@ -419,20 +444,85 @@ def buffer_sort_key(rules, helpers, case_sensitive):
 
 	return key
 
-def merged_sort_key(rules, helpers, case_sensitive):
-	buffer_key = buffer_sort_key(rules, helpers, case_sensitive)
-	def key(merged):
-		best = None
-		for buffer in merged:
-			this = buffer_key(buffer)
-			if best is None or this < best: best = this
-		return best
-	return key
+class SortKeyCache:
+	''' Sort keys of buffers, kept until a buffer or the configuration changes. '''
+
+	def __init__(self):
+		self.keys       = {}
+		self.hits       = 0
+		self.misses     = 0
+		self.buffer_key = None
+
+	def clear(self):
+		''' Forget all sort keys, for example because the rules changed. '''
+		self.keys.clear()
+		self.buffer_key = None
+
+	def invalidate(self, buffer):
+		''' Forget the sort key of a single buffer. '''
+		self.keys.pop(buffer, None)
+
+	def key(self, buffer):
+		try:
+			result = self.keys[buffer]
+			self.hits += 1
+		except KeyError:
+			if self.buffer_key is None:
+				self.buffer_key = buffer_sort_key(config.rules, config.helpers, config.case_sensitive)
+			result = self.keys[buffer] = self.buffer_key(buffer)
+			self.misses += 1
+		return result
+
+	def merged_key(self, merged):
+		return min(self.key(buffer) for buffer in merged)
+
+def longest_increasing_subsequence(values):
+	''' Get the indices of a longest strictly increasing subsequence of a list. '''
+	tails   = []
+	indices = []
+	parents = [None] * len(values)
+	for i, value in enumerate(values):
+		pos = bisect.bisect_left(tails, value)
+		if pos > 0: parents[i] = indices[pos - 1]
+		if pos == len(tails):
+			tails.append(value)
+			indices.append(i)
+		else:
+			tails[pos]   = value
+			indices[pos] = i
+
+	result = set()
+	i = indices[-1] if indices else None
+	while i is not None:
+		result.add(i)
+		i = parents[i]
+	return result
 
 def apply_buffer_order(buffers):
-	''' Sort the buffers in weechat according to the given order. '''
-	for i, buffer in enumerate(buffers):
-		weechat.buffer_set(buffer[0], "number", str(i + 1))
+	'''
+	Sort the buffers in weechat according to the given order.
+	Buffers that are part of a longest run already in the right relative order stay where they are,
+	the others are moved one by one right behind the buffer that should precede them.
+	'''
+	current = sorted(buffers, key=lambda merged: merged.number)
+
+	# Moves only shift the buffers in between if the buffer list has no gaps.
+	if [merged.number for merged in current] != list(range(1, len(current) + 1)):
+		for i, buffer in enumerate(buffers):
+			weechat.buffer_set(buffer[0], "number", str(i + 1))
+		return
+
+	target = dict((id(merged), i) for i, merged in enumerate(buffers))
+	keep   = longest_increasing_subsequence([target[id(merged)] for merged in current])
+	keep   = set(id(current[i]) for i in keep)
+
+	order = list(current)
+	for i, merged in enumerate(buffers):
+		if id(merged) in keep: continue
+		order.remove(merged)
+		pos = order.index(buffers[i - 1]) + 1 if i > 0 else 0
+		order.insert(pos, merged)
+		weechat.buffer_set(merged[0], "number", str(pos + 1))
 
 def split_args(args, expected, optional = 0):
 	''' Split an argument string in the desired number of arguments. '''
@@ -442,21 +532,30 @@ def split_args(args, expected, optional = 0):
 	return split[:-1] + pad(split[-1].split(' ', optional), optional + 1, '')
 
 def do_sort(verbose = False):
-	start = perf_counter()
+	start  = perf_counter()
+	hits   = key_cache.hits
+	misses = key_cache.misses
 
 	hdata, buffers = get_buffers()
 	buffers = merge_buffer_list(buffers)
-	buffers = sort_buffers(hdata, buffers, config.rules, config.helpers, config.case_sensitive)
+	buffers = sort_buffers(buffers, key_cache)
 	apply_buffer_order(buffers)
 
 	elapsed = perf_counter() - start
+	hits    = key_cache.hits - hits
+	misses  = key_cache.misses - misses
+	total   = key_cache.hits + key_cache.misses
+	message = "Finished sorting buffers in {0:.4f} seconds, {1} of {2} sort keys cached ({3:.0%} since loaded).".format(
+		elapsed, hits, hits + misses, float(key_cache.hits) / total if total else 0)
 	if verbose:
-		log("Finished sorting buffers in {0:.4f} seconds.".format(elapsed))
+		log(message)
 	else:
-		debug("Finished sorting buffers in {0:.4f} seconds.".format(elapsed))
+		debug(message)
 
 def command_sort(buffer, command, args):
 	''' Sort the buffers and print a confirmation. '''
+	# Rules may depend on more than buffer properties, so evaluate everything again.
+	key_cache.clear()
 	do_sort(True)
 	return weechat.WEECHAT_RC_OK
 
@@ -644,6 +743,12 @@ def on_signal(data, signal, signal_data):
 	global signal_delay_timer
 	global sort_queued
 
+	# Forget the sort key of the buffer in the signal data, or all of them if it isn't a buffer.
+	if signal_data in key_cache.keys or weechat.hdata_check_pointer(weechat.hdata_get('buffer'), weechat.hdata_get_list(weechat.hdata_get('buffer'), 'gui_buffers'), signal_data):
+		key_cache.invalidate(signal_data)
+	else:
+		key_cache.clear()
+
 	# If the sort limit timeout is started, we're in the hold-off time after sorting, just queue a sort.
 	if sort_limit_timer is not None:
 		if sort_queued:
@@ -660,7 +765,7 @@ def on_signal(data, signal, signal_data):
 
 	# Otherwise, start the signal delay timeout.
 	debug('Signal {0} received, starting signal delay timeout of {1} ms.'.format(signal, config.signal_delay))
-	weechat.hook_timer(config.signal_delay, 0, 1, "on_signal_delay_timeout", "")
+	signal_delay_timer = weechat.hook_timer(config.signal_delay, 0, 1, "on_signal_delay_timeout", "")
 	return weechat.WEECHAT_RC_OK
 
 def on_signal_delay_timeout(pointer, remaining_calls):
@@ -712,6 +817,11 @@ def on_sort_limit_timeout(pointer, remainin_calls):
 	return weechat.WEECHAT_RC_OK
 
 
+def on_buffer_changed(data, signal, signal_data):
+	''' Forget the sort key of a buffer that changed. '''
+	key_cache.invalidate(signal_data)
+	return weechat.WEECHAT_RC_OK
+
 def apply_config():
 	# Unhook all signals and hook the new ones.
 	for hook in hooks:
@@ -726,6 +836,7 @@ def apply_config():
 def on_config_changed(*args, **kwargs):
 	''' Called whenever the configuration changes. '''
 	config.reload()
+	key_cache.clear()
 	apply_config()
 
 	return weechat.WEECHAT_RC_OK
@@ -1041,6 +1152,7 @@ info_escape_arguments = 'text'
 
 if weechat.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION, SCRIPT_LICENSE, SCRIPT_DESC, "", ""):
 	config = Config('autosort')
+	key_cache = SortKeyCache()
 
 	colors = {
 		'default':  weechat.color('default'),
@@ -1067,6 +1179,10 @@ if weechat.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION, SCRIPT_LICENSE,
 	}
 
 	weechat.hook_config('autosort.*', 'on_config_changed',  '')
+	weechat.hook_signal('buffer_opened',     'on_buffer_changed', '')
+	weechat.hook_signal('buffer_closed',     'on_buffer_changed', '')
+	weechat.hook_signal('buffer_renamed',    'on_buffer_changed', '')
+	weechat.hook_signal('buffer_localvar_*', 'on_buffer_changed', '')
 	weechat.hook_completion('plugin_autosort', '', 'on_autosort_complete', '')
 	weechat.hook_command('autosort', command_description.format(**colors), '', '', command_completion, 'on_autosort_command', '')
 	weechat.hook_info('autosort_escape',  info_escape_description,  info_escape_arguments,  'on_info_escape', '')
@@ -196,6 +196,22 @@
 #   History:
 #
 #
+#   2026-10-18
+#   version 0.3.9: keep user lists updated from join, part, kick, quit, nick and /who
+#                  messages instead of reading the nicklist again, index users by host
+#
+#   2026-10-18
+#   version 0.3.8: fetch several mask lists at once per server, within a rate budget, and
+#                  fetch them when joining a watched channel
+#
+#   2026-10-18
+#   version 0.3.7: store channel masks in a SQLite database instead of a shelf, written as
+#                  they change and loaded per channel when first used
+#
+#   2026-10-18
+#   version 0.3.6: index masks and hostmasks by their literal prefix and suffix,
+#                  for faster ban matching in big channels
+#
 #   2023-02-05
 #   version 0.3.5: replace command /VERSION by /version
 #                  (compatibility with WeeChat 3.9)
@@ -296,7 +312,7 @@ WEECHAT_VERSION = (0x30200, '0.3.2')
 
 SCRIPT_NAME    = "chanop"
 SCRIPT_AUTHOR  = "Elián Hanisch <lambdae2@gmail.com>"
-SCRIPT_VERSION = "0.3.5"
+SCRIPT_VERSION = "0.3.9"
 SCRIPT_LICENSE = "GPL3"
 SCRIPT_DESC    = "Helper script for IRC Channel Operators"
 
@@ -326,7 +342,9 @@ import re
 import time
 import string
 import getopt
-from collections import defaultdict
+import sqlite3
+from bisect import bisect_left
+from collections import defaultdict, deque
 from shelve import DbfilenameShelf as Shelf
 
 chars = str.maketrans('', '')
@@ -477,30 +495,34 @@ def is_ip(s):
         return False
 
 _reCache = {}
+def get_pattern_regexp(pattern):
+    """Returns cached regexp object or compiles a new one from pattern."""
+    try:
+        regexp = _reCache[pattern]
+    except KeyError:
+        s = '^'
+        for c in pattern:
+            if c == '*':
+                s += '.*'
+            elif c == '?':
+                s += '.'
+            elif c in '[{':
+                s += r'[\[{]'
+            elif c in ']}':
+                s += r'[\]}]'
+            elif c in '|\\':
+                s += r'[|\\]'
+            else:
+                s += re.escape(c)
+        s += '$'
+        regexp = re.compile(s, re.I)
+        _reCache[pattern] = regexp
+    return regexp
+
 def cachedPattern(f):
     """Use cached regexp object or compile a new one from pattern."""
     def getRegexp(pattern, *arg):
-        try:
-            regexp = _reCache[pattern]
-        except KeyError:
-            s = '^'
-            for c in pattern:
-                if c == '*':
-                    s += '.*'
-                elif c == '?':
-                    s += '.'
-                elif c in '[{':
-                    s += r'[\[{]'
-                elif c in ']}':
-                    s += r'[\]}]'
-                elif c in '|\\':
-                    s += r'[|\\]'
-                else:
-                    s += re.escape(c)
-            s += '$'
-            regexp = re.compile(s, re.I)
-            _reCache[pattern] = regexp
-        return f(regexp, *arg)
+        return f(get_pattern_regexp(pattern), *arg)
     return getRegexp
 
 def hostmaskPattern(f):
@@ -536,6 +558,128 @@ pattern_match_list = cachedPattern(match_list)
 hostmask_match = hostmaskPattern(pattern_match)
 hostmask_match_list = hostmaskPattern(pattern_match_list)
 
+_wildcardRe = re.compile(r'[*?]')
+_nonAsciiRe = re.compile(r'[^\x00-\x7f]')
+def pattern_literals(pattern):
+    """Returns the literal prefix and suffix of pattern, lowered with IRC case rules. Every
+    string matched by pattern starts and ends with them.
+
+    '*!*@*.example.com' => ('', '.example.com')"""
+    if _nonAsciiRe.search(pattern):
+        # re.I does unicode case folding, IRClower doesn't.
+        return '', ''
+    parts = _wildcardRe.split(IRClower(pattern))
+    return parts[0], parts[-1]
+
+class HostmaskIndex(object):
+    """Sorted index of strings (usually hostmasks), for find the ones a pattern matches without
+    testing all of them."""
+    def __init__(self, strings):
+        self.strings = strings
+        self._others = [] # can't be sorted with IRClower, always tested
+        self._forwards = [] # only these can match 'pattern$*'
+        prefixes, suffixes = [], []
+        for i, s in enumerate(strings):
+            if '$' in s:
+                self._forwards.append(i)
+            if _nonAsciiRe.search(s):
+                self._others.append(i)
+                continue
+            s = IRClower(s)
+            prefixes.append((s, i))
+            suffixes.append((s[::-1], i))
+        prefixes.sort()
+        suffixes.sort()
+        self._prefixes = [ s for s, i in prefixes ]
+        self._prefixesPos = [ i for s, i in prefixes ]
+        self._suffixes = [ s for s, i in suffixes ]
+        self._suffixesPos = [ i for s, i in suffixes ]
+
+    def __len__(self):
+        return len(self.strings)
+
+    def _range(self, keys, positions, literal):
+        lo = bisect_left(keys, literal)
+        hi = bisect_left(keys, literal + '\uffff', lo)
+        return positions[lo:hi]
+
+    def _candidates(self, pattern):
+        prefix, suffix = pattern_literals(pattern)
+        if not prefix and not suffix:
+            return range(len(self.strings))
+        L = None
+        if prefix:
+            L = self._range(self._prefixes, self._prefixesPos, prefix)
+        if suffix:
+            R = self._range(self._suffixes, self._suffixesPos, suffix[::-1])
+            if L is None or len(R) < len(L):
+                L = R
+        L.extend(self._others)
+        L.sort() # keep the order of self.strings
+        return L
+
+    def match(self, pattern):
+        """Returns strings matched by pattern, like pattern_match_list()."""
+        regexp = get_pattern_regexp(pattern)
+        strings = self.strings
+        return [ strings[i] for i in self._candidates(pattern)
+                 if regexp.match(strings[i]) is not None ]
+
+    def hostmask_match(self, pattern):
+        """Returns hostmasks matched by pattern, like hostmask_match_list()."""
+        if not is_hostmask(pattern):
+            return ''
+        if '$' in pattern:
+            pattern = pattern.partition('$')[0]
+        L = [ s for s in self.match(pattern) if is_hostmask(s) ]
+        regexp = get_pattern_regexp(pattern + '$*')
+        strings = self.strings
+        L.extend([ strings[i] for i in self._forwards
+                   if is_hostmask(strings[i]) and regexp.match(strings[i]) is not None ])
+        return L
+
+class MaskIndex(object):
+    """Index of masks bucketed by their literal suffix (usually the host) or else their literal
+    prefix (usually the nick), for find the masks that match a hostmask without testing all of
+    them."""
+    def __init__(self, masks):
+        self.masks = masks
+        self._suffixes = defaultdict(list)
+        self._prefixes = defaultdict(list)
+        self._wild = []
+        for i, mask in enumerate(masks):
+            if not is_hostmask(mask):
+                # hostmask_match() never matches these
+                continue
+            prefix, suffix = pattern_literals(mask.partition('$')[0])
+            if suffix:
+                self._suffixes[suffix].append(i)
+            elif prefix:
+                self._prefixes[prefix].append(i)
+            else:
+                self._wild.append(i)
+
+    def __len__(self):
+        return len(self.masks)
+
+    def search(self, hostmask):
+        """Returns masks that match hostmask, like
+        [ mask for mask in masks if hostmask_match(mask, hostmask) ]"""
+        if not is_hostmask(hostmask):
+            return []
+        if '$' in hostmask or _nonAsciiRe.search(hostmask):
+            # can match masks with a ban forward in any bucket
+            L = range(len(self.masks))
+        else:
+            key = IRClower(hostmask)
+            L = list(self._wild)
+            for i in range(len(key)):
+                L.extend(self._suffixes.get(key[i:], ()))
+                L.extend(self._prefixes.get(key[:i + 1], ()))
+            L.sort()
+        masks = self.masks
+        return [ masks[i] for i in L if hostmask_match(masks[i], hostmask) ]
+
 def get_nick(s):
     """':nick!user@host' => 'nick'"""
     return weechat.info_get('irc_nick_from_host', s)
@@ -1323,9 +1467,29 @@ class MaskObject(object):
 
 class MaskList(CaseInsensibleDict):
     """Single list of masks"""
+    _index = None
     def __init__(self, server, channel):
         self.synced = 0
 
+    def __setitem__(self, k, v):
+        self._index = None
+        CaseInsensibleDict.__setitem__(self, k, v)
+
+    def __delitem__(self, k):
+        self._index = None
+        CaseInsensibleDict.__delitem__(self, k)
+
+    def pop(self, k):
+        self._index = None
+        return CaseInsensibleDict.pop(self, k)
+
+    def index(self):
+        """Returns (HostmaskIndex, MaskIndex) pair of our masks."""
+        if self._index is None:
+            masks = list(self.keys())
+            self._index = (HostmaskIndex(masks), MaskIndex(masks))
+        return self._index
+
     def add(self, mask, **kwargs):
         if mask in self:
             # mask exists, update it
@@ -1345,59 +1509,158 @@ class MaskList(CaseInsensibleDict):
 #            return []
 
     def search(self, pattern, reverseMatch=False):
+        hostmaskIndex, maskIndex = self.index()
         if reverseMatch:
-            L = [ mask for mask in self if hostmask_match(mask, pattern) ]
+            L = maskIndex.search(pattern)
         else:
-            L = pattern_match_list(pattern, list(self.keys()))
+            L = hostmaskIndex.match(pattern)
         return L
 
     def purge(self):
         pass
 
 class MaskCache(ServerChannelDict):
-    """Keeps a cache of masks for different channels."""
+    """Keeps a cache of masks for different channels, channel lists are loaded from the store
+    when first used and every change is written back."""
+    def __init__(self, mode, store):
+        self.mode = mode
+        self.store = store
+
+    def __missing__(self, key):
+        server, channel = key
+        rows = self.store.load(self.mode, server, channel)
+        if not rows:
+            raise KeyError(key)
+        masklist = MaskList(server, channel)
+        for mask, operator, date, expires, hostmask in rows:
+            masklist[mask] = MaskObject(mask, hostmask and hostmask.split(',') or [],
+                                        operator, date, expires)
+        self[key] = masklist
+        return masklist
+
+    def __contains__(self, key):
+        return ServerChannelDict.__contains__(self, key) or self.store.has(self.mode, *key)
+
     def add(self, server, channel, mask, **kwargs):
         """Adds a ban to (server, channel) banlist."""
         key = (server, channel)
         if key not in self:
             self[key] = MaskList(*key)
         ban = self[key].add(mask, **kwargs)
+        self.store.save(self.mode, server, channel, ban)
         return ban
 
     def remove(self, server, channel, mask=None):#, hostmask=None):
         key = (server, channel)
         try:
             if mask is None:
+                self.store.delete(self.mode, server, channel)
                 del self[key]
             else:
+                self.store.delete(self.mode, server, channel, mask)
                 del self[key][mask]
                 #debug("removing ban: %s" %banmask)
         except KeyError:
             pass
 
-class ChanopCache(Shelf):
+    def sync(self, server, channel, masks):
+        """Replaces (server, channel) banlist with masks, a list of (mask, operator, date)."""
+        key = (server, channel)
+        try:
+            masklist = self[key]
+        except KeyError:
+            masklist = self[key] = MaskList(server, channel)
+
+        # delete old masks in cache
+        banmasks = CaseInsensibleSet([ L[0] for L in masks ])
+        removed = [ mask for mask in masklist if mask not in banmasks ]
+        for mask in removed:
+            del masklist[mask]
+
+        bans = [ masklist.add(mask, operator=op, date=date) for mask, op, date in masks ]
+        self.store.update(self.mode, server, channel, bans, removed)
+        return masklist
+
+    def purge(self):
+        for key in self.store.channels(self.mode):
+            if key not in chanopChannels:
+                debug('removing %s mask list, not in watchlist.', key)
+                self.remove(*key)
+        ServerChannelDict.purge(self)
+
+class ChanopCache(object):
+    """SQLite store of channel masks, keyed by (mode, server, channel, mask). Server, channel
+    and mask keys are stored lowered with IRC case rules."""
     def __init__(self, filename):
         options = {
             'directory': 'data',
         }
         path = weechat.string_eval_path_home('%%h/%s' % filename, {}, {}, options)
-        Shelf.__init__(self, path, writeback=True)
+        self.db = sqlite3.connect(path)
+        # it's a cache, losing the last changes in a power failure is fine.
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.created = not self.db.execute("SELECT 1 FROM sqlite_master "
+                                           "WHERE type = 'table' AND name = 'masks'").fetchone()
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS masks ('
+                            'mode TEXT, server TEXT, channel TEXT, key TEXT, mask TEXT, '
+                            'operator TEXT, date INTEGER, expires INTEGER, hostmask TEXT, '
+                            'PRIMARY KEY (mode, server, channel, key))')
+
+    def load(self, mode, server, channel):
+        """Returns list of (mask, operator, date, expires, hostmask) rows."""
+        return self.db.execute('SELECT mask, operator, date, expires, hostmask FROM masks '
+                               'WHERE mode = ? AND server = ? AND channel = ? ORDER BY rowid',
+                               (mode, IRClower(server), IRClower(channel))).fetchall()
+
+    def has(self, mode, server, channel):
+        return self.db.execute('SELECT 1 FROM masks '
+                               'WHERE mode = ? AND server = ? AND channel = ? LIMIT 1',
+                               (mode, IRClower(server), IRClower(channel))).fetchone() is not None
+
+    def channels(self, mode):
+        """Returns list of (server, channel) with masks of mode."""
+        return self.db.execute('SELECT DISTINCT server, channel FROM masks WHERE mode = ?',
+                               (mode, )).fetchall()
+
+    def update(self, mode, server, channel, bans=(), removed=()):
+        """Writes MaskObjects in bans and deletes masks in removed, in a single transaction."""
+        server, channel = IRClower(server), IRClower(channel)
+        with self.db:
+            self.db.executemany('DELETE FROM masks '
+                                'WHERE mode = ? AND server = ? AND channel = ? AND key = ?',
+                                [ (mode, server, channel, IRClower(mask)) for mask in removed ])
+            self.db.executemany('INSERT OR REPLACE INTO masks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                [ (mode, server, channel, IRClower(ban.mask), ban.mask,
+                                   ban.operator, ban.date, ban.expires, ','.join(ban.hostmask))
+                                  for ban in bans ])
+
+    def save(self, mode, server, channel, *bans):
+        self.update(mode, server, channel, bans=bans)
+
+    def delete(self, mode, server, channel, *masks):
+        """Deletes masks, or the whole channel list if none given."""
+        if masks:
+            self.update(mode, server, channel, removed=masks)
+        else:
+            with self.db:
+                self.db.execute('DELETE FROM masks WHERE mode = ? AND server = ? AND channel = ?',
+                                (mode, IRClower(server), IRClower(channel)))
+
+    def close(self):
+        self.db.close()
 
-class ModeCache(ChanopCache):
+class ModeCache(dict):
     """class for store channel modes lists."""
     def __init__(self, filename):
-        ChanopCache.__init__(self, filename)
+        self.store = ChanopCache(filename)
         self.modes = set()
         self.map = CaseInsensibleDict()
 
-        # reset all sync timers
-        for cache in list(self.values()):
-            for masklist in list(cache.values()):
-                masklist.synced = 0
-
     def registerMode(self, mode, *args):
         if mode not in self:
-            cache = MaskCache()
+            cache = MaskCache(mode, self.store)
             self[mode] = cache
 
         if mode not in self.modes:
@@ -1409,9 +1672,32 @@ class ModeCache(ChanopCache):
 
     def __getitem__(self, mode):
         try:
-            return ChanopCache.__getitem__(self, mode)
+            return dict.__getitem__(self, mode)
         except KeyError:
-            return ChanopCache.__getitem__(self, self.map[mode])
+            return dict.__getitem__(self, self.map[mode])
+
+    def importShelf(self, filename):
+        """Imports mask lists from the shelf used by chanop 0.3.6 and older, only done when
+        the store is new."""
+        if not self.store.created:
+            return
+        options = {
+            'directory': 'data',
+        }
+        path = weechat.string_eval_path_home('%%h/%s' % filename, {}, {}, options)
+        try:
+            shelf = Shelf(path, flag='r')
+        except Exception:
+            # no shelf
+            return
+        try:
+            for mode in self.modes:
+                if mode not in shelf:
+                    continue
+                for (server, channel), masklist in list(shelf[mode].items()):
+                    self.store.save(mode, server, channel, *list(masklist.values()))
+        finally:
+            shelf.close()
 
     def add(self, server, channel, mode, mask, **kwargs):
         assert mode in self.modes
@@ -1425,9 +1711,9 @@ class ModeCache(ChanopCache):
             cache.purge()
 
 class MaskSync(object):
-    """Class for fetch and sync bans of any channel and mode."""
+    """Class for fetch and sync bans of any channel and mode. Several lists are requested at
+    once per server, replies are matched to their request by channel and mode."""
     __name__ = ''
-    _hide_msg = False
 
     _hook_mask = ''
     _hook_end = ''
@@ -1436,8 +1722,18 @@ class MaskSync(object):
     _hook_quiet_mask = ''
     _hook_quiet_end = ''
 
+    _hook_disconnected = ''
+
     # sync queue stuff
-    queue = []
+    max_in_flight = 3       # list requests waiting for their reply, per server
+    rate_budget = (6, 10)   # max requests sent in that many seconds, per server
+    timeout = 60            # forget requests without reply after this many seconds
+
+    _queue = CaseInsensibleDefaultDict(deque)           # server => (channel, mode) to fetch
+    _inflight = CaseInsensibleDefaultDict(CaseInsensibleDict) # server => {(channel, mode): sent}
+    _sent = CaseInsensibleDefaultDict(deque)            # server => times of sent requests
+    _expired = CaseInsensibleDefaultDict(CaseInsensibleDict) # server => {(channel, mode): expired}
+    _timer = CaseInsensibleDict()
     _maskbuffer = CaseInsensibleDefaultDict(list)
     _callback = CaseInsensibleDict()
 
@@ -1455,12 +1751,16 @@ class MaskSync(object):
                 weechat.hook_modifier('irc_in_728', callback(self._maskCallback), '')
         self._hook_quiet_end = \
                 weechat.hook_modifier('irc_in_729', callback(self._endCallback), '')
+        self._hook_disconnected = \
+                weechat.hook_signal('irc_server_disconnected',
+                                    callback(self._disconnectedCallback), '')
 
     def unhook(self):
         for hook in ('_hook_mask',
                      '_hook_end',
                      '_hook_quiet_mask',
-                     '_hook_quiet_end'):
+                     '_hook_quiet_end',
+                     '_hook_disconnected'):
             attr = getattr(self, hook)
             if attr:
                 weechat.unhook(attr)
@@ -1487,94 +1787,171 @@ class MaskSync(object):
         except KeyError:
             pass
 
-        if not self.queue:
-            self.queue.append((server, channel, mode))
-            self._fetch(server, channel, mode)
-        elif (server, channel, mode) not in self.queue:
-            self.queue.append((server, channel, mode))
+        # a request that timed out must not keep this one from being sent
+        self._expire(server)
+        if callback:
+            self._callback[server, channel, mode] = callback
 
+        key = caseInsensibleKey((channel, mode))
+        queue = self._queue[server]
+        if key in self._inflight[server]:
+            return
         if callback:
-            self._callback[server, channel] = callback
+            # somebody is waiting for this one
+            if key in queue:
+                queue.remove(key)
+            queue.appendleft(key)
+        elif key not in queue:
+            queue.append(key)
+        self._dispatch(server)
+
+    def pending(self, server, channel, mode):
+        """Returns True if masks of channel are queued or being fetched."""
+        self._expire(server)
+        key = caseInsensibleKey((channel, mode))
+        return key in self._queue[server] or key in self._inflight[server]
+
+    def _next(self, queue, server):
+        """Pops next request from queue, the channel of the current buffer goes first."""
+        current = irc_buffer(weechat.current_buffer())
+        if current and caseInsensibleKey(server) == current[0]:
+            for key in queue:
+                if key[0] == current[1]:
+                    queue.remove(key)
+                    return key
+        return queue.popleft()
+
+    def _expire(self, server):
+        """Gives up on requests in flight without reply after timeout."""
+        inflight, expired = self._inflight[server], self._expired[server]
+        t = now()
+        for key, started in list(expired.items()):
+            if t - started > self.timeout:
+                del expired[key]
+        for key, started in list(inflight.items()):
+            if t - started > self.timeout:
+                debug('MaskSync: no reply for %s %s, giving up.', server, key)
+                del inflight[key]
+                # a late reply is hidden and dropped, what was received is incomplete
+                channel, mode = key
+                for pending in (self._callback, self._maskbuffer):
+                    if (server, channel, mode) in pending:
+                        del pending[server, channel, mode]
+                expired[key] = t
+
+    def _dispatch(self, server):
+        """Sends queued requests while they fit in flight and in the rate budget."""
+        queue, inflight, sent = self._queue[server], self._inflight[server], self._sent[server]
+        expired = self._expired[server]
+        self._expire(server)
+        t = now()
+
+        max_sent, seconds = self.rate_budget
+        while sent and t - sent[0] >= seconds:
+            sent.popleft()
+
+        while queue and len(inflight) < self.max_in_flight and len(sent) < max_sent:
+            channel, mode = self._next(queue, server)
+            if self._fetch(server, channel, mode):
+                inflight[channel, mode] = t
+                if (channel, mode) in expired:
+                    del expired[channel, mode]
+                sent.append(t)
+
+        if queue and server not in self._timer:
+            # try again when a request is allowed or one in flight times out
+            if len(sent) >= max_sent:
+                delay = sent[0] + seconds - t
+            else:
+                delay = min(inflight.values()) + self.timeout + 1 - t
+            self._timer[server] = weechat.hook_timer(max(delay, 1) * 1000, 0, 1,
+                                                     callback(self._timerCallback), server)
+
+    def _timerCallback(self, server, count):
+        del self._timer[server]
+        self._dispatch(server)
+        return WEECHAT_RC_OK
+
+    def _disconnectedCallback(self, data, signal, server):
+        """Forgets the requests of a server, their replies won't come."""
+        debug('MaskSync: %s disconnected, dropping queued requests.', server)
+        if server in self._timer:
+            weechat.unhook(self._timer.pop(server))
+        for state in (self._queue, self._inflight, self._sent, self._expired):
+            if server in state:
+                del state[server]
+        for pending in (self._callback, self._maskbuffer):
+            for key in [key for key in pending if key[0] == caseInsensibleKey(server)]:
+                del pending[key]
+        return WEECHAT_RC_OK
 
     def _fetch(self, server, channel, mode):
         buffer = weechat.buffer_search('irc', 'server.%s' %server)
         if not buffer:
-            return
+            return False
         cmd = '/mode %s %s' %(channel, mode)
-        self._hide_msg = True
         weechat_command(buffer, cmd)
+        return True
 
     def _maskCallback(self, data, modifier, modifier_data, string):
         """callback for store a single mask."""
         #debug("MASK %s: %s %s", modifier, modifier_data, string)
         args = string.split()
-        if self.queue:
-            server, channel, _ = self.queue[0]
-        else:
-            server, channel = modifier_data, args[3]
-
+        server, channel = modifier_data, args[3]
         if modifier == 'irc_in_367':
+            mode = 'b'
             try:
                 mask, op, date = args[4:]
-            except IndexError:
+            except ValueError:
                 mask = args[4]
                 op = date = None
         elif modifier == 'irc_in_728':
+            mode = args[4]
             mask, op, date = args[5:]
 
+        if (channel, mode) in self._expired[server]:
+            # reply of a request that timed out
+            return ''
+
         # store temporally until "end list" msg
-        self._maskbuffer[server, channel].append((mask, op, date))
-        if self._hide_msg:
+        self._maskbuffer[server, channel, mode].append((mask, op, date))
+        if (channel, mode) in self._inflight[server]:
+            # we asked for it, hide it
             string = ''
         return string
 
     def _endCallback(self, data, modifier, modifier_data, string):
         """callback for end of channel's mask list."""
         #debug("MASK END %s: %s %s", modifier, modifier_data, string)
-        if self.queue:
-            server, channel, mode = self.queue.pop(0)
+        args = string.split()
+        server, channel = modifier_data, args[3]
+        if modifier == 'irc_in_368':
+            mode = 'b'
+        elif modifier == 'irc_in_729':
+            mode = args[4]
         else:
-            args = string.split()
-            server, channel = modifier_data, args[3]
-            if modifier == 'irc_in_368':
-                mode = args[7]
-            elif modifier == 'irc_in_729':
-                mode = args[4]
-            else:
-                return string
+            return string
 
-        maskCache = modeCache[mode]
+        expired = self._expired[server]
+        if (channel, mode) in expired:
+            del expired[channel, mode]
+            return ''
 
-        # delete old masks in cache
-        if (server, channel) in maskCache:
-            masklist = maskCache[server, channel]
-            banmasks = [ L[0] for L in self._maskbuffer[server, channel] ]
-            for mask in list(masklist.keys()):
-                if mask not in banmasks:
-                    del masklist[mask]
-
-        for banmask, op, date in self._maskbuffer[server, channel]:
-            maskCache.add(server, channel, banmask, operator=op, date=date)
-        del self._maskbuffer[server, channel]
-        try:
-            maskList = maskCache[server, channel]
-        except KeyError:
-            maskList = maskCache[server, channel] = MaskList(server, channel)
+        maskCache = modeCache[mode]
+        maskList = maskCache.sync(server, channel, self._maskbuffer[server, channel, mode])
+        del self._maskbuffer[server, channel, mode]
         maskList.synced = now()
 
         # run hooked functions if any
-        if (server, channel) in self._callback:
-            self._callback[server, channel]()
-            del self._callback[server, channel]
+        if (server, channel, mode) in self._callback:
+            self._callback[server, channel, mode]()
+            del self._callback[server, channel, mode]
 
-        if self._hide_msg:
+        inflight = self._inflight[server]
+        if (channel, mode) in inflight:
+            del inflight[channel, mode]
             string = ''
-        if self.queue:
-            next = self.queue[0]
-            self._fetch(*next)
-        else:
-            assert not self._maskbuffer, "mask buffer not empty: %s" % list(self._maskbuffer.keys())
-            self._hide_msg = False
+            self._dispatch(server)
         return string
 
 maskSync = MaskSync()
@@ -1582,7 +1959,15 @@ maskSync = MaskSync()
 # -----------------------------------------------------------------------------
 # User cache
 
+def host_key(hostmask):
+    """Returns host of hostmask lowered with IRC case rules, None if it has non ascii chars."""
+    host = hostmask.rpartition('@')[2]
+    if _nonAsciiRe.search(host):
+        return None
+    return IRClower(host)
+
 class UserObject(object):
+    __slots__ = ('nick', '_hostmask', 'seen', '_channels')
     def __init__(self, nick, hostmask=None):
         self.nick = nick
         if hostmask:
@@ -1618,18 +2003,45 @@ class ServerUserList(CaseInsensibleDict):
         buffer = weechat.buffer_search('irc', 'server.%s' %server)
         self.irc = IrcCommands(buffer)
         self._purge_time = 3600*4 # 4 hours
+        self.hosts = defaultdict(set) # host_key() => users that had that host
 
     def getHostmask(self, nick):
         user = self[nick]
         return user.hostmask
 
+    def remember(self, nick, hostmask):
+        """Returns nick's user, updated with hostmask."""
+        try:
+            user = self[nick]
+        except KeyError:
+            #debug("%s: new user %s %s", self.server, nick, hostmask)
+            user = self[nick] = UserObject(nick, hostmask)
+            if hostmask:
+                self.hosts[host_key(hostmask)].add(user)
+            return user
+        if hostmask:
+            if hostmask not in user._hostmask:
+                self.hosts[host_key(hostmask)].add(user)
+            user.update(hostmask)
+        return user
+
+    def forget(self, nick):
+        user = self.pop(nick)
+        for hostmask in user._hostmask:
+            key = host_key(hostmask)
+            users = self.hosts.get(key)
+            if users:
+                users.discard(user)
+                if not users:
+                    del self.hosts[key]
+
     def purge(self):
         """Purge old nicks"""
         n = now()
         for nick, user in list(self.items()):
             if user._channels < 1 and (n - user.seen) > self._purge_time:
                 #debug('purging old user: %s' % nick)
-                del self[nick]
+                self.forget(nick)
 
 class UserList(ServerUserList):
     def __init__(self, server, channel):
@@ -1637,11 +2049,15 @@ class UserList(ServerUserList):
         self.channel = channel
         self._purge_list = CaseInsensibleDict()
         self._purge_time = 3600*2 # 2 hours
+        self._index = {}
 
     def __setitem__(self, nick, user):
         #debug('%s %s: join, %s', self.server, self.channel, nick)
         if nick not in self:
             user._channels += 1
+        elif self[nick] is not user:
+            self[nick]._channels -= 1
+            user._channels += 1
         if nick in self._purge_list:
             #debug(' - removed from purge list')
             del self._purge_list[nick]
@@ -1672,6 +2088,34 @@ class UserList(ServerUserList):
             # only current hostmasks
             return [ user.hostmask for user in users if user._hostmask ]
 
+    def hostmask_match(self, mask, all=False):
+        """Returns hostmasks of our users matched by mask, like hostmask_match_list(). Masks with
+        a literal host only test the users that had that host."""
+        if not is_hostmask(mask):
+            return ''
+        host = mask.partition('$')[0].rpartition('@')[2]
+        if _wildcardRe.search(host) or _nonAsciiRe.search(host):
+            return self.hostmaskIndex(all).hostmask_match(mask)
+
+        hosts = userCache[self.server].hosts
+        hostmasks = []
+        for user in hosts.get(IRClower(host), set()) | hosts.get(None, set()):
+            if user.nick not in self or self[user.nick] is not user:
+                continue
+            if all:
+                hostmasks.extend(user._hostmask)
+            elif user._hostmask:
+                hostmasks.append(user.hostmask)
+        return hostmask_match_list(mask, hostmasks)
+
+    def hostmaskIndex(self, all=False):
+        """Returns a HostmaskIndex of hostmasks(), reused while they don't change."""
+        hostmasks = self.hostmasks(all=all)
+        index = self._index.get(all)
+        if index is None or index.strings != hostmasks:
+            index = self._index[all] = HostmaskIndex(hostmasks)
+        return index
+
     def nicks(self, *args, **kwargs):
 #        if not all(self.itervalues()):
 #            userCache.who(self.server, self.channel)
@@ -1700,10 +2144,28 @@ class UserList(ServerUserList):
                     pass
 
 class UserCache(ServerChannelDict):
+    """Keeps user lists of channels. Lists are updated from join, part, kick, quit, nick and
+    /who messages, the nicklist is only read when a list is first needed."""
     __name__ = ''
     servercache = CaseInsensibleDict()
-    _hook_who = _hook_who_end = None
-    _channels = CaseInsensibleSet()
+    _hook_who = _hook_who_end = ''
+    _channels = CaseInsensibleSet() # channels we did a /who
+    _who = CaseInsensibleSet()      # channels waiting for /who reply
+
+    def hook(self):
+        # 352 - who reply
+        # 315 - end of who
+        self.unhook()
+        self._hook_who = weechat.hook_modifier('irc_in_352', callback(self._whoCallback), '')
+        self._hook_who_end = \
+                weechat.hook_modifier('irc_in_315', callback(self._endWhoCallback), '')
+
+    def unhook(self):
+        for hook in ('_hook_who', '_hook_who_end'):
+            attr = getattr(self, hook)
+            if attr:
+                weechat.unhook(attr)
+                setattr(self, hook, '')
 
     def generateCache(self, server, channel):
         debug('* building cache: %s %s', server, channel)
@@ -1729,16 +2191,17 @@ class UserCache(ServerChannelDict):
         return users
 
     def remember(self, server, nick, hostmask):
-        cache = self[server]
-        try:
-            user = cache[nick]
-            if hostmask:
-                user.update(hostmask)
-        except KeyError:
-            #debug("%s: new user %s %s", server, nick, hostmask)
-            user = UserObject(nick, hostmask)
-            cache[nick] = user
-        return user
+        return self[server].remember(nick, hostmask)
+
+    def join(self, server, channel):
+        """We joined channel, start a new user list and fill it with /who."""
+        key = (server, channel)
+        if key in self:
+            del self[key]
+        self[key] = UserList(server, channel)
+        if key in self._channels:
+            self._channels.remove(key)
+        self.who(server, channel)
 
     def __getitem__(self, k):
         if isinstance(k, tuple):
@@ -1757,7 +2220,7 @@ class UserCache(ServerChannelDict):
         # when we delete a channel, we need to reduce user._channels count
         # so they can be purged later.
         #debug('forgeting about %s', k)
-        for user in list(self[k].values()):
+        for user in list(dict.values(ServerChannelDict.__getitem__(self, k))):
             user._channels -= 1
         ServerChannelDict.__delitem__(self, k)
 
@@ -1768,20 +2231,11 @@ class UserCache(ServerChannelDict):
         return self[server].getHostmask(nick)
 
     def who(self, server, channel):
-        if self._hook_who:
-            return
-
         if (server, channel) in self._channels:
             return
 
         self._channels.add((server, channel))
-
-        key = ('%s.%s' %(server, channel)).lower()
-        self._hook_who = weechat.hook_modifier(
-                'irc_in_352', callback(self._whoCallback), key)
-        self._hook_who_end = weechat.hook_modifier(
-                'irc_in_315', callback(self._endWhoCallback), key)
-
+        self._who.add((server, channel))
         buffer = weechat.buffer_search('irc', 'server.%s' %server)
         weechat_command(buffer, '/who %s' % channel)
 
@@ -1789,27 +2243,23 @@ class UserCache(ServerChannelDict):
         #debug('%s %s %s', modifier, modifier_data, string)
         args = string.split()
         server, channel = modifier_data, args[3]
-        key = ('%s.%s' %(server, channel)).lower()
-        if key != data:
+        if (server, channel) not in self._who:
             return string
 
         nick, user, host = args[7], args[4], args[5]
         hostmask = '%s!%s@%s' %(nick, user, host)
         debug('WHO: %s', hostmask)
-        self.remember(server, nick, hostmask)
+        self[server, channel][nick] = self.remember(server, nick, hostmask)
         return ''
 
     def _endWhoCallback(self, data, modifier, modifier_data, string):
         args = string.split()
         server, channel = modifier_data, args[3]
-        key = ('%s.%s' %(server, channel)).lower()
-        if key != data:
+        if (server, channel) not in self._who:
             return string
 
         debug('WHO: end.')
-        weechat.unhook(self._hook_who)
-        weechat.unhook(self._hook_who_end)
-        self._hook_who = self._hook_who_end = None
+        self._who.remove((server, channel))
         return ''
 
     def purge(self):
@@ -2627,12 +3077,10 @@ def mode_cb(server, channel, nick, opHostmask, signal_data):
 
     # check if channel is in watchlist
     key = (server, channel)
-    allkeys = CaseInsensibleSet()
-    for maskCache in list(modeCache.values()):
-        allkeys.update(maskCache)
-        if key not in allkeys and key not in chanopChannels:
-            # from a channel we're not tracking
-            return WEECHAT_RC_OK
+    if key not in chanopChannels \
+            and not [ maskCache for maskCache in list(modeCache.values()) if key in maskCache ]:
+        # from a channel we're not tracking
+        return WEECHAT_RC_OK
 
     prefix = get_isupport_value(server, 'prefix')
     chanmodes = get_isupport_value(server, 'chanmodes')
@@ -2667,7 +3115,7 @@ def mode_cb(server, channel, nick, opHostmask, signal_data):
     for action, mode, mask in chanmode_list:
         debug('MODE: %s%s %s %s', action, mode, mask, opHostmask)
         if action == '+':
-            hostmask = hostmask_match_list(mask, userCache[key].hostmasks())
+            hostmask = userCache[key].hostmask_match(mask)
             if hostmask:
                 affected_users.extend(hostmask)
             if mask != '*!*@*':
@@ -2691,11 +3139,10 @@ def mode_cb(server, channel, nick, opHostmask, signal_data):
 def join_cb(server, channel, nick, hostmask, signal_data):
     if weechat.info_get('irc_nick', server) == nick:
         # we're joining the channel, the cache is no longer valid
-        #userCache.generateCache(server, channel)
-        try:
-            del userCache[server, channel]
-        except KeyError:
-            pass
+        userCache.join(server, channel)
+        # and so is the mask cache
+        for mode in supported_modes(server):
+            maskSync.fetch(server, channel, mode)
         return WEECHAT_RC_OK
     user = userCache.remember(server, nick, hostmask)
     userCache[server, channel][nick] = user
@@ -2707,6 +3154,12 @@ def part_cb(server, channel, nick, hostmask, signal_data):
     userCache[server, channel].part(nick)
     return WEECHAT_RC_OK
 
+@signal_parse
+def kick_cb(server, channel, nick, hostmask, signal_data):
+    kicked = signal_data.split()[3]
+    userCache[server, channel].part(kicked)
+    return WEECHAT_RC_OK
+
 @signal_parse_no_channel
 def quit_cb(server, channels, nick, hostmask, signal_data):
     userCache.remember(server, nick, hostmask)
@@ -2734,9 +3187,11 @@ def garbage_collector_cb(data, counter):
     modeCache.purge()
     userCache.purge()
 
-    if weechat.config_get_plugin('debug'):
-        # extra check that everything is right.
-        for serv, chan in userCache:
+    value = weechat.config_get_plugin('debug')
+    if value and boolDict[value]:
+        # extra check that everything is right, lists of channels not in watchlist aren't
+        # updated.
+        for serv, chan in [ key for key in userCache if key in chanopChannels ]:
             for nick in [ nick['name'] for nick in nick_infolist(serv, chan) ]:
                 if nick not in userCache[serv, chan]:
                     error('User cache out of sync, unknown nick. (%s - %s.%s)' % (nick, serv, chan))
@@ -2855,7 +3310,7 @@ def unban_mask_cmpl(mode, completion_item, buffer, completion):
 
     if key not in maskCache or not maskCache[key].synced:
         # do completion after fetching marks
-        if not maskSync.queue:
+        if not maskSync.pending(server, channel, mode):
             def callback():
                 masklist = maskCache[key]
                 if chanop_bar:
@@ -3046,10 +3501,9 @@ def item_ban_matches_cb(data, item, window):
     #debug('ban matches item: %s', masks)
 
     affected = []
-    hostmasks = users.hostmasks(all=True)
     for mask in masks:
         if is_hostmask(mask):
-            affected.extend(hostmask_match_list(mask, hostmasks))
+            affected.extend(users.hostmask_match(mask, all=True))
         elif mask in users:
             affected.append(mask)
     #debug('ban matches item: %s', affected)
@@ -3109,6 +3563,7 @@ def unload_chanop():
     bar_item = weechat.bar_item_search('chanop_ban_matches')
     if bar_item:
         weechat.bar_item_remove(bar_item)
+    modeCache.store.close()
     return WEECHAT_RC_OK
 
 # Register script
@@ -3163,12 +3618,13 @@ if __name__ == '__main__' and import_ok and \
         if not weechat.config_is_set_plugin(opt):
             weechat.config_set_plugin(opt, val)
 
-    modeCache = ModeCache('chanop_mode_cache.dat')
+    modeCache = ModeCache('chanop_mode_cache.db')
     modeCache.registerMode('b', 'ban', 'bans')
     modeCache.registerMode('q', 'quiet', 'quiets')
+    modeCache.importShelf('chanop_mode_cache.dat')
 
     # -------------------------------------------------------------------------
-    # remove old chanmask config and save them in shelf
+    # remove old chanmask config and save them in mask store
 
     prefix = 'python.%s.chanmask' % SCRIPT_NAME
     infolist = Infolist('option', 'plugins.var.%s.*' % prefix)
@@ -3187,6 +3643,7 @@ if __name__ == '__main__' and import_ok and \
         else:
             obj = masklist[mask] = MaskObject(mask)
             obj.deserialize(infolist['value'])
+        modeCache.store.save(mode, server, channel, masklist[mask])
         weechat.config_unset_plugin('chanmask.%s.%s.%s.%s' \
                 % (server, channel, mode, mask))
     del infolist
@@ -3218,6 +3675,7 @@ if __name__ == '__main__' and import_ok and \
     DeVoice().hook()
 
     maskSync.hook()
+    userCache.hook()
 
     weechat.hook_config('plugins.var.python.%s.enable_multi_kick' % SCRIPT_NAME,
             'enable_multi_kick_conf_cb', '')
@@ -3235,6 +3693,7 @@ if __name__ == '__main__' and import_ok and \
 
     weechat.hook_signal('*,irc_in_join', 'join_cb', '')
     weechat.hook_signal('*,irc_in_part', 'part_cb', '')
+    weechat.hook_signal('*,irc_in_kick', 'kick_cb', '')
     weechat.hook_signal('*,irc_in_quit', 'quit_cb', '')
     weechat.hook_signal('*,irc_in_nick', 'nick_cb', '')
     weechat.hook_signal('*,irc_in_mode', 'mode_cb', '')
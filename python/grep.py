@@ -56,10 +56,21 @@
 #   * plugins.var.python.grep.timeout_secs:
 #     Timeout (in seconds) for background grepping.
 #
+#   * plugins.var.python.grep.workers:
+#     Number of processes used for background grepping, '0' uses one process per CPU. With more
+#     than one process, results of each log are shown as soon as the log is grepped.
+#
 #   * plugins.var.python.grep.default_tail_head:
 #     Config option for define default number of lines returned when using --head or --tail options.
 #     Can be overriden in the command with --number option.
 #
+#   * plugins.var.python.grep.index:
+#     Use an index of the logs for narrowing searches to the parts of the logs that can match,
+#     the index is updated in the background after searching. Valid values: on, off
+#
+#   * plugins.var.python.grep.index_file:
+#     Path of the index database (path is evaluated, see /help eval).
+#
 #
 #   TODO:
 #   * try to figure out why hook_process chokes in long outputs (using a tempfile as a
@@ -69,6 +80,24 @@
 #
 #   History:
 #
+#   2026-10-18
+#   version 0.9.3: search logs with a bytes regexp over the memory mapped file when the
+#                  pattern has a literal part, only lines where it's found are decoded
+#
+#   2026-10-18
+#   version 0.9.2: --tail and --before-context don't load the whole log in memory
+#
+#   2026-10-18
+#   version 0.9.1: grep logs in a pool of processes
+#   * added option 'workers'
+#   * results of each log are shown as soon as they are available
+#
+#   2026-10-18
+#   version 0.9.0: optional trigram index of the logs
+#   * searches with literal text only read the parts of the logs that can match
+#   * added options 'index' and 'index_file'
+#   * added /grep index rebuild|verify
+#
 #   2022-11-11, anonymous2ch
 #   version 0.8.6: ignore utf-8 decoding errors
 #
@@ -226,6 +255,7 @@
 ###
 
 from os import path
+from collections import deque
 import sys, getopt, time, os, re
 
 try:
@@ -242,7 +272,7 @@ except ImportError:
 
 SCRIPT_NAME    = "grep"
 SCRIPT_AUTHOR  = "Elián Hanisch <lambdae2@gmail.com>"
-SCRIPT_VERSION = "0.8.6"
+SCRIPT_VERSION = "0.9.3"
 SCRIPT_LICENSE = "GPL3"
 SCRIPT_DESC    = "Search in buffers and logs"
 SCRIPT_COMMAND = "grep"
@@ -257,6 +287,9 @@ settings = {
     'size_limit'        : '2048',
     'default_tail_head' : '10',
     'timeout_secs'      : '300',
+    'index'             : 'off',
+    'index_file'        : '%h/grep_index.db',
+    'workers'           : '1',
 }
 
 ### Class definitions ###
@@ -379,6 +412,41 @@ def get_size(f):
     except OSError:
         return 0
 
+REVERSE_BLOCK_SIZE = 64 * 1024
+def reversed_lines(file, block_size=REVERSE_BLOCK_SIZE):
+    """Yields the lines of 'file' from the last one to the first one. The file is read backwards
+    in blocks, so memory use doesn't depend on the size of the file. Lines are decoded and their
+    newlines translated like when reading the file in text mode."""
+    import locale
+    encoding = locale.getpreferredencoding(False)
+    def decode(line):
+        line = line.decode(encoding, 'ignore')
+        if line[-2:] == '\r\n':
+            return line[:-2] + '\n'
+        elif line[-1:] == '\r':
+            return line[:-1] + '\n'
+        return line
+
+    try:
+        file_object = open(file, 'rb')
+    except IOError:
+        return
+    with file_object:
+        position = file_object.seek(0, 2)
+        # first line of the data already read, it might start in the previous block
+        rest = b''
+        while position > 0:
+            size = min(block_size, position)
+            position -= size
+            file_object.seek(position)
+            data = file_object.read(size) + rest
+            data = data.splitlines(True)
+            rest = data[0]
+            for line in reversed(data[1:]):
+                yield decode(line)
+        if rest:
+            yield decode(rest)
+
 sizeDict = {0:'b', 1:'KiB', 2:'MiB', 3:'GiB', 4:'TiB'}
 def human_readable_size(size):
     power = 0
@@ -714,8 +782,469 @@ def check_string(s, regexp, hilight='', exact=False):
     elif regexp.search(s):
         return s
 
-def grep_file(file, head, tail, after_context, before_context, count, regexp, hilight, exact, invert):
-    """Return a list of lines that match 'regexp' in 'file', if no regexp returns all lines."""
+def regexp_literals(regexp):
+    """Returns the literal parts of 'regexp' that are always required for a match, as a list of
+    (string, ignorecase) tuples."""
+    try:
+        from re import _parser as sre_parse
+    except ImportError:
+        import sre_parse
+    try:
+        parsed = sre_parse.parse(regexp.pattern, regexp.flags)
+    except Exception:
+        return []
+    repeats = [ getattr(sre_parse, op) for op in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+            if hasattr(sre_parse, op) ]
+    literals = []
+
+    def walk(items, ignorecase):
+        chars = []
+        for op, av in items:
+            if op == sre_parse.LITERAL:
+                chars.append(chr(av))
+                continue
+            if chars:
+                literals.append((''.join(chars), ignorecase))
+                chars = []
+            if op == sre_parse.SUBPATTERN:
+                group, add_flags, del_flags, subpattern = av
+                walk(subpattern, bool((ignorecase or add_flags & re.IGNORECASE) and \
+                        not del_flags & re.IGNORECASE))
+            elif op in repeats and av[0] >= 1:
+                walk(av[2], ignorecase)
+        if chars:
+            literals.append((''.join(chars), ignorecase))
+
+    walk(parsed, bool(regexp.flags & re.IGNORECASE))
+    return literals
+
+# non ascii chars matched by ascii letters when ignoring case
+ignorecase_equivalents = {'i': '\u0130\u0131', 'k': '\u212a', 's': '\u017f'}
+def make_literal_bytes_regexp(literal, ignorecase):
+    """Returns a compiled bytes regexp that matches the utf-8 encoded 'literal', when ignoring
+    case 'literal' must be ascii."""
+    pattern = []
+    for c in literal:
+        if ignorecase and c.lower() in ignorecase_equivalents:
+            chars = c.lower() + c.upper() + ignorecase_equivalents[c.lower()]
+            pattern.append(b'(?:%s)' %b'|'.join([ re.escape(char.encode('utf-8'))
+                for char in chars ]))
+        else:
+            pattern.append(re.escape(c.encode('utf-8')))
+    return re.compile(b''.join(pattern), ignorecase and re.IGNORECASE or 0)
+
+def mmap_search(file, regexp):
+    """Returns an iterator over the lines of 'file' that contain the longest required literal of
+    'regexp', they are found by running a bytes regexp over the memory mapped file, so only these
+    lines are decoded. Returns None if the whole file must be read instead."""
+    import codecs, locale, mmap
+    if codecs.lookup(locale.getpreferredencoding(False)).name != 'utf-8':
+        return None
+    longest = longest_simple = ''
+    longest_ignorecase = False
+    for literal, ignorecase in regexp_literals(regexp):
+        if ignorecase:
+            # case folding of non ascii chars isn't the same with bytes
+            pieces = re.split(r'[^\x00-\x7f]+', literal)
+            # pieces without letters that need alternatives are a lot faster to search
+            for piece in pieces:
+                for simple in re.split(r'[iks]+', piece, flags=re.IGNORECASE):
+                    if len(simple) > len(longest_simple):
+                        longest_simple = simple
+        else:
+            pieces = [literal]
+        for piece in pieces:
+            if len(piece) > len(longest):
+                longest, longest_ignorecase = piece, ignorecase
+    if not longest:
+        return None
+    if longest_ignorecase and len(longest_simple) >= 3:
+        longest = longest_simple
+    try:
+        file_object = open(file, 'rb')
+    except IOError:
+        return None
+    try:
+        mapping = mmap.mmap(file_object.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        # empty file
+        file_object.close()
+        return None
+    if mapping.find(b'\r') != -1 or not is_utf8(mapping):
+        # text mode translates '\r' newlines, and lines are decoded ignoring invalid bytes so a
+        # literal can match across them, let it do the job
+        mapping.close()
+        file_object.close()
+        return None
+    return mmap_read_lines(file_object, mapping,
+            make_literal_bytes_regexp(longest, longest_ignorecase))
+
+def is_utf8(data, chunk_size=1024 * 1024):
+    """Returns True if 'data' (bytes or a memory map) is valid utf-8."""
+    import codecs
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for start in range(0, len(data), chunk_size):
+            chunk = data[start:start + chunk_size]
+            # ascii chunks are valid, unless they follow an incomplete sequence
+            if not chunk.isascii() or decoder.getstate()[0]:
+                decoder.decode(chunk)
+        decoder.decode(b'', True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+def mmap_read_lines(file_object, mapping, literal_regexp):
+    """Yields the lines of 'mapping' where 'literal_regexp' matches."""
+    search = literal_regexp.search
+    find = mapping.find
+    rfind = mapping.rfind
+    with file_object, mapping:
+        position = 0
+        while True:
+            match = search(mapping, position)
+            if not match:
+                break
+            start = rfind(b'\n', 0, match.start()) + 1
+            position = find(b'\n', match.start()) + 1 or len(mapping)
+            yield mapping[start:position].decode('utf-8', 'ignore')
+
+### Log index ###
+# The index is a SQLite database that maps every trigram (3 consecutive bytes, ascii lowercased)
+# found in a log, once decoded like grep reads it (so invalid bytes are ignored), to the list of blocks of the log containing it. Blocks are about
+# INDEX_BLOCK_SIZE bytes and always end at a line boundary, so a search only needs to read the
+# blocks that contain all the trigrams of the literal parts of the regexp. The index is updated
+# incrementally, only the data appended to a log since the last update is indexed, and only by
+# child processes: searches made in WeeChat's process only read it, for never waiting on a lock.
+INDEX_VERSION = 3 # bump when the schema changes, older indexes are dropped
+INDEX_BLOCK_SIZE = 128 * 1024
+INDEX_HEAD_SIZE = 256 # bytes kept for detecting logs that were replaced
+INDEX_FLUSH_BLOCKS = 64 # blocks indexed in memory before merging them in the database
+# these ascii letters are matched by non ascii chars when ignoring case (like 'K' and KELVIN SIGN)
+index_unsafe_ignorecase = frozenset(b'iks')
+
+def get_index_file():
+    """Returns index's path or '' if the index is disabled."""
+    if not get_config_boolean('index'):
+        return ''
+    return weechat.string_eval_path_home(weechat.config_get_plugin('index_file'),
+            {}, {}, {'directory': 'data'})
+
+def index_connect(index_file, timeout=60, readonly=False):
+    """Opens the index, a read only connection fails if there's no index instead of creating it.
+    Raises sqlite3.Error if the index is locked for longer than 'timeout' seconds."""
+    import sqlite3
+    if readonly:
+        try:
+            from urllib.request import pathname2url
+        except ImportError:
+            from urllib import pathname2url
+        db = sqlite3.connect('file:%s?mode=ro' % pathname2url(index_file), timeout=timeout,
+                uri=True)
+        if db.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+            db.close()
+            raise sqlite3.DatabaseError('index must be rebuilt')
+        return db
+    db = sqlite3.connect(index_file, timeout=timeout)
+    if db.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+        # made by an older version or new
+        db.executescript("""
+            BEGIN IMMEDIATE;
+            DROP TABLE IF EXISTS postings;
+            DROP TABLE IF EXISTS blocks;
+            DROP TABLE IF EXISTS logs;
+            CREATE TABLE logs (id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, head BLOB);
+            CREATE TABLE blocks (log INTEGER, block INTEGER, offset INTEGER,
+                PRIMARY KEY (log, block));
+            CREATE TABLE postings (log INTEGER, trigram INTEGER, chunk INTEGER, blocks BLOB,
+                PRIMARY KEY (log, trigram, chunk));
+            PRAGMA user_version = %d;
+            COMMIT;
+        """ % INDEX_VERSION)
+    return db
+
+def index_delete(db, log_id):
+    for table, column in (('postings', 'log'), ('blocks', 'log'), ('logs', 'id')):
+        db.execute('DELETE FROM %s WHERE %s = ?' %(table, column), (log_id, ))
+
+def index_trigrams(data, encoding):
+    """Returns the set of trigrams in 'data' (bytes) as integers. Lines are decoded ignoring
+    errors when searched, so bytes that can't be decoded must not split the trigrams around
+    them: 'fo\\xffo' has the trigram 'foo'."""
+    if not data.isascii():
+        data = data.decode(encoding, 'ignore').encode(encoding, 'ignore')
+    data = data.lower()
+    return set(a << 16 | b << 8 | c for a, b, c in set(zip(data, data[1:], data[2:])))
+
+def index_flush(db, log_id, chunk, postings):
+    """Adds 'postings' (trigram -> list of new block ids) to the database, as rows of 'chunk' (the
+    first of the new blocks), so the blocks indexed before aren't read and written again."""
+    from array import array
+    db.executemany('INSERT OR REPLACE INTO postings VALUES (?, ?, ?, ?)',
+            [ (log_id, trigram, chunk, array('I', blocks).tobytes())
+                for trigram, blocks in postings.items() ])
+    postings.clear()
+
+def index_lookup(db, log):
+    """Returns log's id and indexed size if the indexed data is still the start of 'log', None
+    otherwise. Nothing is indexed, the data appended since the last update isn't narrowed."""
+    row = db.execute('SELECT id, size, head FROM logs WHERE path = ?', (log, )).fetchone()
+    if not row:
+        return None
+    log_id, indexed_size, indexed_head = row
+    try:
+        with open(log, 'rb') as file_object:
+            head = file_object.read(len(indexed_head))
+            size = os.fstat(file_object.fileno()).st_size
+    except (IOError, OSError):
+        return None
+    if indexed_size > size or head != bytes(indexed_head):
+        return None
+    return log_id, indexed_size
+
+def index_update(db, log):
+    """Indexes the data appended to 'log' since the last update, the index is rebuilt if the log
+    was truncated or replaced. Returns log's id and the indexed size, or None if the log can't be
+    read."""
+    import locale
+    encoding = locale.getpreferredencoding(False)
+    try:
+        file_object = open(log, 'rb')
+    except IOError:
+        return None
+    with file_object:
+        head = file_object.read(INDEX_HEAD_SIZE)
+        size = os.fstat(file_object.fileno()).st_size
+        row = db.execute('SELECT id, size, head FROM logs WHERE path = ?', (log, )).fetchone()
+        if row:
+            log_id, indexed_size, indexed_head = row
+            if indexed_size > size or head[:len(indexed_head)] != bytes(indexed_head):
+                # not the same log we indexed before
+                index_delete(db, log_id)
+                row = None
+        if not row:
+            log_id = db.execute('INSERT INTO logs (path, size, head) VALUES (?, 0, ?)',
+                    (log, b'')).lastrowid
+            indexed_size = 0
+        if indexed_size == size:
+            db.commit()
+            return log_id, indexed_size
+
+        block = chunk = db.execute('SELECT COUNT(*) FROM blocks WHERE log = ?',
+                (log_id, )).fetchone()[0]
+        postings = {}
+        file_object.seek(indexed_size)
+        while True:
+            data = file_object.read(INDEX_BLOCK_SIZE)
+            if not data:
+                break
+            if data[-1:] != b'\n':
+                data += file_object.readline()
+                if data[-1:] != b'\n':
+                    # last line is still being written, it'll be indexed in the next update
+                    data = data[:data.rfind(b'\n') + 1]
+                    if not data:
+                        break
+            db.execute('INSERT INTO blocks VALUES (?, ?, ?)', (log_id, block, indexed_size))
+            for trigram in index_trigrams(data, encoding):
+                postings.setdefault(trigram, []).append(block)
+            block += 1
+            indexed_size += len(data)
+            if block % INDEX_FLUSH_BLOCKS == 0:
+                index_flush(db, log_id, chunk, postings)
+                chunk = block
+        index_flush(db, log_id, chunk, postings)
+        db.execute('UPDATE logs SET size = ?, head = ? WHERE id = ?',
+                (indexed_size, head[:indexed_size], log_id))
+        db.commit()
+    return log_id, indexed_size
+
+def regexp_trigrams(regexp, encoding):
+    """Returns the trigrams that a line must contain for matching 'regexp'."""
+    trigrams = set()
+    for literal, ignorecase in regexp_literals(regexp):
+        try:
+            data = literal.encode(encoding)
+        except (UnicodeError, LookupError):
+            continue
+        for trigram in zip(data, data[1:], data[2:]):
+            if b'\r' in bytes(trigram) or b'\n' in bytes(trigram):
+                # lost when newlines are translated
+                continue
+            trigram = bytes(trigram).lower()
+            if ignorecase and (max(trigram) > 127 or index_unsafe_ignorecase.intersection(trigram)):
+                continue
+            trigrams.add(int.from_bytes(trigram, 'big'))
+    return trigrams
+
+def index_search(index_file, log, regexp, update=True):
+    """Updates log's index and returns an iterator over the lines of the blocks that may match
+    'regexp', returns None if the index can't narrow the search. Without 'update' the index is
+    only read, and not waited for if it's locked."""
+    import locale
+    from array import array
+    encoding = locale.getpreferredencoding(False)
+    trigrams = regexp_trigrams(regexp, encoding)
+    if not trigrams:
+        return None
+    try:
+        if update:
+            db = index_connect(index_file)
+        else:
+            db = index_connect(index_file, timeout=0, readonly=True)
+    except Exception:
+        return None
+    try:
+        if update:
+            indexed = index_update(db, log)
+        else:
+            indexed = index_lookup(db, log)
+        if indexed is None:
+            return None
+        log_id, indexed_size = indexed
+        select = 'SELECT blocks FROM postings WHERE log = ? AND trigram = ?'
+        candidates = None
+        for trigram in trigrams:
+            blocks = set()
+            for row in db.execute(select, (log_id, trigram)):
+                blocks.update(array('I', row[0]))
+            if candidates is None:
+                candidates = blocks
+            else:
+                candidates &= blocks
+            if not candidates:
+                break
+        offsets = [ offset for offset, in db.execute(
+                'SELECT offset FROM blocks WHERE log = ? ORDER BY block', (log_id, )) ]
+    except Exception:
+        return None
+    finally:
+        db.close()
+
+    offsets.append(indexed_size)
+    ranges = [ (offsets[block], offsets[block + 1]) for block in sorted(candidates) ]
+    # data not indexed yet (an incomplete last line) is always searched
+    ranges.append((indexed_size, None))
+    return index_read_lines(log, ranges, encoding)
+
+def index_read_lines(log, ranges, encoding):
+    """Yields the lines of 'log' in the given (start, end) byte ranges."""
+    from io import StringIO
+    try:
+        file_object = open(log, 'rb')
+    except IOError:
+        return
+    with file_object:
+        for start, end in ranges:
+            file_object.seek(start)
+            if end is None:
+                data = file_object.read()
+            else:
+                data = file_object.read(end - start)
+            for line in StringIO(data.decode(encoding, 'ignore'), newline=None):
+                yield line
+
+def index_process(*args):
+    """Rebuilds the index of the logs in 'index_logs', or only updates it if 'index_rebuild' is
+    false."""
+    global index_logs, index_file, index_rebuild
+    try:
+        if index_rebuild and path.isfile(index_file):
+            os.remove(index_file)
+        db = index_connect(index_file)
+        try:
+            size = 0
+            for log in index_logs:
+                indexed = index_update(db, log)
+                if indexed:
+                    size += indexed[1]
+            if not index_rebuild:
+                index_prune(db)
+        finally:
+            db.close()
+    except Exception as e:
+        return pickle.dumps(e, 0)
+    return pickle.dumps((len(index_logs), size), 0)
+
+def index_prune(db):
+    """Removes the entries of logs that no longer exist."""
+    for log_id, log in db.execute('SELECT id, path FROM logs').fetchall():
+        if not path.isfile(log):
+            index_delete(db, log_id)
+    db.commit()
+
+def index_process_cb(data, command, return_code, out, err):
+    global index_stdout, hook_index
+    if isinstance(out, str):
+        out = out.encode()
+    index_stdout += out
+    if return_code == weechat.WEECHAT_HOOK_PROCESS_ERROR:
+        hook_index = None
+        if data == 'rebuild':
+            error('Index rebuild timed out')
+    elif return_code >= 0:
+        hook_index = None
+        if data != 'rebuild':
+            # updates after searches are silent, the next one will retry
+            return WEECHAT_RC_OK
+        try:
+            result = pickle.loads(index_stdout)
+            if isinstance(result, Exception):
+                raise result
+        except Exception as e:
+            error('Index rebuild failed, %r' % e)
+        else:
+            print_line('Index rebuilt: %s logs, %s indexed.' %(result[0],
+                human_readable_size(result[1])), display=True)
+    return WEECHAT_RC_OK
+
+def index_update_background(logs):
+    """Updates the index of 'logs' in a child process, unless the index is already being updated
+    or rebuilt."""
+    global index_file, index_logs, index_rebuild, index_stdout, hook_index
+    if hook_index:
+        return
+    index_file = get_index_file()
+    if not index_file:
+        return
+    index_logs = logs
+    index_rebuild = False
+    index_stdout = b''
+    hook_index = weechat.hook_process('func:index_process', 0, 'index_process_cb', '')
+
+def index_verify(index_file, logs):
+    """Checks the index against 'logs', the index is only read. Returns a dict with the number of
+    logs in each state."""
+    status = dict.fromkeys(('up to date', 'outdated', 'invalid', 'not indexed', 'removed'), 0)
+    db = index_connect(index_file, timeout=0, readonly=True)
+    try:
+        indexed_logs = set()
+        for log_id, log, indexed_size, indexed_head in \
+                db.execute('SELECT id, path, size, head FROM logs').fetchall():
+            indexed_logs.add(log)
+            try:
+                file_object = open(log, 'rb')
+            except IOError:
+                status['removed'] += 1
+                continue
+            with file_object:
+                head = file_object.read(len(indexed_head))
+                size = os.fstat(file_object.fileno()).st_size
+            if head != bytes(indexed_head) or size < indexed_size:
+                status['invalid'] += 1
+            elif size > indexed_size:
+                status['outdated'] += 1
+            else:
+                status['up to date'] += 1
+    finally:
+        db.close()
+    status['not indexed'] = len(set(logs) - indexed_logs)
+    return status
+
+def grep_file(file, head, tail, after_context, before_context, count, regexp, hilight, exact, invert,
+        index_file='', index_update=True):
+    """Return a list of lines that match 'regexp' in 'file', if no regexp returns all lines. The
+    index is only read without 'index_update', for searches made in WeeChat's process."""
     if count:
         tail = head = after_context = before_context = False
         hilight = ''
@@ -740,72 +1269,80 @@ def grep_file(file, head, tail, after_context, before_context, count, regexp, hi
     else:
         check = lambda s: check_string(s, regexp, hilight, exact)
 
-    try:
-        file_object = open(file, 'r', errors='ignore')
-    except IOError:
-        # file doesn't exist
-        return lines
+    file_object = None
+    if regexp and not (tail or before_context or after_context or invert):
+        # the index and the memory map only give us the lines where matches can be, so they can't
+        # be used for options that need the lines around matches or the lines that don't match
+        if index_file:
+            file_object = index_search(index_file, file, regexp, index_update)
+        if file_object is None:
+            file_object = mmap_search(file, regexp)
+    if file_object is None:
+        try:
+            file_object = open(file, 'r', errors='ignore')
+        except IOError:
+            # file doesn't exist
+            return lines
     if tail or before_context:
-        # for these options, I need to seek in the file, but is slower and uses a good deal of
-        # memory if the log is too big, so we do this *only* for these options.
-        file_lines = file_object.readlines()
-
         if tail:
             # instead of searching in the whole file and later pick the last few lines, we
-            # reverse the log, search until count reached and reverse it again, that way is a lot
-            # faster
-            file_lines.reverse()
+            # read the log backwards, search until count reached and reverse the result, that way
+            # is a lot faster
+            file_object.close()
+            file_object = reversed_lines(file)
             # don't invert context switches
             before_context, after_context = after_context, before_context
 
         if before_context:
             before_context_range = list(range(1, before_context + 1))
             before_context_range.reverse()
+        # last lines read, for before context
+        previous_lines = deque(maxlen=before_context or 0)
 
         limit = tail or head
 
-        line_idx = 0
-        while line_idx < len(file_lines):
-            line = file_lines[line_idx]
-            line = check(line)
-            if line:
-                if before_context:
-                    separator()
-                    trimmed = False
-                    for id in before_context_range:
-                        try:
-                            context_line = file_lines[line_idx - id]
-                            if check(context_line):
-                                # match in before context, that means we appended these same lines in a
-                                # previous match, so we delete them merging both paragraphs
-                                if not trimmed:
-                                    del lines[id - before_context - 1:]
-                                    trimmed = True
-                            else:
-                                append(context_line)
-                        except IndexError:
-                            pass
-                append(line)
-                count_match(line)
-                if after_context:
-                    id, offset = 0, 0
-                    while id < after_context + offset:
-                        id += 1
-                        try:
-                            context_line = file_lines[line_idx + id]
-                            _context_line = check(context_line)
-                            if _context_line:
-                                offset = id
-                                context_line = _context_line # so match is hilighted with --hilight
-                                count_match()
-                            append(context_line)
-                        except IndexError:
-                            pass
-                    separator()
-                    line_idx += id
-                if limit and lines.matches_count >= limit:
-                    break
-            line_idx += 1
+        for raw_line in file_object:
+            line = check(raw_line)
+            if not line:
+                previous_lines.append(raw_line)
+                continue
+            if before_context:
+                separator()
+                trimmed = False
+                for id in before_context_range:
+                    if id > len(previous_lines):
+                        # start of the log
+                        continue
+                    context_line = previous_lines[-id]
+                    if check(context_line):
+                        # match in before context, that means we appended these same lines in a
+                        # previous match, so we delete them merging both paragraphs
+                        if not trimmed:
+                            del lines[id - before_context - 1:]
+                            trimmed = True
+                    else:
+                        append(context_line)
+            previous_lines.append(raw_line)
+            append(line)
+            count_match(line)
+            if after_context:
+                id, offset = 0, 0
+                while id < after_context + offset:
+                    id += 1
+                    try:
+                        context_line = next(file_object)
+                    except StopIteration:
+                        continue
+                    previous_lines.append(context_line)
+                    _context_line = check(context_line)
+                    if _context_line:
+                        offset = id
+                        context_line = _context_line # so match is hilighted with --hilight
+                        count_match()
+                    append(context_line)
+                separator()
+            if limit and lines.matches_count >= limit:
+                break
 
         if tail:
             lines.reverse()
@@ -991,22 +1528,34 @@ def show_matching_lines():
 
         global grep_options, log_pairs
         grep_options = (head, tail, after_context, before_context,
-                        count, regexp, hilight, exact, invert)
+                        count, regexp, hilight, exact, invert, get_index_file())
 
         log_pairs = [(strip_home(log), log) for log in search_in_files]
 
         if not background:
             # run grep normally
             for log_name, log in log_pairs:
-                matched_lines[log_name] = grep_file(log, *grep_options)
+                matched_lines[log_name] = grep_file(log, *grep_options, index_update=False)
             buffer_update()
+            if grep_options[-1]:
+                index_update_background(search_in_files)
         else:
             global hook_file_grep, grep_stdout, grep_stderr, pattern_tmpl
+            global grep_workers, printed_lines
             grep_stdout = grep_stderr = b''
+            grep_workers = get_config_int('workers')
+            if grep_workers <= 0:
+                grep_workers = os.cpu_count() or 1
+            grep_workers = min(grep_workers, len(log_pairs))
+            printed_lines = None
+            if grep_workers > 1:
+                function, callback = 'grep_process_pool', 'grep_process_pool_cb'
+            else:
+                function, callback = 'grep_process', 'grep_process_cb'
             hook_file_grep = weechat.hook_process(
-                'func:grep_process',
+                'func:%s' % function,
                 get_config_int('timeout_secs') * 1000,
-                'grep_process_cb',
+                callback,
                 ''
             )
             if hook_file_grep:
@@ -1029,6 +1578,91 @@ def grep_process(*args):
 
     return pickle.dumps(result, 0)
 
+def grep_worker(log_pair):
+    """Greps one log in a worker process of the pool."""
+    global grep_options
+    log_name, log = log_pair
+    try:
+        return log_name, grep_file(log, *grep_options)
+    except Exception as e:
+        return log_name, e
+
+def grep_process_pool(*args):
+    """Greps logs in a pool of 'grep_workers' processes. The result of each log is written to
+    stdout as soon as it's ready, framed as '<length>\\n<pickled data>', so grep's buffer can be
+    updated before the whole search is over."""
+    global log_pairs, grep_workers
+    import multiprocessing
+
+    def write(result):
+        data = pickle.dumps(result, 0)
+        data = b'%d\n%s' %(len(data), data)
+        while data:
+            data = data[os.write(1, data):]
+
+    try:
+        # WeeChat's binary can't be used for spawning new interpreters, so we must fork
+        pool = multiprocessing.get_context('fork').Pool(grep_workers)
+        try:
+            # biggest logs first, so no worker is left with a big log at the end
+            log_pairs = sorted(log_pairs, key=lambda pair: get_size(pair[1]), reverse=True)
+            for result in pool.imap_unordered(grep_worker, log_pairs):
+                write(result)
+        finally:
+            pool.terminate()
+    except Exception as e:
+        write(('', e))
+    return ''
+
+def set_buffer_error(message):
+    error(message)
+    grep_buffer = buffer_create()
+    title = weechat.buffer_get_string(grep_buffer, 'title')
+    title = title + ' %serror' % color_title
+    weechat.buffer_set(grep_buffer, 'title', title)
+
+def grep_process_pool_cb(data, command, return_code, out, err):
+    global grep_stdout, grep_stderr, hook_file_grep
+
+    if isinstance(out, str):
+        out = out.encode()
+    grep_stdout += out
+
+    if isinstance(err, str):
+        err = err.encode()
+    grep_stderr += err
+
+    # unpickle the results that arrived complete
+    results = {}
+    while True:
+        header, sep, frame = grep_stdout.partition(b'\n')
+        if not sep or len(frame) < int(header):
+            break
+        try:
+            log_name, lines = pickle.loads(frame[:int(header)])
+        except Exception as e:
+            log_name, lines = '', e
+        grep_stdout = frame[int(header):]
+        if isinstance(lines, Exception):
+            error('Error while searching in %s: %r' %(log_name or 'logs', lines))
+        else:
+            results[log_name] = lines
+    if results:
+        buffer_update_partial(results)
+
+    if return_code == weechat.WEECHAT_HOOK_PROCESS_ERROR:
+        set_buffer_error("Background grep timed out")
+        hook_file_grep = None
+
+    elif return_code >= 0:
+        hook_file_grep = None
+        if grep_stderr:
+            set_buffer_error(grep_stderr)
+        else:
+            buffer_update_end()
+
+    return WEECHAT_RC_OK
+
 def grep_process_cb(data, command, return_code, out, err):
     global grep_stdout, grep_stderr, matched_lines, hook_file_grep
 
@@ -1040,13 +1674,6 @@ def grep_process_cb(data, command, return_code, out, err):
         err = err.encode()
     grep_stderr += err
 
-    def set_buffer_error(message):
-        error(message)
-        grep_buffer = buffer_create()
-        title = weechat.buffer_get_string(grep_buffer, 'title')
-        title = title + ' %serror' % color_title
-        weechat.buffer_set(grep_buffer, 'title', title)
-
     if return_code == weechat.WEECHAT_HOOK_PROCESS_ERROR:
         set_buffer_error("Background grep timed out")
         hook_file_grep = None
@@ -1084,9 +1711,98 @@ def get_grep_file_status():
         ' in grep buffer.' %(log, elapsed)
 
 ### Grep buffer ###
+def make_summary(log, lines):
+    """Returns the summary line of 'lines' matched in 'log'."""
+    global pattern_tmpl, count, invert
+    if count:
+        note = ' (not shown)'
+    elif lines.stripped_lines:
+        if lines:
+            note = ' (last %s lines shown)' %len(lines)
+        else:
+            note = ' (not shown)'
+    else:
+        note = ''
+    return '%s matches "%s%s%s"%s in %s%s%s%s' \
+            %(lines.matches_count, color_summary, pattern_tmpl, color_info,
+              invert and ' (inverted)' or '',
+              color_summary, log, color_reset, note)
+
+def format_line(s):
+    global nick_dict, weechat_format, hilight
+    if hilight:
+        # we don't want colors if there's match highlighting
+        return '%s %s %s' %split_line(s)
+    date, nick, msg = split_line(s)
+    if weechat_format:
+        try:
+            nick = nick_dict[nick]
+        except KeyError:
+            # cache nick
+            nick_c = color_nick(nick)
+            nick_dict[nick] = nick_c
+            nick = nick_c
+        return '%s%s %s%s %s' %(color_date, date, nick, color_reset, msg)
+    else:
+        #no formatting
+        return msg
+
+def print_header(buffer, logs):
+    global pattern_tmpl, invert
+    prnt(buffer, '\n')
+    print_line('Search for "%s%s%s"%s in %s%s%s.' %(color_summary, pattern_tmpl, color_info,
+        invert and ' (inverted)' or '', color_summary, logs, color_reset),
+            buffer)
+
+def print_log_lines(buffer, log, lines):
+    """Prints the lines matched in 'log' and its summary."""
+    global count, exact, weechat_format
+    if lines.matches_count:
+        # matched lines
+        if not count:
+            # print lines
+            weechat_format = True
+            if exact:
+                lines.onlyUniq()
+            for line in lines:
+                #debug(repr(line))
+                if line == linesList._sep:
+                    # separator
+                    prnt(buffer, context_sep)
+                else:
+                    if '\x00' in line:
+                        # log was corrupted
+                        error("Found garbage in log '%s', maybe it's corrupted" %log)
+                        line = line.replace('\x00', '')
+                    prnt_date_tags(buffer, 0, 'no_highlight', format_line(line))
+
+        # summary
+        if count or get_config_boolean('show_summary'):
+            summary = make_summary(log, lines)
+            print_line(summary, buffer)
+
+    # separator
+    if not count and lines:
+        prnt(buffer, '\n')
+
+def set_title(buffer, time_grep, note=''):
+    """Sets grep buffer's title with the search stats."""
+    global pattern_tmpl, matched_lines, invert, time_start
+    time_end = now()
+    # total time
+    time_total = time_end - time_start
+    # percent of the total time used for grepping
+    time_grep_pct = (time_grep - time_start)/time_total*100
+    #debug('time: %.4f seconds (%.2f%%)' %(time_total, time_grep_pct))
+    title = "'q': close buffer | Search in %s%s%s %s matches%s | pattern \"%s%s%s\"%s %s | %.4f seconds (%.2f%%)" \
+            %(color_title, matched_lines, color_reset, matched_lines.get_matches_count(), note,
+              color_title, pattern_tmpl, color_reset, invert and ' (inverted)' or '', format_options(),
+              time_total, time_grep_pct)
+    weechat.buffer_set(buffer, 'title', title)
+
 def buffer_update():
     """Updates our buffer with new lines."""
-    global pattern_tmpl, matched_lines, pattern, count, hilight, invert, exact
+    global matched_lines, count
     time_grep = now()
 
     buffer = buffer_create()
@@ -1098,50 +1814,7 @@ def buffer_update():
     if not count and len_total_lines > max_lines:
         weechat.buffer_clear(buffer)
 
-    def _make_summary(log, lines, note):
-        return '%s matches "%s%s%s"%s in %s%s%s%s' \
-                %(lines.matches_count, color_summary, pattern_tmpl, color_info,
-                  invert and ' (inverted)' or '',
-                  color_summary, log, color_reset, note)
-
-    if count:
-        make_summary = lambda log, lines : _make_summary(log, lines, ' (not shown)')
-    else:
-        def make_summary(log, lines):
-            if lines.stripped_lines:
-                if lines:
-                    note = ' (last %s lines shown)' %len(lines)
-                else:
-                    note = ' (not shown)'
-            else:
-                note = ''
-            return _make_summary(log, lines, note)
-
-    global weechat_format
-    if hilight:
-        # we don't want colors if there's match highlighting
-        format_line = lambda s : '%s %s %s' %split_line(s)
-    else:
-        def format_line(s):
-            global nick_dict, weechat_format
-            date, nick, msg = split_line(s)
-            if weechat_format:
-                try:
-                    nick = nick_dict[nick]
-                except KeyError:
-                    # cache nick
-                    nick_c = color_nick(nick)
-                    nick_dict[nick] = nick_c
-                    nick = nick_c
-                return '%s%s %s%s %s' %(color_date, date, nick, color_reset, msg)
-            else:
-                #no formatting
-                return msg
-
-    prnt(buffer, '\n')
-    print_line('Search for "%s%s%s"%s in %s%s%s.' %(color_summary, pattern_tmpl, color_info,
-        invert and ' (inverted)' or '', color_summary, matched_lines, color_reset),
-            buffer)
+    print_header(buffer, matched_lines)
     # print last <max_lines> lines
     if matched_lines.get_matches_count():
         if count:
@@ -1152,53 +1825,16 @@ def buffer_update():
 
         matched_lines.get_last_lines(max_lines)
         for log, lines in matched_lines_items:
-            if lines.matches_count:
-                # matched lines
-                if not count:
-                    # print lines
-                    weechat_format = True
-                    if exact:
-                        lines.onlyUniq()
-                    for line in lines:
-                        #debug(repr(line))
-                        if line == linesList._sep:
-                            # separator
-                            prnt(buffer, context_sep)
-                        else:
-                            if '\x00' in line:
-                                # log was corrupted
-                                error("Found garbage in log '%s', maybe it's corrupted" %log)
-                                line = line.replace('\x00', '')
-                            prnt_date_tags(buffer, 0, 'no_highlight', format_line(line))
-
-                # summary
-                if count or get_config_boolean('show_summary'):
-                    summary = make_summary(log, lines)
-                    print_line(summary, buffer)
-
-            # separator
-            if not count and lines:
-                prnt(buffer, '\n')
+            print_log_lines(buffer, log, lines)
     else:
         print_line('No matches found.', buffer)
 
     # set title
-    global time_start
-    time_end = now()
-    # total time
-    time_total = time_end - time_start
-    # percent of the total time used for grepping
-    time_grep_pct = (time_grep - time_start)/time_total*100
-    #debug('time: %.4f seconds (%.2f%%)' %(time_total, time_grep_pct))
     if not count and len_total_lines > max_lines:
         note = ' (last %s lines shown)' %len(matched_lines)
     else:
         note = ''
-    title = "'q': close buffer | Search in %s%s%s %s matches%s | pattern \"%s%s%s\"%s %s | %.4f seconds (%.2f%%)" \
-            %(color_title, matched_lines, color_reset, matched_lines.get_matches_count(), note,
-              color_title, pattern_tmpl, color_reset, invert and ' (inverted)' or '', format_options(),
-              time_total, time_grep_pct)
-    weechat.buffer_set(buffer, 'title', title)
+    set_title(buffer, time_grep, note)
 
     if get_config_boolean('go_to_buffer'):
         weechat.buffer_set(buffer, 'display', '1')
@@ -1206,6 +1842,62 @@ def buffer_update():
     # free matched_lines so it can be removed from memory
     del matched_lines
 
+def buffer_update_partial(results):
+    """Prints the results of the logs that were just grepped, used when logs are grepped by a pool
+    of processes. The first call prints the search header."""
+    global matched_lines, count, printed_lines, search_in_files
+    buffer = buffer_create()
+    if printed_lines is None:
+        # first results
+        if get_config_boolean('clear_buffer'):
+            weechat.buffer_clear(buffer)
+        printed_lines = 0
+        print_header(buffer, '%s logs' %len(search_in_files))
+        if get_config_boolean('go_to_buffer'):
+            weechat.buffer_set(buffer, 'display', '1')
+
+    max_lines = get_config_int('max_lines')
+    if count:
+        results = sorted(results.items(), key=lambda i: i[1].matches_count)
+    else:
+        results = sorted(results.items(), key=lambda i: len(i[1]))
+    for log, lines in results:
+        lines.strip_separator()
+        if not count:
+            # lines beyond <max_lines> for the whole search aren't shown
+            shown = max(max_lines - printed_lines, 0)
+            if len(lines) > shown:
+                lines.stripped_lines = len(lines) - shown
+                del lines[:lines.stripped_lines]
+            printed_lines += len(lines)
+        matched_lines[log] = lines
+        print_log_lines(buffer, log, lines)
+    set_title(buffer, now(), ' (searching %s/%s logs)' %(dict.__len__(matched_lines),
+        len(search_in_files)))
+
+def buffer_update_end():
+    """Prints the end of a search made by a pool of processes."""
+    global matched_lines, printed_lines
+    time_grep = now()
+    buffer = buffer_create()
+    if printed_lines is None:
+        # no log was grepped
+        buffer_update()
+        return
+    if matched_lines.get_matches_count():
+        print_line('%s matches in %s logs.' %(matched_lines.get_matches_count(),
+            dict.__len__(matched_lines)), buffer)
+    else:
+        print_line('No matches found.', buffer)
+    if not count and sum([ L.stripped_lines for L in matched_lines.values() ]):
+        note = ' (last %s lines shown)' %len(matched_lines)
+    else:
+        note = ''
+    set_title(buffer, time_grep, note)
+
+    # free matched_lines so it can be removed from memory
+    del matched_lines
+
 def split_line(s):
     """Splits log's line 's' in 3 parts, date, nick and msg."""
     global weechat_format
@@ -1459,6 +2151,43 @@ def cmd_grep_stop(buffer, args):
             say(get_grep_file_status(), buffer)
         raise Exception
 
+hook_index = None
+index_rebuild = False
+def cmd_grep_index(buffer, action):
+    """Rebuilds or verifies the index of the logs."""
+    global home_dir, index_file, index_logs, index_stdout, hook_index, index_rebuild
+    index_file = get_index_file()
+    if not index_file:
+        error("Index is disabled, enable it with: /set plugins.var.python.%s.index on" %SCRIPT_NAME)
+        return
+    index_logs = dir_list(home_dir)
+    if action == 'rebuild':
+        if hook_index:
+            if index_rebuild:
+                error('Index is already being rebuilt.')
+                return
+            # an update after a search, the rebuild replaces it
+            weechat.unhook(hook_index)
+        index_stdout = b''
+        index_rebuild = True
+        # no timeout, indexing big log directories can take a while
+        hook_index = weechat.hook_process('func:index_process', 0, 'index_process_cb', 'rebuild')
+        if hook_index:
+            print_line('Rebuilding index of %s logs (%s) in %s...' %(len(index_logs),
+                human_readable_size(sum(map(get_size, index_logs))), index_file), display=True)
+    else:
+        try:
+            status = index_verify(index_file, index_logs)
+        except Exception as e:
+            error('Index verification failed, %r' % e)
+            return
+        print_line('Index %s: %s' %(index_file, ', '.join([ '%s %s' %(status[key], key)
+            for key in ('up to date', 'outdated', 'invalid', 'not indexed', 'removed') ])),
+            display=True)
+        if status['invalid'] or status['removed']:
+            print_line('Invalid and removed entries will be updated after the next search, or use'
+                    ' "/grep index rebuild".')
+
 def cmd_grep(data, buffer, args):
     """Search in buffers and logs."""
     global pattern, matchcase, head, tail, number, count, exact, hilight
@@ -1472,6 +2201,10 @@ def cmd_grep(data, buffer, args):
         return WEECHAT_RC_OK
 
     cmd_init()
+    if args.split() in (['index', 'rebuild'], ['index', 'verify']):
+        cmd_grep_index(buffer, args.split()[1])
+        return WEECHAT_RC_OK
+
     global log_name, buffer_name, only_buffers, all
     log_name = buffer_name = ''
     only_buffers = all = False
@@ -1665,7 +2398,7 @@ if __name__ == '__main__' and import_ok and \
 
 
     weechat.hook_command(SCRIPT_COMMAND, cmd_grep.__doc__,
-            "[log <file> | buffer <name> | stop] [-a|--all] [-b|--buffer] [-c|--count] [-m|--matchcase] "
+            "[log <file> | buffer <name> | stop | index rebuild|verify] [-a|--all] [-b|--buffer] [-c|--count] [-m|--matchcase] "
             "[-H|--hilight] [-o|--only-match] [-i|-v|--invert] [(-h|--head)|(-t|--tail) [-n|--number <n>]] "
             "[-A|--after-context <n>] [-B|--before-context <n>] [-C|--context <n> ] <expression>",
 # help
@@ -1675,6 +2408,8 @@ if __name__ == '__main__' and import_ok and \
   buffer <name>: Search in buffer <name>, if there's no buffer with <name> it will
                  try to search for a log file.
            stop: Stops a currently running search.
+  index rebuild: Rebuild the index of all logs in background (needs option 'index' on).
+   index verify: Check which logs are indexed and up to date.
        -a --all: Search in all open buffers.
                  If used with 'log <file>' search in all logs that matches <file>.
     -b --buffer: Search only in buffers, not in file logs.
@@ -1716,6 +2451,7 @@ Examples:
             "buffer %(buffers_names) %(grep_arguments)|%*"
             "||log %(grep_log_files) %(grep_arguments)|%*"
             "||stop"
+            "||index rebuild|verify"
             "||%(grep_arguments)|%*",
             'cmd_grep' ,'')
     weechat.hook_command('logs', cmd_logs.__doc__, "[-s|--size] [<filter>]",
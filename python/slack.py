@@ -5,11 +5,12 @@
 
 from __future__ import print_function, unicode_literals
 
-from collections import OrderedDict, namedtuple
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque, namedtuple
 from datetime import date, datetime, timedelta
 from functools import partial, wraps
 from io import StringIO
-from itertools import chain, count, islice
+from itertools import chain, count
 
 import copy
 import errno
@@ -25,6 +26,8 @@ import ssl
 import random
 import socket
 import string
+import threading
+import zlib
 
 # Prevent websocket from using numpy (it's an optional dependency). We do this
 # because numpy causes python (and thus weechat) to crash when it's reloaded.
@@ -50,18 +53,39 @@ try:
         Iterable,
         KeysView,
         Mapping,
+        MutableMapping,
         Reversible,
         ValuesView,
     )
 except ImportError:
-    from collections import ItemsView, Iterable, KeysView, Mapping, ValuesView
+    from collections import (
+        ItemsView,
+        Iterable,
+        KeysView,
+        Mapping,
+        MutableMapping,
+        ValuesView,
+    )
 
     Reversible = object
 
 try:
-    from urllib.parse import quote, unquote, urlencode
+    from urllib.parse import quote, unquote, urlencode, urlparse
 except ImportError:
     from urllib import quote, unquote, urlencode
+    from urlparse import urlparse
+
+try:
+    import http.client as http_client
+    from queue import Queue
+except ImportError:
+    import httplib as http_client
+    from Queue import Queue
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
 
 try:
     JSONDecodeError = json.JSONDecodeError
@@ -76,7 +100,7 @@ except ImportError:
 
 SCRIPT_NAME = "slack"
 SCRIPT_AUTHOR = "Trygve Aaberge <trygveaa@gmail.com>"
-SCRIPT_VERSION = "2.11.0"
+SCRIPT_VERSION = "2.11.8"
 SCRIPT_LICENSE = "MIT"
 SCRIPT_DESC = "Extends WeeChat for typing notification/search/etc on slack.com"
 REPO_URL = "https://github.com/wee-slack/wee-slack"
@@ -85,6 +109,9 @@ TYPING_DURATION = 6
 
 RECORD_DIR = "/tmp/weeslack-debug"
 
+# Set of the users, channels and subteams resolved while rendering a message
+render_dependencies = None
+
 SLACK_API_TRANSLATOR = {
     "channel": {
         "history": "conversations.history",
@@ -510,9 +537,13 @@ class EventRouter(object):
         It has a recorder that, when enabled, logs most events
         to the location specified in RECORD_DIR.
         """
-        self.queue = []
-        self.slow_queue = []
+        self.queue = deque()
+        self.slow_queue = deque()
         self.slow_queue_timer = 0
+        self.queue_max_length = 0
+        self.handler_stats = {}
+        self.hashed_messages_to_change = []
+        self.http_workers = {}
         self.teams = {}
         self.subteams = {}
         self.context = {}
@@ -820,10 +851,38 @@ class EventRouter(object):
             dbg("from slow queue", 0)
             self.queue.append(self.slow_queue.pop())
             self.slow_queue_timer = time.time()
-        if len(self.queue) > 0:
-            j = self.queue.pop(0)
+        queue_length = len(self.queue)
+        if queue_length > self.queue_max_length:
+            self.queue_max_length = queue_length
+        # Process as many events as fit in the time budget, so bursts of
+        # events (e.g. on reconnect) don't take one timer tick each
+        deadline = time.time() + config.event_processing_time / 1000.0
+        while self.queue:
+            self.handle_event(self.queue.popleft())
+            if time.time() >= deadline:
+                break
+        self.change_messages_with_new_hash()
+
+    def change_messages_with_new_hash(self):
+        """
+        Updates the messages which got a longer hash because of a collision
+        with a new hash. This is done once per batch of events, so a message
+        colliding several times (e.g. when loading history) is changed once.
+        """
+        while self.hashed_messages_to_change:
+            self.hashed_messages_to_change.pop().change_messages()
+
+    def handle_event(self, j):
+        """
+        Handles one event from the queue: routes it to its callback or
+        handler and records how long the handler took.
+        """
+        start = time.time()
+        handler_name = "unknown"
+        try:
             # Reply is a special case of a json reply from websocket.
             if isinstance(j, SlackRequest):
+                handler_name = "slack_api_request"
                 if j.should_try():
                     if j.retry_ready():
                         local_process_async_slack_api_request(j, self)
@@ -876,18 +935,52 @@ class EventRouter(object):
 
                 dbg("running {}".format(function_name))
                 if callable(callback):
+                    handler_name = getattr(callback, "__name__", function_name)
                     callback(j, self, team, channel, metadata)
                 elif (
                     function_name.startswith("local_")
                     and function_name in self.local_proc
                 ):
+                    handler_name = "local_process_" + function_name
                     self.local_proc[function_name](j, self, team, channel, metadata)
                 elif function_name in self.proc:
+                    handler_name = "process_" + function_name
                     self.proc[function_name](j, self, team, channel, metadata)
                 elif function_name in self.handlers:
+                    handler_name = "handle_" + function_name
                     self.handlers[function_name](j, self, team, channel, metadata)
                 else:
                     dbg("Callback not implemented for event: {}".format(function_name))
+        finally:
+            self.record_handler_time(handler_name, time.time() - start)
+
+    def record_handler_time(self, handler_name, elapsed):
+        stats = self.handler_stats.get(handler_name)
+        if stats is None:
+            stats = self.handler_stats[handler_name] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += elapsed
+        if elapsed > stats[2]:
+            stats[2] = elapsed
+
+    def reset_stats(self):
+        self.queue_max_length = len(self.queue)
+        self.handler_stats = {}
+
+    def format_handler_stats(self):
+        stats = sorted(
+            self.handler_stats.items(), key=lambda item: item[1][1], reverse=True
+        )
+        return [
+            "  {}: {} events, {:.1f} ms total, {:.2f} ms avg, {:.1f} ms max".format(
+                handler_name,
+                events,
+                total_time * 1000,
+                total_time * 1000 / events,
+                max_time * 1000,
+            )
+            for handler_name, (events, total_time, max_time) in stats
+        ]
 
 
 def handle_next(data, remaining_calls):
@@ -970,6 +1063,13 @@ def local_process_async_slack_api_request(request, event_router):
         options = request.options()
         options["header"] = "1"
         context = event_router.store_context(request)
+        if (
+            config.http_connection_pool
+            and request.team
+            and not ProxyWrapper().has_proxy
+        ):
+            send_request_to_http_worker(request, context, event_router)
+            return
         w.hook_process_hashtable(
             weechat_request,
             options,
@@ -979,6 +1079,174 @@ def local_process_async_slack_api_request(request, event_router):
         )
 
 
+def send_request_to_http_worker(request, context, event_router):
+    """
+    Sends an API request to the HTTP worker process of the team, which is
+    started if needed. The worker keeps its connections to Slack alive, so
+    only the first requests have to do a TLS handshake.
+    """
+    team_hash = request.team.team_hash
+    worker = event_router.http_workers.get(team_hash)
+    if worker is None:
+        hook = w.hook_process_hashtable(
+            "func:slack_http_worker",
+            {"stdin": "1", "buffer_flush": "1"},
+            0,
+            "slack_http_worker_cb",
+            team_hash,
+        )
+        worker = {"hook": hook, "output": "", "pending": set()}
+        event_router.http_workers[team_hash] = worker
+
+    options = request.options()
+    headers = {"User-Agent": options["useragent"]}
+    name, value = options["httpheader"].split(": ", 1)
+    headers[name] = value
+    if options["cookie"]:
+        headers["Cookie"] = options["cookie"]
+    request_json = {
+        "id": context,
+        "url": request.request_string(),
+        "headers": headers,
+        "timeout": config.slack_timeout / 1000.0,
+    }
+    worker["pending"].add(context)
+    w.hook_set(worker["hook"], "stdin", json.dumps(request_json) + "\n")
+
+
+@utf8_decode
+def slack_http_worker_cb(team_hash, command, return_code, out, err):
+    worker = EVENTROUTER.http_workers.get(team_hash)
+    if worker is None:
+        return w.WEECHAT_RC_OK
+
+    lines = (worker["output"] + out).split("\n")
+    worker["output"] = lines.pop()
+    for line in lines:
+        if line:
+            response = json.loads(line)
+            worker["pending"].discard(response["id"])
+            EVENTROUTER.receive_httprequest_callback(
+                response["id"],
+                command,
+                response["return_code"],
+                response.get("out", ""),
+                response.get("err", ""),
+            )
+
+    if return_code != w.WEECHAT_HOOK_PROCESS_RUNNING:
+        # The worker has exited, the requests without response are retried
+        del EVENTROUTER.http_workers[team_hash]
+        for context in worker["pending"]:
+            EVENTROUTER.receive_httprequest_callback(
+                context,
+                command,
+                return_code if return_code > 0 else w.WEECHAT_HOOK_PROCESS_ERROR,
+                "",
+                "HTTP worker exited: {}".format(err),
+            )
+    return w.WEECHAT_RC_OK
+
+
+def stop_http_workers():
+    for worker in EVENTROUTER.http_workers.values():
+        w.unhook(worker["hook"])
+    EVENTROUTER.http_workers = {}
+
+
+def slack_http_worker(data):
+    """
+    Runs in a process forked by WeeChat. Reads requests as JSON lines on
+    stdin and runs them in http_connection_pool_size threads, each keeping
+    its connections alive. Responses are written as JSON lines on stdout,
+    with the headers in the same format as the output of url: processes.
+    """
+    requests = Queue()
+    output_lock = threading.Lock()
+
+    def write_response(response):
+        line = (json.dumps(response) + "\n").encode("utf-8")
+        with output_lock:
+            while line:
+                line = line[os.write(1, line) :]
+
+    def run_requests():
+        connections = {}
+        while True:
+            request = requests.get()
+            if request is None:
+                return
+            response = {"id": request["id"], "return_code": 0}
+            try:
+                response["out"] = http_worker_request(connections, request)
+            except Exception as e:
+                response["return_code"] = w.WEECHAT_HOOK_PROCESS_ERROR
+                response["err"] = "{}: {}".format(type(e).__name__, e)
+            write_response(response)
+
+    threads = [
+        threading.Thread(target=run_requests)
+        for _ in range(max(1, config.http_connection_pool_size))
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    data_read = b""
+    while True:
+        chunk = os.read(0, 65536)
+        if not chunk:
+            break
+        lines = (data_read + chunk).split(b"\n")
+        data_read = lines.pop()
+        for line in lines:
+            if line:
+                requests.put(json.loads(line.decode("utf-8")))
+
+    for thread in threads:
+        requests.put(None)
+    for thread in threads:
+        thread.join()
+    return ""
+
+
+def http_worker_request(connections, request):
+    url = urlparse(request["url"])
+    path = "{}?{}".format(url.path, url.query) if url.query else url.path
+    while True:
+        connection = connections.pop(url.netloc, None)
+        reused = connection is not None
+        if not reused:
+            ssl_context = ssl.create_default_context(
+                cafile=sslopt_ca_certs.get("ca_certs")
+            )
+            connection = http_client.HTTPSConnection(
+                url.netloc, timeout=request["timeout"], context=ssl_context
+            )
+        try:
+            connection.request("GET", path, headers=request["headers"])
+            response = connection.getresponse()
+            body = response.read()
+            break
+        except (http_client.HTTPException, socket.error):
+            connection.close()
+            # A kept alive connection may have been closed by the server, so
+            # retry once with a new connection
+            if not reused:
+                raise
+
+    if response.will_close:
+        connection.close()
+    else:
+        connections[url.netloc] = connection
+    headers = "".join(
+        "{}: {}\r\n".format(name, value) for name, value in response.getheaders()
+    )
+    return "HTTP/1.1 {} {}\r\n{}\r\n{}".format(
+        response.status, response.reason, headers, body.decode("utf-8")
+    )
+
+
 ###### New Callbacks
 
 
@@ -1188,7 +1456,7 @@ def typing_bar_item_cb(data, item, current_window, current_buffer, extra_info):
     # here is where we notify you that someone is typing in DM
     # regardless of which buffer you are in currently
     for team in EVENTROUTER.teams.values():
-        for channel in team.channels.values():
+        for channel in team.channels.created_values():
             if channel.type == "im":
                 if channel.is_someone_typing():
                     typers.append("D/" + channel.name)
@@ -1234,8 +1502,9 @@ def channel_completion_cb(data, completion_item, current_buffer, completion):
         for team in EVENTROUTER.teams.values()
         if not current_channel or team != current_channel.team
     ]
+    # Channels which aren't created yet are not active, so they are skipped
     for team in other_teams:
-        for channel in team.channels.values():
+        for channel in team.channels.created_values():
             if should_include_channel(channel):
                 completion_list_add(
                     completion, channel.name, 0, w.WEECHAT_LIST_POS_SORT
@@ -1243,7 +1512,7 @@ def channel_completion_cb(data, completion_item, current_buffer, completion):
 
     if current_channel:
         for channel in sorted(
-            current_channel.team.channels.values(),
+            current_channel.team.channels.created_values(),
             key=lambda channel: channel.name,
             reverse=True,
         ):
@@ -1265,7 +1534,7 @@ def dm_completion_cb(data, completion_item, current_buffer, completion):
     Adds all dms/mpdms on all teams to completion list
     """
     for team in EVENTROUTER.teams.values():
-        for channel in team.channels.values():
+        for channel in team.channels.created_values():
             if channel.active and channel.type in ["im", "mpim"]:
                 completion_list_add(
                     completion, channel.name, 0, w.WEECHAT_LIST_POS_SORT
@@ -1347,7 +1616,7 @@ def topic_completion_cb(data, completion_item, current_buffer, completion):
         return w.WEECHAT_RC_OK
 
     topic = current_channel.render_topic()
-    channel_names = [channel.name for channel in current_channel.team.channels.values()]
+    channel_names = current_channel.team.get_channel_map()
     if topic.split(" ", 1)[0] in channel_names:
         topic = "{} {}".format(current_channel.name, topic)
 
@@ -1445,6 +1714,7 @@ def stop_talking_to_slack():
     """
     if "EVENTROUTER" in globals():
         EVENTROUTER.shutdown()
+        stop_http_workers()
         for team in EVENTROUTER.teams.values():
             team.ws.shutdown()
     return w.WEECHAT_RC_OK
@@ -1631,6 +1901,8 @@ class SlackTeam(object):
             self.channels = channels
         self.users = users
         self.bots = bots
+        self.render_dependents = {}
+        self._history_cache = None
         self.channel_buffer = None
         self.got_history = True
         self.history_needs_update = False
@@ -1638,6 +1910,8 @@ class SlackTeam(object):
         self.set_muted_channels(kwargs.get("muted_channels", ""))
         self.set_highlight_words(kwargs.get("highlight_words", ""))
         for c in self.channels.keys():
+            if channel_info_is_unused(self.channels.lazy_info(c)):
+                continue
             channels[c].set_related_server(self)
             channels[c].check_should_open()
         # Last step is to make sure my nickname is the set color
@@ -1717,13 +1991,13 @@ class SlackTeam(object):
 
     def set_muted_channels(self, muted_str):
         self.muted_channels = {x for x in muted_str.split(",") if x}
-        for channel in self.channels.values():
+        for channel in self.channels.created_values():
             channel.set_highlights()
             channel.rename()
 
     def set_highlight_words(self, highlight_str):
         self.highlight_words = {x for x in highlight_str.split(",") if x}
-        for channel in self.channels.values():
+        for channel in self.channels.created_values():
             channel.set_highlights()
 
     def formatted_name(self):
@@ -1738,17 +2012,64 @@ class SlackTeam(object):
         w.prnt("", "ERROR: Sending a message in the team buffer is not supported")
 
     def find_channel_by_members(self, members, channel_type=None):
-        for channel in self.channels.values():
+        # IMs and MPIMs are always created, so only created channels are
+        # searched, looking at every channel would create all of them
+        for channel in self.channels.created_values():
             if channel.members == members and (
                 channel_type is None or channel.type == channel_type
             ):
                 return channel
 
     def get_channel_map(self):
-        return {v.name: k for k, v in self.channels.items()}
+        channel_map = {
+            channel_name_from_info(info): k for k, info in self.channels.lazy_items()
+        }
+        channel_map.update({v.name: k for k, v in self.channels.created_items()})
+        return channel_map
 
     def get_username_map(self):
-        return {v.name: k for k, v in self.users.items()}
+        username_map = {
+            nick_from_profile(info.get("profile", {}), info["name"]): k
+            for k, info in self.users.lazy_items()
+        }
+        username_map.update({v.name: k for k, v in self.users.created_items()})
+        return username_map
+
+    def set_render_dependencies(self, message, dependencies):
+        """
+        Updates the index of messages by what their rendered text depends on,
+        e.g. ("user", user_id), so they can be rendered again when it changes.
+        """
+        for dependency in message.render_dependencies - dependencies:
+            dependents = self.render_dependents.get(dependency)
+            if dependents is not None:
+                dependents.discard(message)
+                if not dependents:
+                    del self.render_dependents[dependency]
+        for dependency in dependencies - message.render_dependencies:
+            self.render_dependents.setdefault(dependency, set()).add(message)
+        message.render_dependencies = dependencies
+
+    def rerender_dependent_messages(self, dependency):
+        for message in list(self.render_dependents.get(dependency, ())):
+            if message.channel.messages.get(message.ts) is not message:
+                # The message has been removed or replaced since it was rendered
+                self.set_render_dependencies(message, frozenset())
+            else:
+                message.channel.change_message(message.ts)
+
+    @property
+    def history_cache(self):
+        if not config.history_cache or sqlite3 is None:
+            return None
+        if self._history_cache is None:
+            cache_dir = w.info_get("weechat_cache_dir", "") or w.info_get(
+                "weechat_dir", ""
+            )
+            self._history_cache = SlackHistoryCache(
+                "{}/slack_history_{}.db".format(cache_dir, self.identifier)
+            )
+        return self._history_cache
 
     def get_team_hash(self):
         return self.team_hash
@@ -1842,7 +2163,7 @@ class SlackTeam(object):
         dbg("connected to {}".format(self.domain))
 
         if config.background_load_all_history:
-            for channel in self.channels.values():
+            for channel in self.channels.created_values():
                 if channel.channel_buffer:
                     channel.get_history(slow_queue=True)
         else:
@@ -1903,6 +2224,58 @@ class SlackTeam(object):
         )
 
 
+class SlackHistoryCache(object):
+    """
+    Cache of the channel history of a team, in an SQLite database indexed by
+    channel and ts. The raw message JSON is stored compressed, so it can be
+    processed like a conversations.history response when a channel is opened.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "channel TEXT NOT NULL, ts TEXT NOT NULL, message BLOB NOT NULL, "
+            "PRIMARY KEY (channel, ts)) WITHOUT ROWID"
+        )
+        self.db.commit()
+
+    def load(self, channel_id, count):
+        """Returns the newest cached messages of a channel, newest first."""
+        rows = self.db.execute(
+            "SELECT message FROM messages WHERE channel = ? "
+            "ORDER BY ts DESC LIMIT ?",
+            (channel_id, count),
+        )
+        return [json.loads(zlib.decompress(row[0]).decode("utf-8")) for row in rows]
+
+    def store(self, channel_id, messages, count, replace=False):
+        """
+        Stores messages, keeping only the newest count messages of the channel.
+        With replace, the messages cached before are removed first.
+        """
+        if replace:
+            self.db.execute("DELETE FROM messages WHERE channel = ?", (channel_id,))
+        self.db.executemany(
+            "INSERT OR REPLACE INTO messages (channel, ts, message) VALUES (?, ?, ?)",
+            [
+                (
+                    channel_id,
+                    str(SlackTS(message["ts"])),
+                    sqlite3.Binary(zlib.compress(json.dumps(message).encode("utf-8"))),
+                )
+                for message in messages
+            ],
+        )
+        self.db.execute(
+            "DELETE FROM messages WHERE channel = ? AND ts < ("
+            "SELECT ts FROM messages WHERE channel = ? "
+            "ORDER BY ts DESC LIMIT 1 OFFSET ?)",
+            (channel_id, channel_id, count - 1),
+        )
+        self.db.commit()
+
+
 class SlackChannelCommon(object):
     def __init__(self):
         self.label_full_drop_prefix = False
@@ -2178,7 +2551,7 @@ class SlackChannel(SlackChannelCommon):
         self.got_members = False
         self.history_needs_update = False
         self.pending_history_requests = set()
-        self.messages = OrderedDict()
+        self.messages = SlackChannelMessages()
         self.visible_messages = SlackChannelVisibleMessages(self)
         self.hashed_messages = SlackChannelHashedMessages(self)
         self.thread_channels = {}
@@ -2468,7 +2841,7 @@ class SlackChannel(SlackChannelCommon):
 
     def destroy_buffer(self, update_remote):
         super(SlackChannel, self).destroy_buffer(update_remote)
-        self.messages = OrderedDict()
+        self.messages = SlackChannelMessages()
         if update_remote and not self.eventrouter.shutting_down:
             s = SlackRequest(
                 self.team,
@@ -2538,13 +2911,12 @@ class SlackChannel(SlackChannelCommon):
             message_to_store.submessages = old_message.submessages
 
         self.messages[message_to_store.ts] = message_to_store
-        self.messages = OrderedDict(sorted(self.messages.items()))
 
         max_history = w.config_integer(
             w.config_get("weechat.history.max_buffer_lines_number")
         )
-        messages_to_check = islice(
-            self.messages.items(), max(0, len(self.messages) - max_history)
+        messages_to_check = self.messages.oldest_items(
+            max(0, len(self.messages) - max_history)
         )
         messages_to_delete = []
         for ts, message in messages_to_check:
@@ -2569,6 +2941,7 @@ class SlackChannel(SlackChannelCommon):
             if message_hash:
                 del self.hashed_messages[ts]
                 del self.hashed_messages[message_hash]
+            self.team.set_render_dependencies(self.messages[ts], frozenset())
             del self.messages[ts]
 
     def is_visible(self):
@@ -2591,6 +2964,10 @@ class SlackChannel(SlackChannelCommon):
         if self.identifier in self.pending_history_requests:
             return
 
+        from_cache = False
+        if not self.got_history and not full:
+            from_cache = self.load_cached_history(no_log)
+
         self.print_getting_history()
         self.pending_history_requests.add(self.identifier)
         self.get_members()
@@ -2604,12 +2981,37 @@ class SlackChannel(SlackChannelCommon):
             self.team.slack_api_translator[self.type]["history"],
             post_data,
             channel=self,
-            metadata={"slow_queue": slow_queue, "no_log": no_log},
+            metadata={
+                "slow_queue": slow_queue,
+                "no_log": no_log,
+                "after_cache": from_cache and "oldest" in post_data,
+            },
         )
         self.eventrouter.receive(s, slow_queue)
         self.got_history = True
         self.history_needs_update = False
 
+    def load_cached_history(self, no_log=False):
+        """
+        Processes the history cached on disk, if any. The history request
+        which follows then only fetches the messages newer than the cache.
+        Returns whether cached messages were processed.
+        """
+        history_cache = self.team.history_cache
+        if not history_cache:
+            return False
+        messages = history_cache.load(self.identifier, config.history_fetch_count)
+        if messages:
+            handle_history(
+                {"messages": messages},
+                self.eventrouter,
+                self.team,
+                self,
+                {"slow_queue": False, "no_log": no_log, "from_cache": True},
+                includes_threads=False,
+            )
+        return bool(messages)
+
     def get_thread_history(self, thread_ts, slow_queue=False, no_log=False):
         if thread_ts in self.pending_history_requests:
             return
@@ -2797,6 +3199,67 @@ class SlackChannel(SlackChannelCommon):
         return text
 
 
+class SlackChannelMessages(MappingReversible):
+    """
+    Class with a reversible mapping interface (like an OrderedDict) which
+    keeps the messages sorted by ts. Messages are looked up in a dict and the
+    sorted keys are kept in a list, so storing a message is a binary search
+    (usually an append, as new messages are the most recent ones) instead of
+    sorting all the messages again.
+    """
+
+    def __init__(self):
+        self._messages = {}
+        self._keys = []
+
+    def __getitem__(self, key):
+        return self._messages[key]
+
+    def __contains__(self, key):
+        return key in self._messages
+
+    def get(self, key, default=None):
+        return self._messages.get(key, default)
+
+    def __setitem__(self, key, value):
+        if key not in self._messages:
+            if not self._keys or key > self._keys[-1]:
+                self._keys.append(key)
+            else:
+                insort(self._keys, key)
+        self._messages[key] = value
+
+    def __delitem__(self, key):
+        del self._messages[key]
+        del self._keys[bisect_left(self._keys, key)]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __reversed__(self):
+        return reversed(self._keys)
+
+    def oldest_items(self, count):
+        return [(ts, self._messages[ts]) for ts in self._keys[:count]]
+
+    def iter_from(self, ts):
+        """Iterate over the keys which are greater than or equal to ts."""
+        i = bisect_left(self._keys, ts)
+        while i < len(self._keys):
+            yield self._keys[i]
+            i += 1
+
+    def reversed_from(self, ts):
+        """Iterate in reverse over the keys which are greater than or equal to ts."""
+        for key in reversed(self._keys):
+            if key < ts:
+                break
+            yield key
+
+
 class SlackChannelVisibleMessages(MappingReversible):
     """
     Class with a reversible mapping interface (like a read-only OrderedDict)
@@ -2827,7 +3290,7 @@ class SlackChannelVisibleMessages(MappingReversible):
         return True
 
     def __iter__(self):
-        for ts in self.channel.messages:
+        for ts in self.channel.messages.iter_from(self.first_ts_to_display):
             if self._is_visible(ts):
                 yield ts
 
@@ -2838,14 +3301,47 @@ class SlackChannelVisibleMessages(MappingReversible):
         return i
 
     def __reversed__(self):
-        for ts in reversed(self.channel.messages):
+        for ts in self.channel.messages.reversed_from(self.first_ts_to_display):
             if self._is_visible(ts):
                 yield ts
 
 
 class SlackChannelHashedMessages(dict):
+    """
+    Dict mapping message ts to short hashes and short hashes to message ts.
+    The number of short hashes starting with each prefix is kept in
+    hash_prefixes, so checking if a hash is unique is a dict lookup instead of
+    a scan of all the hashes.
+    """
+
     def __init__(self, channel):
         self.channel = channel
+        self.hash_prefixes = {}
+        self.messages_to_change = set()
+
+    def _update_hash_prefixes(self, short_hash, increment):
+        for i in range(1, len(short_hash) + 1):
+            prefix = short_hash[:i]
+            count = self.hash_prefixes.get(prefix, 0) + increment
+            if count > 0:
+                self.hash_prefixes[prefix] = count
+            else:
+                self.hash_prefixes.pop(prefix, None)
+
+    def __setitem__(self, key, value):
+        if isinstance(key, str) and key not in self:
+            self._update_hash_prefixes(key, 1)
+        super(SlackChannelHashedMessages, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super(SlackChannelHashedMessages, self).__delitem__(key)
+        if isinstance(key, str):
+            self._update_hash_prefixes(key, -1)
+
+    def pop(self, key, *args):
+        if isinstance(key, str) and key in self:
+            self._update_hash_prefixes(key, -1)
+        return super(SlackChannelHashedMessages, self).pop(key, *args)
 
     def __missing__(self, key):
         if not isinstance(key, SlackTS):
@@ -2855,7 +3351,7 @@ class SlackChannelHashedMessages(dict):
         full_hash = sha1_hex(str(key))
         short_hash = full_hash[:hash_len]
 
-        while any(x.startswith(short_hash) for x in self if isinstance(x, str)):
+        while short_hash in self.hash_prefixes:
             hash_len += 1
             short_hash = full_hash[:hash_len]
 
@@ -2870,18 +3366,28 @@ class SlackChannelHashedMessages(dict):
             self[other_short_hash] = ts_with_same_hash
             self[ts_with_same_hash] = other_short_hash
 
-            other_message = self.channel.messages.get(ts_with_same_hash)
-            if other_message:
-                self.channel.change_message(other_message.ts)
-                if other_message.thread_channel:
-                    other_message.thread_channel.rename()
-                for thread_message in other_message.submessages:
-                    self.channel.change_message(thread_message)
+            # The message with the old hash is changed by the eventrouter
+            # after the current batch of events, see change_messages
+            if not self.messages_to_change:
+                self.channel.eventrouter.hashed_messages_to_change.append(self)
+            self.messages_to_change.add(ts_with_same_hash)
 
         self[short_hash] = key
         self[key] = short_hash
         return self[key]
 
+    def change_messages(self):
+        messages_to_change = sorted(self.messages_to_change)
+        self.messages_to_change = set()
+        for ts in messages_to_change:
+            message = self.channel.messages.get(ts)
+            if message:
+                self.channel.change_message(message.ts)
+                if message.thread_channel:
+                    message.thread_channel.rename()
+                for thread_message in message.submessages:
+                    self.channel.change_message(thread_message)
+
 
 class SlackDMChannel(SlackChannel):
     """
@@ -3349,6 +3855,78 @@ class SlackBot(SlackUser):
         super(SlackBot, self).__init__(originating_team_id, **kwargs)
 
 
+class SlackLazyRecord(object):
+    """
+    The info received from Slack for a user, bot or channel which hasn't
+    been used yet, and the function creating the full object from it.
+    """
+
+    __slots__ = ("factory", "info")
+
+    def __init__(self, factory, info):
+        self.factory = factory
+        self.info = info
+
+
+class SlackLazyObjects(MutableMapping):
+    """
+    Dict of users, bots or channels which only creates the objects when
+    they are first looked up. Large teams have many more users and channels
+    than are ever shown, so this saves both time when connecting and memory.
+    Checking if a key exists and iterating over the keys doesn't create any
+    objects, but iterating over the values or items creates all of them.
+    """
+
+    def __init__(self):
+        self._objects = {}
+        self._records = {}
+
+    def add_lazy(self, key, factory, info):
+        self._objects.pop(key, None)
+        self._records[key] = SlackLazyRecord(factory, info)
+
+    def lazy_info(self, key):
+        record = self._records.get(key)
+        return record.info if record else None
+
+    def __getitem__(self, key):
+        try:
+            return self._objects[key]
+        except KeyError:
+            record = self._records.pop(key)
+            obj = self._objects[key] = record.factory(record.info)
+            return obj
+
+    def __setitem__(self, key, value):
+        self._records.pop(key, None)
+        self._objects[key] = value
+
+    def __delitem__(self, key):
+        if key in self._records:
+            del self._records[key]
+        else:
+            del self._objects[key]
+
+    def __contains__(self, key):
+        return key in self._objects or key in self._records
+
+    def __iter__(self):
+        return iter(list(self._objects) + list(self._records))
+
+    def __len__(self):
+        return len(self._objects) + len(self._records)
+
+    def created_values(self):
+        return list(self._objects.values())
+
+    def created_items(self):
+        return list(self._objects.items())
+
+    def lazy_items(self):
+        """Returns the keys and info of the objects which aren't created yet."""
+        return [(key, record.info) for key, record in self._records.items()]
+
+
 class SlackMessage(object):
     """
     Represents a single slack message and associated context/metadata.
@@ -3369,6 +3947,7 @@ class SlackMessage(object):
         self.subscribed = message_json.get("subscribed", False)
         self.last_read = SlackTS(message_json.get("last_read", 0))
         self.last_notify = SlackTS(0)
+        self.render_dependencies = frozenset()
 
     def __hash__(self):
         return hash(self.ts)
@@ -3395,10 +3974,21 @@ class SlackMessage(object):
         if not force and self.message_json.get("_rendered_text"):
             return self.message_json["_rendered_text"]
 
+        global render_dependencies
+        render_dependencies = set()
+        try:
+            text = self.render_text()
+        finally:
+            dependencies = frozenset(render_dependencies)
+            render_dependencies = None
+        self.team.set_render_dependencies(self, dependencies)
+
+        self.message_json["_rendered_text"] = text
+        return text
+
+    def render_text(self):
         if self.message_json.get("deleted"):
-            text = colorize_string(config.color_deleted, "(deleted)")
-            self.message_json["_rendered_text"] = text
-            return text
+            return colorize_string(config.color_deleted, "(deleted)")
 
         blocks = self.message_json.get("blocks", [])
         blocks_rendered = "\n".join(unfurl_blocks(blocks))
@@ -3417,10 +4007,10 @@ class SlackMessage(object):
             inviter_id = self.message_json.get("inviter")
             text += unfurl_refs(" by invitation from <@{}>".format(inviter_id))
 
-        if self.subtype == "me_message" and not self.message_json["text"].startswith(
-            self.sender
-        ):
-            text = "{} {}".format(self.sender, text)
+        if self.subtype == "me_message":
+            render_dependencies.add(("user", self.user_identifier))
+            if not self.message_json["text"].startswith(self.sender):
+                text = "{} {}".format(self.sender, text)
 
         if "edited" in self.message_json:
             text += " " + colorize_string(config.color_edited_suffix, "(edited)")
@@ -3447,10 +4037,7 @@ class SlackMessage(object):
         # replace_string_with_emoji() was called on blocks earlier via
         # unfurl_blocks(), so exclude them here
         text_to_replace = text[len(blocks_rendered) :]
-        text = text[: len(blocks_rendered)] + replace_string_with_emoji(text_to_replace)
-
-        self.message_json["_rendered_text"] = text
-        return text
+        return text[: len(blocks_rendered)] + replace_string_with_emoji(text_to_replace)
 
     def get_sender(self, plain):
         user = self.team.users.get(self.user_identifier)
@@ -3703,13 +4290,40 @@ def handle_rtmstart(login_data, eventrouter, team, channel, metadata):
         login_data["team"]["id"], login_data["team"]["domain"]
     )
     if not eventrouter.teams.get(th):
-        users = {}
+        team_id = login_data["team"]["id"]
+        myidentifier = login_data["self"]["id"]
+
+        def create_user(info):
+            return SlackUser(team_id, **info)
+
+        def create_bot(info):
+            return SlackBot(team_id, **info)
+
+        def create_channel(info):
+            return SlackChannel(eventrouter, team=eventrouter.teams.get(th), **info)
+
+        def create_private_channel(info):
+            return SlackPrivateChannel(
+                eventrouter, team=eventrouter.teams.get(th), **info
+            )
+
+        def create_group_channel(info):
+            return SlackGroupChannel(
+                eventrouter, team=eventrouter.teams.get(th), **info
+            )
+
+        def create_shared_channel(info):
+            return SlackSharedChannel(
+                eventrouter, team=eventrouter.teams.get(th), **info
+            )
+
+        users = SlackLazyObjects()
         for item in login_data["users"]:
-            users[item["id"]] = SlackUser(login_data["team"]["id"], **item)
+            users.add_lazy(item["id"], create_user, item)
 
-        bots = {}
+        bots = SlackLazyObjects()
         for item in login_data["bots"]:
-            bots[item["id"]] = SlackBot(login_data["team"]["id"], **item)
+            bots.add_lazy(item["id"], create_bot, item)
 
         subteams = {}
         for item in login_data["subteams"]["all"]:
@@ -3718,32 +4332,32 @@ def handle_rtmstart(login_data, eventrouter, team, channel, metadata):
                 login_data["team"]["id"], is_member=is_member, **item
             )
 
-        channels = {}
+        channels = SlackLazyObjects()
         for item in login_data["channels"]:
             if item["is_shared"]:
-                channels[item["id"]] = SlackSharedChannel(eventrouter, **item)
+                channels.add_lazy(item["id"], create_shared_channel, item)
             elif item["is_mpim"]:
                 channels[item["id"]] = SlackMPDMChannel(
-                    eventrouter, users, login_data["self"]["id"], **item
+                    eventrouter, users, myidentifier, **item
                 )
             elif item["is_private"]:
-                channels[item["id"]] = SlackPrivateChannel(eventrouter, **item)
+                channels.add_lazy(item["id"], create_private_channel, item)
             else:
-                channels[item["id"]] = SlackChannel(eventrouter, **item)
+                channels.add_lazy(item["id"], create_channel, item)
 
         for item in login_data["ims"]:
             channels[item["id"]] = SlackDMChannel(
-                eventrouter, users, login_data["self"]["id"], **item
+                eventrouter, users, myidentifier, **item
             )
 
         for item in login_data["mpims"]:
             channels[item["id"]] = SlackMPDMChannel(
-                eventrouter, users, login_data["self"]["id"], **item
+                eventrouter, users, myidentifier, **item
             )
 
         for item in login_data["groups"]:
             if not item["is_mpim"]:
-                channels[item["id"]] = SlackGroupChannel(eventrouter, **item)
+                channels.add_lazy(item["id"], create_group_channel, item)
 
         t = SlackTeam(
             eventrouter,
@@ -3888,6 +4502,21 @@ def handle_history(
                 channel.set_unread_count_display(1)
         return
 
+    # More messages were posted since the cached ones than a request returns,
+    # so there would be a gap between them and the ones received: only show
+    # (and cache) the ones received, which are the newest
+    skip_cached = bool(metadata.get("after_cache") and message_json.get("has_more"))
+
+    history_cache = team.history_cache
+    if history_cache and not metadata.get("from_cache"):
+        # Store the messages before they are modified by process_message
+        history_cache.store(
+            channel.identifier,
+            message_json["messages"],
+            config.history_fetch_count,
+            replace=skip_cached,
+        )
+
     channel.got_history = True
     channel.history_needs_update = False
     for message in reversed(message_json["messages"]):
@@ -3911,9 +4540,8 @@ def handle_history(
 
     channel.pending_history_requests.discard(channel.identifier)
     if (
-        channel.visible_messages.first_ts_to_display.major == 0
-        and message_json["messages"]
-    ):
+        channel.visible_messages.first_ts_to_display.major == 0 or skip_cached
+    ) and message_json["messages"]:
         channel.visible_messages.first_ts_to_display = SlackTS(
             message_json["messages"][-1]["ts"]
         )
@@ -4144,6 +4772,25 @@ def process_user_change(message_json, eventrouter, team, channel, metadata):
         if dmchannel:
             dmchannel.set_topic(create_user_status_string(profile))
 
+        name = nick_from_profile(profile, message_json["user"]["name"])
+        if name != user.name:
+            channels_with_user = [
+                channel
+                for channel in team.channels.created_values()
+                if channel.channel_buffer
+                and user.identifier in (getattr(channel, "members", None) or ())
+            ]
+            for channel in channels_with_user:
+                nick = w.nicklist_search_nick(channel.channel_buffer, "", user.name)
+                w.nicklist_remove_nick(channel.channel_buffer, nick)
+            user.profile.update(profile)
+            user.name = name
+            user.update_color()
+            for channel in channels_with_user:
+                channel.update_nicklist(user.identifier)
+            # Only the messages mentioning the user have to be rendered again
+            team.rerender_dependent_messages(("user", user.identifier))
+
 
 def process_user_typing(message_json, eventrouter, team, channel, metadata):
     if channel and metadata["user"]:
@@ -4154,6 +4801,7 @@ def process_user_typing(message_json, eventrouter, team, channel, metadata):
 def process_team_join(message_json, eventrouter, team, channel, metadata):
     user = message_json["user"]
     team.users[user["id"]] = SlackUser(team.identifier, **user)
+    team.rerender_dependent_messages(("user", user["id"]))
 
 
 def process_pong(message_json, eventrouter, team, channel, metadata):
@@ -4256,8 +4904,7 @@ def subprocess_thread_message(
 
     parent_message = message.parent_message
     if parent_message and message.ts not in parent_message.submessages:
-        parent_message.submessages.append(message.ts)
-        parent_message.submessages.sort()
+        insort(parent_message.submessages, message.ts)
 
     channel.store_message(message)
 
@@ -4398,6 +5045,7 @@ def process_channel_rename(message_json, eventrouter, team, channel, metadata):
     if channel is None:
         return
     channel.set_name(message_json["channel"]["name"])
+    team.rerender_dependent_messages(("channel", channel.identifier))
 
 
 def process_im_created(message_json, eventrouter, team, channel, metadata):
@@ -4480,6 +5128,7 @@ def process_subteam_created(subteam_json, eventrouter, team, channel, metadata):
     is_member = team.myidentifier in subteam_json_info.get("users", [])
     subteam = SlackSubteam(team.identifier, is_member=is_member, **subteam_json_info)
     team.subteams[subteam_json_info["id"]] = subteam
+    team.rerender_dependent_messages(("subteam", subteam_json_info["id"]))
 
 
 def process_subteam_updated(subteam_json, eventrouter, team, channel, metadata):
@@ -4494,9 +5143,12 @@ def process_subteam_updated(subteam_json, eventrouter, team, channel, metadata):
     team.subteams[subteam_json["subteam"]["id"]] = new_subteam_info
 
     if current_subteam_info.is_member != new_subteam_info.is_member:
-        for channel in team.channels.values():
+        for channel in team.channels.created_values():
             channel.set_highlights()
 
+    if current_subteam_info.handle != new_subteam_info.handle:
+        team.rerender_dependent_messages(("subteam", new_subteam_info.identifier))
+
     if (
         config.notify_usergroup_handle_updated
         and current_subteam_info.handle != new_subteam_info.handle
@@ -5099,6 +5751,13 @@ def unwrap_files(message, message_json, text_before):
 def resolve_ref(ref):
     if ref in ["!channel", "!everyone", "!group", "!here"]:
         return ref.replace("!", "@")
+    if render_dependencies is not None:
+        if ref.startswith("@"):
+            render_dependencies.add(("user", ref[1:]))
+        elif ref.startswith("#"):
+            render_dependencies.add(("channel", ref[1:]))
+        elif ref.startswith("!subteam^"):
+            render_dependencies.add(("subteam", ref.split("^")[1]))
     for team in EVENTROUTER.teams.values():
         if ref.startswith("@"):
             user = team.users.get(ref[1:])
@@ -6161,6 +6820,36 @@ def command_help(data, current_buffer, args):
     return w.WEECHAT_RC_OK
 
 
+@utf8_decode
+def command_eventstats(data, current_buffer, args):
+    """
+    /slack eventstats [-reset]
+    Print statistics about the event queue: its current and max length, and
+    how many events each handler processed and how long it took. Use -reset
+    to reset the statistics.
+    """
+    if args == "-reset":
+        EVENTROUTER.reset_stats()
+        w.prnt("", "Event statistics reset")
+        return w.WEECHAT_RC_OK_EAT
+
+    w.prnt(
+        "",
+        "\n{}\nQueue length: {} (max: {}), slow queue length: {}".format(
+            colorize_string("bold", "Event statistics:"),
+            len(EVENTROUTER.queue),
+            EVENTROUTER.queue_max_length,
+            len(EVENTROUTER.slow_queue),
+        ),
+    )
+    for line in EVENTROUTER.format_handler_stats():
+        w.prnt("", line)
+    return w.WEECHAT_RC_OK_EAT
+
+
+command_eventstats.completion = "-reset"
+
+
 @slack_buffer_required
 @utf8_decode
 def command_distracting(data, current_buffer, args):
@@ -6829,6 +7518,12 @@ class PluginConfig(object):
             " to it. How verbose the logging is depends on log_level.",
         ),
         "distracting_channels": Setting(default="", desc="List of channels to hide."),
+        "event_processing_time": Setting(
+            default="20",
+            desc="How long (ms) to spend processing queued events from Slack each"
+            " time the event queue is drained. Remaining events are processed on"
+            " the next timer tick, so WeeChat stays responsive during bursts.",
+        ),
         "external_user_suffix": Setting(
             default="*", desc="The suffix appended to nicks to indicate external users."
         ),
@@ -6847,6 +7542,28 @@ class PluginConfig(object):
             desc="The number of messages to fetch for each channel when fetching"
             " history, between 1 and 1000.",
         ),
+        "history_cache": Setting(
+            default="false",
+            desc="Cache the last history_fetch_count messages of each channel on"
+            " disk (in the WeeChat cache directory), so the cached messages are"
+            " displayed as soon as a channel is opened and only newer messages are"
+            " fetched from Slack. Messages edited or deleted while WeeChat was not"
+            " running are not updated until /rehistory -remote.",
+        ),
+        "http_connection_pool": Setting(
+            default="false",
+            desc="Send Slack API requests through one process per team which keeps"
+            " its connections to Slack alive, instead of starting one process"
+            " (with a new connection and TLS handshake) per request. Not used when"
+            " weechat.network.proxy_curl is set.",
+        ),
+        "http_connection_pool_size": Setting(
+            default="4",
+            desc="Maximum number of requests sent at the same time (and of"
+            " connections kept alive) per team when http_connection_pool is"
+            " enabled. Changing it takes effect when the processes are restarted"
+            " (e.g. on reload).",
+        ),
         "link_previews": Setting(
             default="true", desc="Show previews of website content linked by teammates."
         ),
@@ -7068,10 +7785,12 @@ class PluginConfig(object):
     get_color_typing_notice = get_string
     get_colorize_attachments = get_string
     get_debug_level = get_int
+    get_event_processing_time = get_int
     get_external_user_suffix = get_string
     get_files_download_location = get_string
     get_group_name_prefix = get_string
     get_history_fetch_count = get_int
+    get_http_connection_pool_size = get_int
     get_map_underline_to = get_string
     get_muted_channels_activity = get_string
     get_thread_broadcast_prefix = get_string
@@ -7321,6 +8040,34 @@ def create_channel_from_info(eventrouter, channel_info, team, myidentifier, user
         return SlackChannel(eventrouter, team=team, **channel_info)
 
 
+def channel_name_from_info(channel_info):
+    """
+    Returns the name a channel created from channel_info would have, so
+    channels can be looked up by name without creating them. IMs and MPIMs
+    are always created, so they are not handled.
+    """
+    if channel_info.get("is_shared"):
+        prepend = config.shared_name_prefix
+    elif channel_info.get("is_private") or channel_info.get("is_group"):
+        prepend = config.group_name_prefix
+    else:
+        prepend = "#"
+    return prepend + channel_info["name"]
+
+
+def channel_info_is_unused(channel_info):
+    """
+    Channels we are not a member of don't get a buffer or any requests when
+    connecting, so the objects for them are created when they are first used.
+    Returns False for channels which are already created.
+    """
+    if channel_info is None or channel_info.get("is_im") or channel_info.get("is_mpim"):
+        return False
+    return channel_info.get("is_archived") or not (
+        channel_info.get("is_open") or channel_info.get("is_member")
+    )
+
+
 def create_team(token, initial_data):
     if not any(initial_data["remaining"].values()):
         if initial_data["errors"]:
@@ -7346,24 +8093,40 @@ def create_team(token, initial_data):
 
             team_id = response_json["team"]["id"]
             myidentifier = response_json["self"]["id"]
+            team_hash = SlackTeam.generate_team_hash(
+                team_id, response_json["team"]["domain"]
+            )
+
+            def create_user(info):
+                return SlackUser(team_id, **info)
 
-            users = {}
-            bots = {}
+            def create_bot(info):
+                return SlackBot(team_id, **info)
+
+            def create_channel(info):
+                return create_channel_from_info(
+                    eventrouter,
+                    info,
+                    eventrouter.teams.get(team_hash),
+                    myidentifier,
+                    users,
+                )
+
+            users = SlackLazyObjects()
+            bots = SlackLazyObjects()
             for member in initial_data["members"]:
                 if member.get("is_bot"):
-                    bots[member["id"]] = SlackBot(team_id, **member)
+                    bots.add_lazy(member["id"], create_bot, member)
                 else:
-                    users[member["id"]] = SlackUser(team_id, **member)
+                    users.add_lazy(member["id"], create_user, member)
 
             self_nick = nick_from_profile(
                 users[myidentifier].profile, response_json["self"]["name"]
             )
 
-            channels = {}
+            channels = SlackLazyObjects()
             for channel_info in initial_data["channels"]:
-                channels[channel_info["id"]] = create_channel_from_info(
-                    eventrouter, channel_info, None, myidentifier, users
-                )
+                channels.add_lazy(channel_info["id"], create_channel, channel_info)
 
             subteams = {}
             for usergroup in initial_data["usergroups"]:
@@ -7404,9 +8167,6 @@ def create_team(token, initial_data):
                 "domain": response_json["team"]["domain"],
             }
 
-            team_hash = SlackTeam.generate_team_hash(
-                team_id, response_json["team"]["domain"]
-            )
             if not eventrouter.teams.get(team_hash):
                 team = SlackTeam(
                     eventrouter,
@@ -7456,6 +8216,279 @@ def create_team(token, initial_data):
         EVENTROUTER.receive(s)
 
 
+###### Replay benchmark
+
+
+class ReplayWeechat(object):
+    """
+    Stand-in for the weechat module, used by the replay benchmark to run the
+    event handlers outside of WeeChat. Functions not defined here do nothing.
+    """
+
+    WEECHAT_RC_OK = 0
+    WEECHAT_RC_OK_EAT = 1
+    WEECHAT_RC_ERROR = -1
+    WEECHAT_HOOK_PROCESS_RUNNING = -1
+    WEECHAT_HOOK_PROCESS_ERROR = -2
+    WEECHAT_LIST_POS_SORT = "sort"
+    WEECHAT_LIST_POS_BEGINNING = "beginning"
+
+    # Default values in WeeChat of the options read with config_get
+    default_options = {
+        "weechat.history.max_buffer_lines_number": 4096,
+    }
+
+    def __init__(self):
+        self.options = dict(self.default_options)
+        self.plugin_options = {}
+        self.buffers_created = 0
+        self.lines_printed = 0
+
+    def __getattribute__(self, name):
+        # WeechatWrapper looks up attributes with __getattribute__, so
+        # __getattr__ wouldn't be used as a fallback
+        try:
+            return object.__getattribute__(self, name)
+        except AttributeError:
+            return object.__getattribute__(self, "noop")
+
+    def noop(self, *args, **kwargs):
+        return ""
+
+    def config_get_plugin(self, option):
+        return self.plugin_options.get(option, "")
+
+    def config_is_set_plugin(self, option):
+        return int(option in self.plugin_options)
+
+    def config_set_plugin(self, option, value):
+        self.plugin_options[option] = value
+        return 1
+
+    def config_string_to_boolean(self, text):
+        return int(text in ("on", "yes", "y", "true", "t", "1"))
+
+    def config_get(self, option_name):
+        # Options the replay doesn't know return an empty pointer, like
+        # options that don't exist in WeeChat
+        return option_name if option_name in self.options else ""
+
+    def config_integer(self, option):
+        return self.options.get(option, 0)
+
+    def buffer_new(self, *args):
+        self.buffers_created += 1
+        return "0x{:x}".format(self.buffers_created)
+
+    def prnt(self, buffer, message):
+        self.lines_printed += 1
+
+    def prnt_date_tags(self, buffer, date, tags, message):
+        self.lines_printed += 1
+
+
+class ReplayWebSocket(object):
+    def send(self, data):
+        pass
+
+
+class ReplayEventRouter(EventRouter):
+    """
+    EventRouter for the replay benchmark. Requests are answered with the
+    recorded responses for the same API method, in the order they were
+    recorded, and teams are marked as connected without a websocket.
+    """
+
+    def __init__(self, responses):
+        super(ReplayEventRouter, self).__init__()
+        self.responses = responses
+        self.unanswered_requests = {}
+
+    def receive(self, dataobj, slow=False):
+        if not isinstance(dataobj, SlackRequest):
+            return super(ReplayEventRouter, self).receive(dataobj, slow)
+        responses = self.responses.get(dataobj.request_normalized)
+        if not responses:
+            self.unanswered_requests[dataobj.request] = (
+                self.unanswered_requests.get(dataobj.request, 0) + 1
+            )
+            return
+        response = json.loads(responses.popleft())
+        response["wee_slack_request_metadata"] = dataobj
+        self.queue.append(response)
+
+    def register_team(self, team):
+        super(ReplayEventRouter, self).register_team(team)
+        team.ws = ReplayWebSocket()
+        team.set_connected()
+
+    def handle_all(self):
+        while self.queue or self.slow_queue:
+            if not self.queue:
+                self.queue.append(self.slow_queue.popleft())
+            self.handle_next()
+
+
+def load_recorded_events(directory):
+    """
+    Returns the events recorded by EventRouter.record_event in directory,
+    sorted by the time they were recorded.
+    """
+    if not os.path.isdir(directory):
+        return []
+    events = []
+    for file_name in os.listdir(directory):
+        recorded_time, _, _ = file_name.partition("-")
+        with open(os.path.join(directory, file_name)) as f:
+            events.append((float(recorded_time), f.read()))
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def replay_benchmark(args):
+    """
+    python slack.py [-tracemalloc] [record_dir]
+    Replay a session recorded with the record_events option (from
+    RECORD_DIR by default) through the EventRouter, without WeeChat or a
+    connection to Slack. The recorded HTTP responses are used to connect
+    the team and answer requests, then the recorded websocket events are
+    processed one at a time. Prints how many events each handler processed
+    and how long it took, and the peak memory usage. Use -tracemalloc to
+    also measure the peak memory allocated by Python, which makes the
+    replay slower.
+    """
+    global w, weechat, weechat_version, config, EVENTROUTER, slack_debug, hdata
+    global EMOJI, EMOJI_WITH_SKIN_TONES_REVERSE, typing_timer, hide_distractions
+
+    use_tracemalloc = "-tracemalloc" in args
+    args = [arg for arg in args if arg != "-tracemalloc"]
+    record_dir = args[0] if args else RECORD_DIR
+    if not os.path.isdir(record_dir):
+        print("No recorded events found in {}".format(record_dir))
+        return 1
+
+    responses = {}
+    for team_dir in sorted(os.listdir(record_dir)):
+        http_dir = os.path.join(record_dir, team_dir, "http")
+        for _, data in load_recorded_events(http_dir):
+            method = json.loads(data).get("wee_slack_process_method")
+            responses.setdefault(method, []).append(data)
+    responses = {method: deque(data) for method, data in responses.items()}
+
+    if use_tracemalloc:
+        import tracemalloc
+
+        tracemalloc.start()
+
+    weechat = ReplayWeechat()
+    w = WeechatWrapper(weechat)
+    weechat_version = 0x4000000
+    slack_debug = None
+    config = PluginConfig()
+    EVENTROUTER = ReplayEventRouter(responses)
+    hdata = Hdata(w)
+    EMOJI, EMOJI_WITH_SKIN_TONES_REVERSE = {}, {}
+    typing_timer = time.time()
+    hide_distractions = False
+
+    stored_messages = {}
+    store_message = SlackChannel.store_message
+
+    def replay_store_message(channel, message):
+        store_message(channel, message)
+        if channel.active:
+            # Channels aren't hashable, so they are keyed by their id
+            stored_messages.setdefault(id(channel), (channel, set()))[1].add(message.ts)
+
+    SlackChannel.store_message = replay_store_message
+
+    start = time.time()
+    initiate_connection("xoxp-replay")
+    EVENTROUTER.handle_all()
+    connect_time = time.time() - start
+
+    ws_events = []
+    for team in EVENTROUTER.teams.values():
+        ws_dir = os.path.join(record_dir, team.subdomain, "websocket")
+        for recorded_time, data in load_recorded_events(ws_dir):
+            ws_events.append((recorded_time, team, data))
+    ws_events.sort(key=lambda event: event[0])
+
+    ws_start = time.time()
+    for _, team, data in ws_events:
+        message_json = json.loads(data)
+        message_json["wee_slack_metadata_team"] = team
+        EVENTROUTER.receive(message_json)
+        EVENTROUTER.handle_all()
+    end = time.time()
+    SlackChannel.store_message = store_message
+
+    # Messages are only removed from a channel when it has more than
+    # max_buffer_lines_number of them, so every channel should keep all the
+    # messages stored in it, up to that number
+    max_history = weechat.config_integer("weechat.history.max_buffer_lines_number")
+    assert max_history > 0, "max_buffer_lines_number is {}".format(max_history)
+    messages_kept = 0
+    for channel, stored in stored_messages.values():
+        messages_kept += len(channel.messages)
+        expected = min(len(stored), max_history)
+        message = "{} kept {} of {} messages, expected at least {}".format(
+            channel.name, len(channel.messages), len(stored), expected
+        )
+        assert len(channel.messages) >= expected, message
+
+    print(
+        "Replayed {} from {}: {} teams, {} websocket events".format(
+            SCRIPT_NAME, record_dir, len(EVENTROUTER.teams), len(ws_events)
+        )
+    )
+    print(
+        "Connect: {:.1f} ms, websocket events: {:.1f} ms, total: {:.1f} ms".format(
+            connect_time * 1000, (end - ws_start) * 1000, (end - start) * 1000
+        )
+    )
+    print(
+        "Buffers created: {}, lines printed: {}, messages kept: {}, "
+        "max queue length: {}".format(
+            weechat.buffers_created,
+            weechat.lines_printed,
+            messages_kept,
+            EVENTROUTER.queue_max_length,
+        )
+    )
+    if EVENTROUTER.unanswered_requests:
+        print(
+            "Requests without a recorded response: {}".format(
+                ", ".join(
+                    "{} ({})".format(method, count)
+                    for method, count in sorted(EVENTROUTER.unanswered_requests.items())
+                )
+            )
+        )
+    try:
+        import resource
+
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+        if sys.platform != "darwin":
+            max_rss *= 1024
+        print("Peak memory (max RSS): {:.1f} MB".format(max_rss / 1e6))
+    except ImportError:
+        pass
+    if use_tracemalloc:
+        _, peak = tracemalloc.get_traced_memory()
+        print("Peak memory allocated by Python: {:.1f} MB".format(peak / 1e6))
+    print("Handlers:")
+    for line in EVENTROUTER.format_handler_stats():
+        print(line)
+    return 0
+
+
+if __name__ == "__main__" and "weechat" not in globals():
+    # Not loaded by WeeChat, so run the replay benchmark instead
+    sys.exit(replay_benchmark(sys.argv[1:]))
+
+
 if __name__ == "__main__":
     w = WeechatWrapper(weechat)
 
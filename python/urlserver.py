@@ -28,8 +28,9 @@
 #
 # How does it work?
 #
-# 1. The URLs displayed in buffers are shortened and stored in memory (saved in
-#    a file when script is unloaded).
+# 1. The URLs displayed in buffers are shortened and stored in memory (and
+#    appended to a journal file, compacted in a snapshot file from time to
+#    time).
 # 2. URLs shortened can be displayed below messages, in a dedicated buffer, or
 #    as HTML page in your browser.
 # 3. This script embeds an HTTP server, which will redirect shortened URLs
@@ -44,6 +45,21 @@
 #
 # History:
 #
+# 2026-10-18:
+#     v2.10: compile filters on messages (buffers, tags, regex, URL min length)
+#            when options are changed instead of on each message, cache base
+#            URL
+# 2026-10-18:
+#     v2.9: non-blocking HTTP server with persistent connections and multiple
+#           clients at same time (new options "http_max_clients" and
+#           "http_keep_alive_timeout")
+# 2026-10-18:
+#     v2.8: add pagination and search in page with list of URLs (new option
+#           "http_page_size"), keep URLs sorted by time/nick/buffer and cache
+#           HTML of URLs and pages
+# 2026-10-18:
+#     v2.7: save URLs in a journal as soon as they are added, with a compacted
+#           snapshot (one JSON list per line) instead of a Python dict
 # 2021-05-06, Sébastien Helleu <flashcode@flashtux.org>:
 #     v2.6: add compatibility with WeeChat >= 3.2 (XDG directories)
 # 2021-03-06, Sébastien Helleu <flashcode@flashtux.org>:
@@ -120,7 +136,7 @@
 
 SCRIPT_NAME = 'urlserver'
 SCRIPT_AUTHOR = 'Sébastien Helleu <flashcode@flashtux.org>'
-SCRIPT_VERSION = '2.6'
+SCRIPT_VERSION = '2.10'
 SCRIPT_LICENSE = 'GPL3'
 SCRIPT_DESC = 'Shorten URLs with own HTTP server'
 
@@ -144,16 +160,26 @@ except ImportError:
 try:
     import ast
     import base64
+    import bisect
     import datetime
+    import errno
+    import json
     import os
     import re
     import socket
     import string
     import sys
+    import time
 except ImportError as message:
     print('Missing package(s) for %s: %s' % (SCRIPT_NAME, message))
     import_ok = False
 
+try:
+    from urllib.parse import parse_qs, quote  # python 3.x
+except ImportError:
+    from urllib import quote  # python 2.x
+    from urlparse import parse_qs
+
 # regex are based on urlbar.py, written by xt
 # Extended to reflect RFC3986/3987 by MacGyver
 url_scheme = r'[a-zA-Z][a-zA-Z0-9+\-.]*'
@@ -213,12 +239,26 @@ url_full = r'(?P<url>(?:%s)://(?:%s)(?:%s)(?:\?%s)?(?:#%s)?)(?P<trailer>.)?' % (
 urlserver = {
     'socket': None,
     'hook_fd': None,
+    'hook_timer': None,
+    'clients': {},
     'regex': re.compile(url_full, re.IGNORECASE),
     'urls': {},
     'number': 0,
     'buffer': '',
+    'journal': None,
+    'journal_entries': 0,
+    'index': {'time': [], 'nick': [], 'buffer': []},
+    'html_rows': {},
+    'html_pages': {},
+    'filters': {},
+    'base_url': '',
 }
 
+# replies pending for a client above which it is closed: pipelined requests
+# are not read while a reply is pending, so only a client that never reads
+# its replies can reach this
+urlserver_output_max = 4 * 1024 * 1024
+
 # script options
 urlserver_settings_default = {
     # HTTP server settings
@@ -246,6 +286,13 @@ urlserver_settings_default = {
         '',
         'regex for IPs allowed to use server '
         '(example: "^(123\.45\.67\.89|192\.160\..*)$")'),
+    'http_max_clients': (
+        '32',
+        'max number of clients connected at same time (0 = unlimited)'),
+    'http_keep_alive_timeout': (
+        '30',
+        'close connections with clients after this number of seconds '
+        'without activity'),
     'http_auth': (
         '',
         'login and password (format: "login:password") required to access to '
@@ -292,6 +339,9 @@ urlserver_settings_default = {
     'http_open_in_new_page': (
         'on',
         'open links in new pages/tabs'),
+    'http_page_size': (
+        '100',
+        'number of URLs displayed per page in HTML page (0 = all URLs)'),
     # message filter settings
     'msg_ignore_buffers': (
         'core.weechat,python.grep',
@@ -384,7 +434,10 @@ def urlserver_get_base_url():
     Return url with port number if != default port for the protocol,
     including prefix path.
     """
-    global urlserver_settings
+    global urlserver, urlserver_settings
+
+    if urlserver['base_url']:
+        return urlserver['base_url']
 
     scheme = urlserver_settings['http_scheme_display']
     hostname = (urlserver_settings['http_hostname_display'] or
@@ -409,7 +462,9 @@ def urlserver_get_base_url():
     if urlserver_settings['http_url_prefix']:
         prefix = '%s/' % urlserver_settings['http_url_prefix']
 
-    return '%s://%s%s/%s' % (scheme, hostname, prefixed_port, prefix)
+    urlserver['base_url'] = '%s://%s%s/%s' % (scheme, hostname,
+                                               prefixed_port, prefix)
+    return urlserver['base_url']
 
 
 def urlserver_short_url(number, full=True):
@@ -418,36 +473,38 @@ def urlserver_short_url(number, full=True):
                      base62_encode(number))
 
 
-def urlserver_server_reply(conn, code, extra_header, message,
+def urlserver_server_reply(client, code, extra_header, message,
                            mimetype='text/html'):
     """Send a HTTP reply to client."""
     global urlserver_settings
     if extra_header:
         extra_header += '\r\n'
+    if sys.version_info >= (3,) and type(message) is not bytes:
+        # python 3.x: length of body is in bytes (required for keep-alive)
+        message = message.encode('utf-8')
     s = 'HTTP/1.1 %s\r\n' \
         '%s' \
         'Content-Type: %s\r\n' \
         'Content-Length: %d\r\n' \
+        'Connection: %s\r\n' \
         '\r\n' \
-        % (code, extra_header, mimetype, len(message))
+        % (code, extra_header, mimetype, len(message),
+           'close' if client['closing'] else 'keep-alive')
     msg = None
     if sys.version_info >= (3,):
         # python 3.x
-        if type(message) is bytes:
-            msg = s.encode('utf-8') + message
-        else:
-            msg = s.encode('utf-8') + message.encode('utf-8')
+        msg = s.encode('utf-8') + message
     else:
         # python 2.x
         msg = s + message
     if urlserver_settings['debug'] == 'on':
         weechat.prnt('', 'urlserver: sending %d bytes' % len(msg))
-    conn.sendall(msg)
+    urlserver_client_send(client, msg)
 
 
-def urlserver_server_reply_auth_required(conn):
+def urlserver_server_reply_auth_required(client):
     """Reply a 401 (authorization required)."""
-    urlserver_server_reply(conn,
+    urlserver_server_reply(client,
                            '401 Authorization required',
                            'WWW-Authenticate: Basic realm="%s"' % SCRIPT_NAME,
                            '')
@@ -496,93 +553,191 @@ def urlserver_server_favicon():
     return base64_decode(s)
 
 
-def urlserver_server_reply_list(conn, sort='-time'):
-    """Send list of URLs as HTML page to client."""
+def urlserver_index_rebuild():
+    """Rebuild sorted indexes of URLs (one per sortable column)."""
+    global urlserver
+    urlserver['index'] = {
+        'time': sorted(urlserver['urls']),
+        'nick': sorted([(item[1].lower(), key)
+                        for key, item in urlserver['urls'].items()]),
+        'buffer': sorted([(item[2].lower(), key)
+                          for key, item in urlserver['urls'].items()]),
+    }
+    urlserver['html_rows'] = {}
+    urlserver['html_pages'] = {}
+
+
+def urlserver_index_add(key):
+    """Add an URL in sorted indexes."""
+    global urlserver
+    item = urlserver['urls'][key]
+    bisect.insort(urlserver['index']['time'], key)
+    bisect.insort(urlserver['index']['nick'], (item[1].lower(), key))
+    bisect.insort(urlserver['index']['buffer'], (item[2].lower(), key))
+    urlserver['html_pages'] = {}
+
+
+def urlserver_index_remove(key):
+    """Remove an URL from sorted indexes."""
+    global urlserver
+    item = urlserver['urls'][key]
+    for name, value in (('time', key),
+                        ('nick', (item[1].lower(), key)),
+                        ('buffer', (item[2].lower(), key))):
+        index = urlserver['index'][name]
+        pos = bisect.bisect_left(index, value)
+        if pos < len(index) and index[pos] == value:
+            del index[pos]
+    urlserver['html_rows'].pop(key, None)
+    urlserver['html_pages'] = {}
+
+
+def urlserver_list_href(sort, page=1, search=''):
+    """Return relative link to a page of the list of URLs."""
+    href = 'sort=%s' % sort
+    if page > 1:
+        href += '&amp;page=%d' % page
+    if search:
+        href += '&amp;search=%s' % quote(search.encode('utf-8'))
+    return href
+
+
+def urlserver_html_row(key):
+    """Return HTML code for one URL in the list (cached)."""
+    global urlserver, urlserver_settings
+    row = urlserver['html_rows'].get(key)
+    if row is not None:
+        return row
+    item = urlserver['urls'][key]
+    url = item[3]
+    obj = ''
+    message = (html.escape(item[4].replace(url, '\x01\x02\x03\x04'))
+               .split('\t', 1))
+    message[0] = '<span class="prefix">%s</span>' % message[0]
+    message[1] = '<span class="message">%s</span>' % message[1]
+
+    strjoin = ('<span class="prefix_suffix"> %s </span>' %
+               urlserver_settings['http_prefix_suffix']
+               .replace(' ', '&nbsp;'))
+
+    target = ''
+    if urlserver_settings['http_open_in_new_page'] == 'on':
+        target = ' target=_blank'
+
+    message = strjoin.join(message).replace(
+        '\x01\x02\x03\x04',
+        '</span><a class="url" href="%s" title="%s"%s>%s'
+        '</a><span class="message">' % (
+            urlserver_short_url(key, False), url, target, url))
+    if urlserver_settings['http_embed_image'] == 'on' and \
+            url.lower().endswith(('.jpg', '.jpeg', '.png', '.gif',
+                                  '.bmp', '.svg')):
+        obj = ('<div class="obj"><img src="%s" title="%s" alt="%s">'
+               '</div>' % (url, url, url))
+    elif urlserver_settings['http_embed_youtube'] == 'on' and \
+            'youtube.com/' in url:
+        m = re.search('v=([\w\d]+)', url)
+        if m:
+            yid = m.group(1)
+            try:
+                size = (urlserver_settings['http_embed_youtube_size']
+                        .split('*'))
+                width = int(size[0])
+                height = int(size[1])
+            except:
+                width = 480
+                height = 350
+            obj = ('<div class="obj youtube">'
+                   '<iframe id="%s" type="text/html" width="%d" '
+                   'height="%d" '
+                   'src="https://www.youtube.com/embed/%s?enablejsapi=1">'
+                   '</iframe></div>' % (yid, width, height, yid))
+    row = ('  <tr><td class="timestamp">%s</td>'
+           '<td class="nick">%s</td>'
+           '<td class="buffer">%s</td><td class="message">'
+           '%s%s</td></tr>\n' % (item[0], item[1], item[2], message, obj))
+    urlserver['html_rows'][key] = row
+    return row
+
+
+def urlserver_html_list(sort, page, search):
+    """Return HTML page with list of URLs."""
     global urlserver, urlserver_settings
-    content = '<div class="urls">\n<table id="urls_table">\n'
-    if not sort.startswith('-'):
-        sort = '+%s' % sort
     if sort[1:] == 'time':
-        urls = sorted(urlserver['urls'].items())
+        keys = urlserver['index']['time']
     else:
-        idx = ['time', 'nick', 'buffer'].index(sort[1:])
-        urls = sorted(urlserver['urls'].items(),
-                      key=lambda url: url[1][idx].lower())
+        keys = [key for value, key in urlserver['index'][sort[1:]]]
     if sort.startswith('-'):
-        urls.reverse()
+        keys = keys[::-1]
+    if search:
+        search_lower = search.lower()
+        keys = [key for key in keys
+                if search_lower in ('%s\x00%s\x00%s\x00%s' % tuple(
+                    urlserver['urls'][key][1:5])).lower()]
+    try:
+        page_size = int(urlserver_settings['http_page_size'])
+    except:
+        page_size = 0
+    if page_size <= 0:
+        page_size = max(len(keys), 1)
+    pages = max((len(keys) + page_size - 1) // page_size, 1)
+    page = min(max(page, 1), pages)
+
+    # explicit action: a relative one would submit to the current page
+    # (like "/sort=-time?sort=..."), which isn't parsed as a query string
+    action = '/'
+    if urlserver_settings['http_url_prefix']:
+        action = '/%s/' % urlserver_settings['http_url_prefix']
+    content = []
+    content.append('<div class="search"><form action="%s" method="get">'
+                   '<input type="hidden" name="sort" value="%s" />'
+                   '<input type="text" name="search" value="%s" />'
+                   '<input type="submit" value="Search" />'
+                   '</form></div>\n' % (html.escape(action, True),
+                                         sort.lstrip('+'),
+                                         html.escape(search, True)))
+    content.append('<div class="urls">\n<table id="urls_table">\n')
     sortkey = {
         '-': ('', '&uarr;'),
         '+': ('-', '&darr;')
     }
-    content += '  <tr>'
+    content.append('  <tr>')
     for column, defaultsort in (('time', '-'), ('nick', ''), ('buffer', '')):
         if sort[1:] == column:
-            content += ('<th class="sortable sorted_by %s_header">'
-                        '<a href="sort=%s%s">%s</a> %s</th>' % (
-                            column,
-                            sortkey[sort[0]][0],
-                            column, column.capitalize(),
-                            sortkey[sort[0]][1]))
+            content.append('<th class="sortable sorted_by %s_header">'
+                           '<a href="%s">%s</a> %s</th>' % (
+                               column,
+                               urlserver_list_href(
+                                   sortkey[sort[0]][0] + column,
+                                   search=search),
+                               column.capitalize(),
+                               sortkey[sort[0]][1]))
         else:
-            content += ('<th class="sortable %s_header">'
-                        '<a class="sort_link" href="sort=%s%s">%s</a></th>' % (
-                            column,
-                            defaultsort,
-                            column,
-                            column.capitalize()))
-    content += '<th class="unsortable message_header">URLs</th>'
-    content += '</tr>\n'
-    for key, item in urls:
-        content += '  <tr>'
-        url = item[3]
-        obj = ''
-        message = (html.escape(item[4].replace(url, '\x01\x02\x03\x04'))
-                   .split('\t', 1))
-        message[0] = '<span class="prefix">%s</span>' % message[0]
-        message[1] = '<span class="message">%s</span>' % message[1]
-
-        strjoin = ('<span class="prefix_suffix"> %s </span>' %
-                   urlserver_settings['http_prefix_suffix']
-                   .replace(' ', '&nbsp;'))
-
-        target = ''
-        if urlserver_settings['http_open_in_new_page'] == 'on':
-            target = ' target=_blank'
-
-        message = strjoin.join(message).replace(
-            '\x01\x02\x03\x04',
-            '</span><a class="url" href="%s" title="%s"%s>%s'
-            '</a><span class="message">' % (
-                urlserver_short_url(key, False), url, target, url))
-        if urlserver_settings['http_embed_image'] == 'on' and \
-                url.lower().endswith(('.jpg', '.jpeg', '.png', '.gif',
-                                      '.bmp', '.svg')):
-            obj = ('<div class="obj"><img src="%s" title="%s" alt="%s">'
-                   '</div>' % (url, url, url))
-        elif urlserver_settings['http_embed_youtube'] == 'on' and \
-                'youtube.com/' in url:
-            m = re.search('v=([\w\d]+)', url)
-            if m:
-                yid = m.group(1)
-                try:
-                    size = (urlserver_settings['http_embed_youtube_size']
-                            .split('*'))
-                    width = int(size[0])
-                    height = int(size[1])
-                except:
-                    width = 480
-                    height = 350
-                obj = ('<div class="obj youtube">'
-                       '<iframe id="%s" type="text/html" width="%d" '
-                       'height="%d" '
-                       'src="https://www.youtube.com/embed/%s?enablejsapi=1">'
-                       '</iframe></div>' % (yid, width, height, yid))
-        content += ('<td class="timestamp">%s</td>'
-                    '<td class="nick">%s</td>'
-                    '<td class="buffer">%s</td><td class="message">' % (
-                        item[0], item[1], item[2]))
-        content += '%s%s</td></tr>\n' % (message, obj)
-    content += '</table>'
+            content.append('<th class="sortable %s_header">'
+                           '<a class="sort_link" href="%s">%s</a></th>' % (
+                               column,
+                               urlserver_list_href(defaultsort + column,
+                                                   search=search),
+                               column.capitalize()))
+    content.append('<th class="unsortable message_header">URLs</th>')
+    content.append('</tr>\n')
+    start = (page - 1) * page_size
+    for key in keys[start:start + page_size]:
+        content.append(urlserver_html_row(key))
+    content.append('</table>')
+    if pages > 1:
+        links = []
+        if page > 1:
+            links.append('<a class="page_link" href="%s">&larr;</a>' %
+                         urlserver_list_href(sort.lstrip('+'), page - 1,
+                                             search))
+        links.append('page %d/%d (%d URLs)' % (page, pages, len(keys)))
+        if page < pages:
+            links.append('<a class="page_link" href="%s">&rarr;</a>' %
+                         urlserver_list_href(sort.lstrip('+'), page + 1,
+                                             search))
+        content.append('\n<div class="pages">%s</div>' % ' '.join(links))
+    content = ''.join(content)
     if len(urlserver_settings['http_css_url']) > 0:
         css = ('<link rel="stylesheet" type="text/css" href="%s" />' %
                urlserver_settings['http_css_url'])
@@ -597,27 +752,44 @@ def urlserver_server_reply_list(conn, sort='-time'):
                '  .timestamp,.nick,.buffer { white-space: nowrap }\n'
                '  .sorted_by { font-style: italic; }\n'
                '  .obj { margin-top: 1em }\n'
+               '  .search,.pages { margin: 1em 0 }\n'
                '-->'
                '</style>\n' % (
                    urlserver_settings['http_bg_color'],
                    urlserver_settings['http_fg_color']))
 
-    html_code = ('<html>\n'
-                 '<head>\n'
-                 '<title>%s</title>\n'
-                 '<meta http-equiv="content-type" content="text/html; '
-                 'charset=utf-8" />\n'
-                 '%s\n'
-                 '<base href="%s" />\n'
-                 '<link rel="icon" type="image/png" href="favicon.png" />\n'
-                 '</head>\n'
-                 '<body>\n%s\n</body>\n'
-                 '</html>' % (
-                     urlserver_settings['http_title'],
-                     css,
-                     urlserver_get_base_url(),
-                     content))
-    urlserver_server_reply(conn, '200 OK', '', html_code)
+    return ('<html>\n'
+            '<head>\n'
+            '<title>%s</title>\n'
+            '<meta http-equiv="content-type" content="text/html; '
+            'charset=utf-8" />\n'
+            '%s\n'
+            '<base href="%s" />\n'
+            '<link rel="icon" type="image/png" href="favicon.png" />\n'
+            '</head>\n'
+            '<body>\n%s\n</body>\n'
+            '</html>' % (
+                urlserver_settings['http_title'],
+                css,
+                urlserver_get_base_url(),
+                content))
+
+
+def urlserver_server_reply_list(client, sort='-time', page=1, search=''):
+    """Send list of URLs as HTML page to client."""
+    global urlserver
+    if not sort.startswith('-'):
+        sort = '+%s' % sort
+    if sort[1:] not in ('time', 'nick', 'buffer'):
+        sort = '-time'
+    cache_key = (sort, page, search)
+    html_code = urlserver['html_pages'].get(cache_key)
+    if html_code is None:
+        html_code = urlserver_html_list(sort, page, search)
+        if len(urlserver['html_pages']) >= 64:
+            urlserver['html_pages'] = {}
+        urlserver['html_pages'][cache_key] = html_code
+    urlserver_server_reply(client, '200 OK', '', html_code)
 
 
 def urlserver_check_auth(data):
@@ -635,28 +807,210 @@ def urlserver_check_auth(data):
 
 
 def urlserver_server_fd_cb(data, fd):
-    """Callback for server socket."""
+    """Callback for server socket: accept new clients."""
     global urlserver, urlserver_settings
     if not urlserver['socket']:
         return weechat.WEECHAT_RC_OK
-    conn, addr = urlserver['socket'].accept()
-    if urlserver_settings['debug'] == 'on':
-        weechat.prnt('', 'urlserver: connection from %s' % str(addr))
-    if urlserver_settings['http_allowed_ips'] and \
-            not re.match(urlserver_settings['http_allowed_ips'], addr[0]):
+    while True:
+        try:
+            conn, addr = urlserver['socket'].accept()
+        except socket.error:
+            # no more pending connections
+            break
+        if urlserver_settings['debug'] == 'on':
+            weechat.prnt('', 'urlserver: connection from %s' % str(addr))
+        if urlserver_settings['http_allowed_ips'] and \
+                not re.match(urlserver_settings['http_allowed_ips'], addr[0]):
+            if urlserver_settings['debug'] == 'on':
+                weechat.prnt('', 'urlserver: IP not allowed')
+            conn.close()
+            continue
+        try:
+            max_clients = int(urlserver_settings['http_max_clients'])
+        except:
+            max_clients = 0
+        if 0 < max_clients <= len(urlserver['clients']):
+            if urlserver_settings['debug'] == 'on':
+                weechat.prnt('', 'urlserver: too many clients')
+            conn.close()
+            continue
+        conn.setblocking(False)
+        client_fd = conn.fileno()
+        urlserver['clients'][client_fd] = {
+            'conn': conn,
+            'fd': client_fd,
+            'input': b'',
+            'output': b'',
+            'skip': 0,
+            'closing': False,
+            'time': time.time(),
+            'hook_read': weechat.hook_fd(client_fd, 1, 0, 0,
+                                         'urlserver_client_read_cb', ''),
+            'hook_write': '',
+        }
+    return weechat.WEECHAT_RC_OK
+
+
+def urlserver_client_close(fd):
+    """Close connection with a client."""
+    global urlserver
+    client = urlserver['clients'].pop(fd, None)
+    if not client:
+        return
+    for hook in ('hook_read', 'hook_write'):
+        if client[hook]:
+            weechat.unhook(client[hook])
+    try:
+        client['conn'].close()
+    except socket.error:
+        pass
+
+
+def urlserver_client_flush(client):
+    """
+    Send pending data to client, without blocking: if the socket is full, the
+    remaining data is sent when the socket is writable again.
+    """
+    try:
+        while client['output']:
+            sent = client['conn'].send(client['output'])
+            client['output'] = client['output'][sent:]
+    except socket.error as e:
+        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            urlserver_client_close(client['fd'])
+            return
+    if client['output']:
+        if not client['hook_write']:
+            client['hook_write'] = weechat.hook_fd(
+                client['fd'], 0, 1, 0, 'urlserver_client_write_cb', '')
+    else:
+        if client['hook_write']:
+            weechat.unhook(client['hook_write'])
+            client['hook_write'] = ''
+        if client['closing']:
+            urlserver_client_close(client['fd'])
+        elif not client['hook_read']:
+            # replies are sent, read requests again
+            client['hook_read'] = weechat.hook_fd(
+                client['fd'], 1, 0, 0, 'urlserver_client_read_cb', '')
+            urlserver_client_handle_input(client)
+
+
+def urlserver_client_send(client, data):
+    """Queue data for a client and send as much as possible."""
+    if client['output'] and \
+            len(client['output']) + len(data) > urlserver_output_max:
         if urlserver_settings['debug'] == 'on':
-            weechat.prnt('', 'urlserver: IP not allowed')
-        conn.close()
+            weechat.prnt('', 'urlserver: client does not read replies')
+        urlserver_client_close(client['fd'])
+        return
+    client['output'] += data
+    client['time'] = time.time()
+    urlserver_client_flush(client)
+
+
+def urlserver_client_write_cb(data, fd):
+    """Callback for client socket writable."""
+    global urlserver
+    client = urlserver['clients'].get(fd)
+    if client:
+        urlserver_client_flush(client)
+    return weechat.WEECHAT_RC_OK
+
+
+def urlserver_client_read_cb(data, fd):
+    """Callback for data received from a client: handle complete requests."""
+    global urlserver
+    client = urlserver['clients'].get(fd)
+    if not client:
         return weechat.WEECHAT_RC_OK
-    data = None
     try:
-        conn.settimeout(0.3)
-        data = conn.recv(4096).decode('utf-8')
-        data = data.replace('\r\n', '\n')
-    except:
+        received = client['conn'].recv(4096)
+    except socket.error as e:
+        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            urlserver_client_close(fd)
         return weechat.WEECHAT_RC_OK
+    if not received:
+        # connection closed by client
+        urlserver_client_close(fd)
+        return weechat.WEECHAT_RC_OK
+    client['input'] += received
+    client['time'] = time.time()
+    urlserver_client_handle_input(client)
+    return weechat.WEECHAT_RC_OK
+
+
+def urlserver_client_handle_input(client):
+    """
+    Handle complete requests received from a client, until a reply can not be
+    sent right away: then the client is not read any more until the reply is
+    sent (see urlserver_client_flush).
+    """
+    global urlserver
+    fd = client['fd']
+    while fd in urlserver['clients'] and not client['closing'] \
+            and not client['output']:
+        if client['skip']:
+            # ignore body of request
+            skipped = min(client['skip'], len(client['input']))
+            client['input'] = client['input'][skipped:]
+            client['skip'] -= skipped
+            if client['skip']:
+                break
+        end = client['input'].find(b'\r\n\r\n')
+        if end < 0:
+            end = client['input'].find(b'\n\n')
+            separator_length = 2
+        else:
+            separator_length = 4
+        if end < 0:
+            if len(client['input']) > 16384:
+                # headers are too long, probably not a HTTP client
+                urlserver_client_close(fd)
+            break
+        request = client['input'][:end].decode('utf-8', 'replace')
+        client['input'] = client['input'][end + separator_length:]
+        request = request.replace('\r\n', '\n')
+        length = re.search(r'^Content-Length:\s*(\d+)', request,
+                           re.MULTILINE | re.IGNORECASE)
+        if length:
+            client['skip'] = int(length.group(1))
+        urlserver_server_handle_request(client, request)
+    if fd in urlserver['clients'] and client['output'] and client['hook_read']:
+        weechat.unhook(client['hook_read'])
+        client['hook_read'] = ''
+
+
+def urlserver_timer_cb(data, remaining_calls):
+    """Close idle connections."""
+    global urlserver, urlserver_settings
+    try:
+        timeout = int(urlserver_settings['http_keep_alive_timeout'])
+    except:
+        timeout = 30
+    now = time.time()
+    for fd, client in list(urlserver['clients'].items()):
+        if now - client['time'] > timeout:
+            urlserver_client_close(fd)
+    return weechat.WEECHAT_RC_OK
+
+
+def urlserver_server_handle_request(client, data):
+    """Reply to a HTTP request."""
+    global urlserver, urlserver_settings
+    # HTTP/1.1 connections are persistent by default, not HTTP/1.0 ones
+    version = re.search(r'^\S+ \S+ HTTP/(\d+\.\d+)', data)
+    connection = re.search(r'^Connection:\s*(\S+)', data,
+                           re.MULTILINE | re.IGNORECASE)
+    connection = connection.group(1).lower() if connection else ''
+    if version and version.group(1) != '1.0':
+        client['closing'] = connection == 'close'
+    else:
+        client['closing'] = connection != 'keep-alive'
     replysent = False
     sort = '-time'
+    page = 1
+    search = ''
     referer = re.search('^Referer:', data, re.MULTILINE | re.IGNORECASE)
     m = re.search('^GET /(.*) HTTP/.*$', data, re.MULTILINE)
     if m:
@@ -664,7 +1018,7 @@ def urlserver_server_fd_cb(data, fd):
         if urlserver_settings['debug'] == 'on':
             weechat.prnt('', 'urlserver: %s' % m.group(0))
         if 'favicon.' in url:
-            urlserver_server_reply(conn, '200 OK', '',
+            urlserver_server_reply(client, '200 OK', '',
                                    urlserver_server_favicon(),
                                    mimetype='image/x-icon')
             replysent = True
@@ -680,9 +1034,15 @@ def urlserver_server_fd_cb(data, fd):
                     prefixok = False
             # prefix ok, go on with url
             if prefixok:
-                if url.startswith('sort='):
-                    # sort asked for list of urls
-                    sort = url[5:]
+                if url.startswith(('?', 'sort=', 'page=', 'search=')):
+                    # sort/page/search asked for list of urls
+                    params = parse_qs(url.lstrip('?'))
+                    sort = params.get('sort', [sort])[0].strip()
+                    try:
+                        page = int(params.get('page', [page])[0])
+                    except ValueError:
+                        pass
+                    search = params.get('search', [search])[0].strip()
                     url = ''
                 if url:
                     # short url, read base62 key and redirect to page
@@ -702,38 +1062,42 @@ def urlserver_server_fd_cb(data, fd):
                             # otherwise, we can make redirection with HTTP 302
                             if referer:
                                 urlserver_server_reply(
-                                    conn, '200 OK', '',
+                                    client, '200 OK', '',
                                     '<meta name="referrer" content="never">\n'
                                     '<meta http-equiv="refresh" content="0; '
                                     'url=%s">' % urlserver['urls'][number][3])
                             else:
-                                conn.sendall(
+                                urlserver_client_send(
+                                    client,
                                     'HTTP/1.1 302\r\n'
-                                    'Location: {}\r\n\r\n'
-                                    .format(urlserver['urls'][number][3])
+                                    'Location: {}\r\n'
+                                    'Content-Length: 0\r\n'
+                                    'Connection: {}\r\n\r\n'
+                                    .format(urlserver['urls'][number][3],
+                                            'close' if client['closing']
+                                            else 'keep-alive')
                                     .encode('utf-8'))
                         else:
-                            urlserver_server_reply_auth_required(conn)
+                            urlserver_server_reply_auth_required(client)
                         replysent = True
                 else:
                     # page with list of urls
                     if urlserver_check_auth(data):
-                        urlserver_server_reply_list(conn, sort)
+                        urlserver_server_reply_list(client, sort, page,
+                                                    search)
                     else:
-                        urlserver_server_reply_auth_required(conn)
+                        urlserver_server_reply_auth_required(client)
                     replysent = True
             else:
                 if urlserver_settings['debug'] == 'on':
                     weechat.prnt('', 'urlserver: prefix missing')
     if not replysent:
-        urlserver_server_reply(conn,
+        urlserver_server_reply(client,
                                '404 Not found', '',
                                '<html>\n'
                                '<head><title>Page not found</title></head>\n'
                                '<body><h1>Page not found</h1></body>\n'
                                '</html>')
-    conn.close()
-    return weechat.WEECHAT_RC_OK
 
 
 def urlserver_server_status():
@@ -768,9 +1132,15 @@ def urlserver_server_start():
         urlserver_server_status()
         return
     urlserver['socket'].listen(5)
+    urlserver['socket'].setblocking(False)
+    # base URL in HTML pages depends on the port
+    urlserver['html_pages'] = {}
+    urlserver['base_url'] = ''
     urlserver['hook_fd'] = weechat.hook_fd(urlserver['socket'].fileno(),
                                            1, 0, 0,
                                            'urlserver_server_fd_cb', '')
+    urlserver['hook_timer'] = weechat.hook_timer(5 * 1000, 0, 0,
+                                                 'urlserver_timer_cb', '')
     urlserver_server_status()
 
 
@@ -778,9 +1148,15 @@ def urlserver_server_stop():
     """Stop mini HTTP server."""
     global urlserver
     if urlserver['socket'] or urlserver['hook_fd']:
+        for fd in list(urlserver['clients']):
+            urlserver_client_close(fd)
+        if urlserver['hook_timer']:
+            weechat.unhook(urlserver['hook_timer'])
+            urlserver['hook_timer'] = None
         if urlserver['socket']:
             urlserver['socket'].close()
             urlserver['socket'] = None
+            urlserver['base_url'] = ''
         if urlserver['hook_fd']:
             weechat.unhook(urlserver['hook_fd'])
             urlserver['hook_fd'] = None
@@ -862,6 +1238,8 @@ def urlserver_cmd_cb(data, buffer, args):
     elif args == 'clear':
         urlserver['urls'] = {}
         urlserver['number'] = 0
+        urlserver_index_rebuild()
+        urlserver_write_urls()
         weechat.prnt('', 'urlserver: list cleared')
     else:
         urlserver_open_buffer()
@@ -873,10 +1251,12 @@ def urlserver_update_urllist(buffer_full_name, buffer_short_name, tags, prefix,
     """Update urls list and return a list of short urls for message."""
     global urlserver, urlserver_settings
 
+    if not urlserver['filters']:
+        urlserver_filters_compile()
+    filters = urlserver['filters']
+
     # skip ignored buffers
-    if urlserver_settings['msg_ignore_buffers'] and \
-            buffer_full_name in (urlserver_settings['msg_ignore_buffers']
-                                 .split(',')):
+    if buffer_full_name in filters['ignore_buffers']:
         return None
 
     listtags = []
@@ -884,28 +1264,21 @@ def urlserver_update_urllist(buffer_full_name, buffer_short_name, tags, prefix,
         listtags = tags.split(',')
 
         # skip ignored tags
-        if urlserver_settings['msg_ignore_tags']:
-            for itag in urlserver_settings['msg_ignore_tags'].split(','):
-                for tag in listtags:
-                    if tag.startswith(itag):
-                        return None
+        if filters['ignore_tags'] and \
+                urlserver_tags_matching(listtags, filters['ignore_tags']):
+            return None
 
         # exit if a required tag is missing
-        if urlserver_settings['msg_require_tags']:
-            for rtag in urlserver_settings['msg_require_tags'].split(','):
-                tagfound = False
-                for tag in listtags:
-                    if tag.startswith(rtag):
-                        tagfound = True
-                        break
-                if not tagfound:
-                    return None
+        if filters['require_tags'] and \
+                len(urlserver_tags_matching(listtags,
+                                            filters['require_tags'])) < \
+                filters['require_tags_count']:
+            return None
 
     # ignore message is matching the "msg_ignore_regex"
-    if urlserver_settings['msg_ignore_regex']:
-        if re.search(urlserver_settings['msg_ignore_regex'],
-                     prefix + '\t' + message):
-            return None
+    if filters['ignore_regex'] and \
+            filters['ignore_regex'].search(prefix + '\t' + message):
+        return None
 
     # extract nick from tags
     if not nick:
@@ -916,14 +1289,10 @@ def urlserver_update_urllist(buffer_full_name, buffer_short_name, tags, prefix,
                 break
 
     # get URL min length
-    min_length = 0
-    try:
-        min_length = int(urlserver_settings['url_min_length'])
+    min_length = filters['min_length']
+    if min_length == -1:
         # Detect the minimum length based on shorten url length
-        if min_length == -1:
-            min_length = len(urlserver_short_url(urlserver['number'])) + 1
-    except:
-        min_length = 0
+        min_length = len(urlserver_short_url(urlserver['number'])) + 1
 
     # shorten URL(s) in message
     urls_short = []
@@ -996,26 +1365,78 @@ def urlserver_update_urllist(buffer_full_name, buffer_short_name, tags, prefix,
                     buffer_short_name,
                     url,
                     '%s\t%s' % (prefix, message))
+                urlserver_index_add(number)
+                urlserver_journal_add(number)
                 urls_short.append(urlserver_short_url(number))
                 if urlserver['buffer']:
                     urlserver_display_url_detail(number)
                 urlserver['number'] += 1
 
     # remove old URLs if we have reach max list size
-    urls_amount = 50
-    try:
-        urls_amount = int(urlserver_settings['urls_amount'])
-        if urls_amount <= 0:
-            urls_amount = 50
-    except:
-        urls_amount = 50
+    urls_amount = urlserver_get_urls_amount()
     while len(urlserver['urls']) > urls_amount:
-        keys = sorted(urlserver['urls'])
-        del urlserver['urls'][keys[0]]
+        key = urlserver['index']['time'][0]
+        urlserver_index_remove(key)
+        del urlserver['urls'][key]
 
     return urls_short
 
 
+def urlserver_tag_prefixes(option):
+    """
+    Return beginnings of tags in a comma-separated list, as a dict:
+    {length: set of beginnings of tags with this length}.
+    """
+    prefixes = {}
+    if option:
+        for tag in option.split(','):
+            prefixes.setdefault(len(tag), set()).add(tag)
+    return prefixes
+
+
+def urlserver_tags_matching(tags, prefixes):
+    """
+    Return set of beginnings of tags (from urlserver_tag_prefixes) matching
+    at least one of the tags.
+    """
+    return set(tag[:length]
+               for tag in tags
+               for length, group in prefixes.items()
+               if tag[:length] in group)
+
+
+def urlserver_filters_compile():
+    """Compile filters on messages, using script options."""
+    global urlserver, urlserver_settings
+    filters = {
+        'ignore_buffers': set(),
+        'ignore_tags': urlserver_tag_prefixes(
+            urlserver_settings['msg_ignore_tags']),
+        'require_tags': urlserver_tag_prefixes(
+            urlserver_settings['msg_require_tags']),
+        'ignore_regex': None,
+        'min_length': 0,
+    }
+    if urlserver_settings['msg_ignore_buffers']:
+        filters['ignore_buffers'] = set(
+            urlserver_settings['msg_ignore_buffers'].split(','))
+    filters['require_tags_count'] = sum(
+        len(group) for group in filters['require_tags'].values())
+    if urlserver_settings['msg_ignore_regex']:
+        try:
+            filters['ignore_regex'] = re.compile(
+                urlserver_settings['msg_ignore_regex'])
+        except Exception as e:
+            weechat.prnt('', '%surlserver: invalid regex in option '
+                         '"msg_ignore_regex": %s'
+                         % (weechat.prefix('error'), e))
+    try:
+        filters['min_length'] = int(urlserver_settings['url_min_length'])
+    except:
+        filters['min_length'] = 0
+    urlserver['filters'] = filters
+
+
 def urlserver_print_cb(data, buffer, time, tags, displayed, highlight, prefix,
                        message):
     """
@@ -1118,15 +1539,21 @@ def urlserver_modifier_irc_cb(data, modifier, modifier_data, string):
 
 def urlserver_config_cb(data, option, value):
     """Called when a script option is changed."""
-    global urlserver_settings
+    global urlserver, urlserver_settings
     pos = option.rfind('.')
     if pos > 0:
         name = option[pos+1:]
         if name in urlserver_settings:
+            # HTML and base URL depend on options
+            urlserver['html_rows'] = {}
+            urlserver['html_pages'] = {}
+            urlserver['base_url'] = ''
             if name == 'http_allowed_ips':
                 urlserver_settings[name] = re.compile(value)
             else:
                 urlserver_settings[name] = value
+                if name.startswith('msg_') or name == 'url_min_length':
+                    urlserver_filters_compile()
                 if name in ('http_hostname', 'http_port'):
                     # don't restart if autostart is disabled and server isn't
                     # already running
@@ -1137,7 +1564,7 @@ def urlserver_config_cb(data, option, value):
 
 
 def urlserver_filename():
-    """Return name of file used to store list of urls."""
+    """Return name of file used to store list of urls (compacted snapshot)."""
     options = {
         'directory': 'data',
     }
@@ -1145,39 +1572,136 @@ def urlserver_filename():
                                          {}, {}, options)
 
 
+def urlserver_journal_filename():
+    """Return name of file with URLs added since last snapshot."""
+    options = {
+        'directory': 'data',
+    }
+    return weechat.string_eval_path_home('%h/urlserver_journal.txt',
+                                         {}, {}, options)
+
+
+def urlserver_get_urls_amount():
+    """Return max number of URLs to keep."""
+    global urlserver_settings
+    try:
+        urls_amount = int(urlserver_settings['urls_amount'])
+        if urls_amount <= 0:
+            urls_amount = 50
+    except:
+        urls_amount = 50
+    return urls_amount
+
+
+def urlserver_read_url_lines(filename):
+    """
+    Read URLs from a file with one JSON list per line:
+    [number, time, nick, buffer, url, message].
+    Invalid lines (for example a line partially written in a crash) are
+    ignored.
+    """
+    global urlserver
+    with open(filename, 'r') as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+                urlserver['urls'][int(item[0])] = tuple(item[1:6])
+            except (ValueError, TypeError, IndexError):
+                pass
+
+
 def urlserver_read_urls():
-    """Read file with URLs."""
+    """Read snapshot and journal with URLs."""
     global urlserver
-    filename = urlserver_filename()
-    if os.path.isfile(filename):
-        urlserver['number'] = 0
+    urlserver['urls'] = {}
+    for filename in (urlserver_filename(), urlserver_journal_filename()):
+        if not os.path.isfile(filename):
+            continue
         try:
-            urlserver['urls'] = ast.literal_eval(open(filename, 'r').read())
-            keys = sorted(urlserver['urls'])
-            if keys:
-                urlserver['number'] = keys[-1] + 1
+            with open(filename, 'r') as f:
+                old_format = f.read(1) == '{'
+            if old_format:
+                # file written by urlserver < 2.7 (python dict)
+                urlserver['urls'].update(
+                    ast.literal_eval(open(filename, 'r').read()))
             else:
-                urlserver['number'] = 0
+                urlserver_read_url_lines(filename)
         except:
             weechat.prnt('', '%surlserver: error reading file "%s"' % (
                 weechat.prefix('error'),
                 filename))
+    keys = sorted(urlserver['urls'])
+    if keys:
+        urlserver['number'] = keys[-1] + 1
+    else:
+        urlserver['number'] = 0
+    for key in keys[:-urlserver_get_urls_amount()]:
+        del urlserver['urls'][key]
+    urlserver_index_rebuild()
+    # journal is compacted on startup, so its size never exceeds the number of
+    # URLs added during one session (or "urls_amount" URLs)
+    urlserver_write_urls()
+
+
+def urlserver_journal_close():
+    """Close journal file."""
+    global urlserver
+    if urlserver['journal']:
+        urlserver['journal'].close()
+        urlserver['journal'] = None
+
+
+def urlserver_journal_add(number):
+    """Append an URL to the journal, compact it if it's too big."""
+    global urlserver
+    if urlserver['journal_entries'] >= urlserver_get_urls_amount():
+        urlserver_write_urls()
+    if not urlserver['journal']:
+        return
+    try:
+        urlserver['journal'].write(
+            '%s\n' % json.dumps([number] + list(urlserver['urls'][number])))
+        urlserver['journal'].flush()
+        urlserver['journal_entries'] += 1
+    except (IOError, OSError) as e:
+        weechat.prnt('', '%surlserver: error writing file "%s": %s' % (
+            weechat.prefix('error'),
+            urlserver_journal_filename(),
+            e))
+        urlserver_journal_close()
 
 
 def urlserver_write_urls():
-    """Write file with URLs."""
+    """
+    Write file with URLs (snapshot) and empty the journal.
+    The snapshot is written in a temporary file, which is then renamed, so a
+    crash can not lose URLs.
+    """
     global urlserver
-    keys = sorted(urlserver['urls'])
-    content = '{\n%s\n}\n' % '\n'.join([
-        '  %d: %s,' % (key, str(urlserver['urls'][key])) for key in keys
-    ])
-    open(urlserver_filename(), 'w').write(content)
+    urlserver_journal_close()
+    filename = urlserver_filename()
+    try:
+        with open(filename + '.tmp', 'w') as f:
+            for key in sorted(urlserver['urls']):
+                f.write('%s\n' % json.dumps([key] +
+                                            list(urlserver['urls'][key])))
+        if os.path.isfile(filename) and sys.platform.startswith('win'):
+            os.remove(filename)
+        os.rename(filename + '.tmp', filename)
+        urlserver['journal'] = open(urlserver_journal_filename(), 'w')
+        urlserver['journal_entries'] = 0
+    except (IOError, OSError) as e:
+        weechat.prnt('', '%surlserver: error writing file "%s": %s' % (
+            weechat.prefix('error'),
+            filename,
+            e))
 
 
 def urlserver_end():
     """Script unloaded (oh no, why?)"""
     urlserver_server_stop()
-    urlserver_write_urls()
+    # URLs are already saved in the journal
+    urlserver_journal_close()
     return weechat.WEECHAT_RC_OK
 
 if __name__ == '__main__' and import_ok:
@@ -1196,6 +1720,8 @@ if __name__ == '__main__' and import_ok:
                     option,
                     '%s (default: "%s")' % (value[1], value[0]))
 
+        urlserver_filters_compile()
+
         # detect config changes
         weechat.hook_config('plugins.var.python.%s.*' % SCRIPT_NAME,
                             'urlserver_config_cb', '')
@@ -14,7 +14,7 @@ import time
 import urllib.request
 import weechat
 
-from collections import namedtuple
+from collections import OrderedDict, deque, namedtuple
 from functools import wraps
 from ssl import SSLWantReadError
 from websocket import (create_connection, WebSocketConnectionClosedException,
@@ -950,31 +950,37 @@ def is_post_line_data(line_data, post_id):
         if tag.startswith(post_id_tag):
             return True
 
+def get_line_data_post_id(line_data):
+    for tag in get_line_data_tags(line_data):
+        if tag.startswith("post_id_"):
+            return tag[8:]
+
+    return None
+
+def find_buffer_post_lines_pointers(buffer, post_id):
+    server = get_server_from_buffer(buffer)
+    if not server:
+        return []
+
+    channel = server.get_channel_from_buffer(buffer)
+    if not channel:
+        return []
+
+    return channel._get_lines_pointers(post_id)
+
 def find_buffer_last_post_line_data(buffer, post_id):
-    lines = weechat.hdata_pointer(weechat.hdata_get("buffer"), buffer, "lines")
-    line = weechat.hdata_pointer(weechat.hdata_get("lines"), lines, "last_line")
+    pointers = find_buffer_post_lines_pointers(buffer, post_id)
+    if not pointers:
+        return None
 
-    line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
-    while True:
-        if is_post_line_data(line_data, post_id):
-            return line_data
-        line = weechat.hdata_pointer(weechat.hdata_get("line"), line, "prev_line")
-        if "" == line:
-            return None
-        line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
+    return weechat.hdata_pointer(weechat.hdata_get("line"), pointers[-1], "data")
 
 def find_buffer_first_post_line_data(buffer, post_id):
-    lines = weechat.hdata_pointer(weechat.hdata_get("buffer"), buffer, "lines")
-    line = weechat.hdata_pointer(weechat.hdata_get("lines"), lines, "first_line")
+    pointers = find_buffer_post_lines_pointers(buffer, post_id)
+    if not pointers:
+        return None
 
-    line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
-    while True:
-        if is_post_line_data(line_data, post_id):
-            return line_data
-        line = weechat.hdata_pointer(weechat.hdata_get("line"), line, "next_line")
-        if "" == line:
-            return None
-        line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
+    return weechat.hdata_pointer(weechat.hdata_get("line"), pointers[0], "data")
 
 CHANNEL_TYPES = {
     "D": "direct",
@@ -1000,6 +1006,9 @@ class ChannelBase:
         self.name = self._format_name(kwargs["display_name"], kwargs["name"])
         self.buffer = None
         self.posts = {}
+        # post id => pointers of its lines in the buffer, in printing order
+        self.posts_lines = OrderedDict()
+        self._first_line = ""
         self.users = {}
         self._is_loading = False
         self._is_muted = None
@@ -1064,26 +1073,14 @@ class ChannelBase:
         if not post.files:
             return
 
-        lines = weechat.hdata_pointer(weechat.hdata_get("buffer"), self.buffer, "lines")
-        line = weechat.hdata_pointer(weechat.hdata_get("lines"), lines, "last_line")
-        line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
-
-        # find last line of this post
-        while line and not is_post_line_data(line_data, post_id):
-            line = weechat.hdata_pointer(weechat.hdata_get("line"), line, "prev_line")
+        # files are on the last lines of the post
+        pointers = self._get_lines_pointers(post_id)
+        for file_id, line in zip(reversed(post.files.keys()), reversed(pointers)):
             line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
-
-        for file_id in reversed(post.files.keys()):
             tags = get_line_data_tags(line_data)
             tags.append("file_id_{}".format(file_id))
             weechat.hdata_update(weechat.hdata_get("line_data"), line_data, {"tags_array": ",".join(tags)})
 
-            line = weechat.hdata_pointer(weechat.hdata_get("line"), line, "prev_line")
-            line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
-
-            if not line or not is_post_line_data(line_data, post.id): # safeguard
-                break
-
     def _prefix_thread_message(self, message, post_id, root):
         prefix_format = config.get_value("format", "thread_prefix_root") if root else config.get_value("format", "thread_prefix")
         prefix_color = config.get_value("color", "thread_prefix_root") if root else config.get_value("color", "thread_prefix")
@@ -1112,6 +1109,7 @@ class ChannelBase:
         del self.posts[post_id]
 
         pointers = self._get_lines_pointers(post_id)
+        self.posts_lines.pop(post_id, None)
         if not pointers:
             return
 
@@ -1146,16 +1144,15 @@ class ChannelBase:
             weechat.hdata_update(weechat.hdata_get("line_data"), line_data, {"message": line})
 
     def _get_lines_pointers(self, post_id):
+        self._remove_freed_lines()
+        return list(self.posts_lines.get(post_id, []))
+
+    def _add_lines_pointers(self, post_id):
         lines = weechat.hdata_pointer(weechat.hdata_get("buffer"), self.buffer, "lines")
         line = weechat.hdata_pointer(weechat.hdata_get("lines"), lines, "last_line")
         line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
 
-        # find last line of this post
-        while line and not is_post_line_data(line_data, post_id):
-            line = weechat.hdata_pointer(weechat.hdata_get("line"), line, "prev_line")
-            line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
-
-        # find all lines of this post
+        # the lines of the post just printed are the last ones of the buffer
         pointers = []
         while line and is_post_line_data(line_data, post_id):
             pointers.append(line)
@@ -1163,7 +1160,37 @@ class ChannelBase:
             line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
         pointers.reverse()
 
-        return pointers
+        self.posts_lines.pop(post_id, None)
+        if pointers:
+            self.posts_lines[post_id] = pointers
+
+    def _remove_freed_lines(self):
+        # WeeChat frees the oldest lines of a buffer when it has too many of
+        # them, or all of them when it is cleared, so forget about the posts
+        # printed before the first remaining one
+        lines = weechat.hdata_pointer(weechat.hdata_get("buffer"), self.buffer, "lines")
+        first_line = weechat.hdata_pointer(weechat.hdata_get("lines"), lines, "first_line")
+        if first_line == self._first_line:
+            return
+        self._first_line = first_line
+
+        line = first_line
+        while line:
+            line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
+            post_id = get_line_data_post_id(line_data)
+            if post_id in self.posts_lines and line in self.posts_lines[post_id]:
+                break
+            line = weechat.hdata_pointer(weechat.hdata_get("line"), line, "next_line")
+
+        if not line:
+            self.posts_lines.clear()
+            return
+
+        while next(iter(self.posts_lines)) != post_id:
+            self.posts_lines.popitem(last=False)
+
+        pointers = self.posts_lines[post_id]
+        self.posts_lines[post_id] = pointers[pointers.index(line):]
 
     def write_post(self, post):
         self.posts[post.id] = post
@@ -1202,6 +1229,7 @@ class ChannelBase:
 
         weechat.prnt_date_tags(self.buffer, date, tags, prefix + message)
 
+        self._add_lines_pointers(post.id)
         self._update_file_tags(post.id)
 
         self.last_post_id = post.id
@@ -1403,7 +1431,8 @@ def hydrate_channel_posts_cb(buffer, command, rc, out, err):
 
     channel = server.get_channel_from_buffer(buffer)
 
-    response = json.loads(out)
+    # decoded by EventRouter, see STREAMED_JSON_CALLBACKS
+    response = out
 
     if not response["order"]:
         channel.set_loading(False)
@@ -1524,7 +1553,8 @@ def update_custom_emojis(data, command, rc, out, err):
         server.print_error("An error occurred while updating custom emojis")
         return weechat.WEECHAT_RC_ERROR
 
-    response = json.loads(out)
+    # decoded by EventRouter, see STREAMED_JSON_CALLBACKS
+    response = out
 
     for emoji in response:
         server.custom_emojis.append(emoji["name"])
@@ -1822,6 +1852,8 @@ class Server:
     def unload(self):
         self.print("Unloading server")
 
+        EVENTROUTER.forget_server(self.id)
+
         if self.worker:
             close_worker(self.worker)
         if self.reconnection_loop_hook:
@@ -1964,7 +1996,8 @@ def connect_server_users_cb(data, command, rc, out, err):
         server.print_error("An error occurred while connecting users")
         return weechat.WEECHAT_RC_ERROR
 
-    response = json.loads(out)
+    # decoded by EventRouter, see STREAMED_JSON_CALLBACKS
+    response = out
     for user in response:
         if user["id"] == server.me.id:
             server.users[user["id"]] = server.me
@@ -2148,23 +2181,202 @@ def singularity_cb(buffer, command, rc, out, err):
 
     return weechat.WEECHAT_RC_OK
 
+# callbacks which get their response already decoded from JSON, decoding
+# it while it is received; the value is the names of the members of the
+# response object whose items are also decoded one by one
+STREAMED_JSON_CALLBACKS = {
+    "connect_server_users_cb": (),
+    "hydrate_channel_posts_cb": ("posts",),
+    "update_custom_emojis": (),
+}
+
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+# Decodes a JSON array or object from chunks of text as they are received,
+# so that a big response isn't decoded all at once when it is complete
+class JSONStreamDecoder:
+    def __init__(self, stream_keys=()):
+        self.stream_keys = stream_keys
+        self.decoder = json.JSONDecoder()
+        self.text = ""
+        self.position = 0
+        # containers being decoded, as [container, state, key] lists
+        self.stack = []
+        self.result = None
+        self.done = False
+
+    def feed(self, chunk):
+        # only keep the part of the text not decoded yet
+        self.text = self.text[self.position:] + chunk
+        self.position = 0
+
+        while not self.done and self._decode_next():
+            pass
+
+    def finish(self):
+        if not self.done:
+            raise ValueError("Incomplete JSON response")
+
+        return self.result
+
+    def _decode_next(self):
+        self.position = JSON_WHITESPACE.match(self.text, self.position).end()
+        if self.position >= len(self.text):
+            return False
+
+        char = self.text[self.position]
+
+        if not self.stack:
+            if char not in "[{":
+                raise ValueError("Expecting JSON array or object")
+            self._open(char)
+            return True
+
+        frame = self.stack[-1]
+        container, state, key = frame
+        closing_char = "]" if isinstance(container, list) else "}"
+
+        if state == "after":
+            if char == ",":
+                frame[1] = "next"
+            elif char == closing_char:
+                self._close()
+                return True
+            else:
+                raise ValueError("Expecting ',' or '{}'".format(closing_char))
+            self.position += 1
+            return True
+
+        if state == "first" and char == closing_char:
+            self._close()
+            return True
+
+        if isinstance(container, dict) and state in ["first", "next"]:
+            if char != '"':
+                raise ValueError("Expecting property name")
+            try:
+                key, end = self.decoder.raw_decode(self.text, self.position)
+            except ValueError:
+                return False
+            frame[1:] = ["colon", key]
+            self.position = end
+            return True
+
+        if state == "colon":
+            if char != ":":
+                raise ValueError("Expecting ':'")
+            frame[1] = "value"
+            self.position += 1
+            return True
+
+        # only the members of the top level object can be streamed
+        if len(self.stack) == 1 and key in self.stream_keys and char in "[{":
+            self._open(char)
+            return True
+
+        try:
+            value, end = self.decoder.raw_decode(self.text, self.position)
+        except ValueError:
+            return False
+        # a number could continue in the next chunk
+        if end >= len(self.text) or self.text[end] not in " \t\n\r,]}":
+            return False
+
+        self.position = end
+        self._add_value(value)
+        frame[1] = "after"
+        return True
+
+    def _open(self, char):
+        container = [] if char == "[" else {}
+        if self.stack:
+            self._add_value(container)
+        else:
+            self.result = container
+
+        self.stack.append([container, "first", None])
+        self.position += 1
+
+    def _close(self):
+        self.stack.pop()
+        self.position += 1
+
+        if self.stack:
+            self.stack[-1][1] = "after"
+        else:
+            self.done = True
+
+    def _add_value(self, value):
+        container, state, key = self.stack[-1]
+        if isinstance(container, list):
+            container.append(value)
+        else:
+            container[key] = value
+
 def build_buffer_cb_data(url, cb, cb_data):
-    return "{}|{}|{}".format(url, cb, cb_data)
+    return "{}|{}|{}".format(EVENTROUTER.new_response_buffer_name(url), cb, cb_data)
 
 class EventRouter:
     def __init__(self):
-        self.enqueued_requests = []
+        # server id => (requests for the visible buffer, other requests)
+        self.enqueued_requests = {}
+        self.requests_in_flight = {}
+        self.dispatching_server_id = None
+        self.response_servers = {}
+        self.response_count = 0
         self.response_buffers = {}
+        self.response_decoders = {}
 
     def enqueue_request(self, method, *params):
-        self.enqueued_requests.append([method, params])
+        server = next((p for p in params if isinstance(p, Server)), None)
+        server_id = server.id if server else ""
 
-    def handle_next(self):
-        if not self.enqueued_requests:
-            return
+        current_buffer = weechat.current_buffer()
+        channel = server.get_channel_from_buffer(current_buffer) if server else None
+        visible = current_buffer in params or (channel is not None and channel.id in params)
 
-        request = self.enqueued_requests.pop(0)
-        eval(request[0])(*request[1])
+        queues = self.enqueued_requests.setdefault(server_id, (deque(), deque()))
+        queues[0 if visible else 1].append((globals()[method], params))
+
+    def handle_next(self):
+        for server_id, queues in list(self.enqueued_requests.items()):
+            for queue in queues:
+                while queue and self.requests_in_flight.get(server_id, 0) < MAX_REQUESTS_IN_FLIGHT:
+                    method, params = queue.popleft()
+                    self.dispatching_server_id = server_id
+                    try:
+                        method(*params)
+                    finally:
+                        self.dispatching_server_id = None
+
+            if not queues[0] and not queues[1]:
+                del self.enqueued_requests[server_id]
+
+    def new_response_buffer_name(self, url):
+        self.response_count += 1
+        response_buffer_name = "{}#{}".format(url, self.response_count)
+
+        # requests run directly rather than through the queue are not counted
+        if self.dispatching_server_id is not None:
+            server_id = self.dispatching_server_id
+            self.requests_in_flight[server_id] = self.requests_in_flight.get(server_id, 0) + 1
+            self.response_servers[response_buffer_name] = server_id
+
+        return response_buffer_name
+
+    def release_response(self, response_buffer_name):
+        server_id = self.response_servers.pop(response_buffer_name, None)
+        if server_id is not None:
+            self.requests_in_flight[server_id] -= 1
+
+    # the requests of a server which disconnected are dropped, and the
+    # responses still coming for it don't free slots any more
+    def forget_server(self, server_id):
+        self.enqueued_requests.pop(server_id, None)
+        self.requests_in_flight.pop(server_id, None)
+        for response_buffer_name, response_server_id in list(self.response_servers.items()):
+            if response_server_id == server_id:
+                del self.response_servers[response_buffer_name]
 
     def buffered_response_cb(self, data, command, rc, out, err):
         arg_search = re.search("([^\|]*)\|([^\|]*)\|(.*)", data)
@@ -2173,24 +2385,56 @@ class EventRouter:
         real_data = arg_search.group(3)
 
         if not response_buffer_name in self.response_buffers:
-            self.response_buffers[response_buffer_name] = ""
+            self.response_buffers[response_buffer_name] = []
+            if real_cb in STREAMED_JSON_CALLBACKS:
+                self.response_decoders[response_buffer_name] = JSONStreamDecoder(STREAMED_JSON_CALLBACKS[real_cb])
+
+        self.response_buffers[response_buffer_name].append(out)
+
+        decoder = self.response_decoders.get(response_buffer_name)
+        if decoder:
+            try:
+                decoder.feed(out)
+            except ValueError:
+                # decoded from the whole text at the end instead, which
+                # raises the same error as without streaming
+                decoder = self.response_decoders[response_buffer_name] = None
 
         if rc == weechat.WEECHAT_HOOK_PROCESS_RUNNING:
-            self.response_buffers[response_buffer_name] += out
             return weechat.WEECHAT_RC_OK
 
-        response = self.response_buffers[response_buffer_name] + out
-        del self.response_buffers[response_buffer_name]
+        chunks = self.response_buffers.pop(response_buffer_name)
+        self.response_decoders.pop(response_buffer_name, None)
 
-        return eval(real_cb)(real_data, command, rc, response, err)
+        self.release_response(response_buffer_name)
+
+        try:
+            if real_cb in STREAMED_JSON_CALLBACKS and rc == 0:
+                response = decoder.finish() if decoder else json.loads("".join(chunks))
+            else:
+                response = "".join(chunks)
+
+            return globals()[real_cb](real_data, command, rc, response, err)
+        finally:
+            # a slot is free again, don't wait for the next timer tick
+            self.handle_next()
 
 def handle_queued_request_cb(data, remaining_calls):
     EVENTROUTER.handle_next()
     return weechat.WEECHAT_RC_OK
 
+def hook_process_hashtable(command, options, timeout, callback, callback_data):
+    hook = weechat.hook_process_hashtable(command, options, timeout, callback, callback_data)
+
+    # the callback won't be called, so it won't free the request slot
+    if not hook and callback == "buffered_response_cb":
+        EVENTROUTER.release_response(callback_data.split("|", 1)[0])
+
+    return hook
+
 def run_get_user_teams(server, cb, cb_data):
     url = server.url + "/api/v4/users/me/teams"
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "failonerror": "1",
@@ -2203,7 +2447,7 @@ def run_get_user_teams(server, cb, cb_data):
 
 def run_get_team(team_id, server, cb, cb_data):
     url = server.url + "/api/v4/teams/{}".format(team_id)
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "failonerror": "1",
@@ -2216,7 +2460,7 @@ def run_get_team(team_id, server, cb, cb_data):
 
 def run_get_users(server, page, cb, cb_data):
     url = server.url + "/api/v4/users?per_page=200&page={}".format(str(page))
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "failonerror": "1",
@@ -2229,7 +2473,7 @@ def run_get_users(server, page, cb, cb_data):
 
 def run_get_user(server, user_id, cb, cb_data):
     url = server.url + "/api/v4/users/{}".format(user_id)
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "failonerror": "1",
@@ -2242,7 +2486,7 @@ def run_get_user(server, user_id, cb, cb_data):
 
 def run_get_custom_emojis(server, page, cb, cb_data):
     url = server.url + "/api/v4/emoji?per_page=150&page={}".format(str(page))
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "failonerror": "1",
@@ -2281,7 +2525,7 @@ def run_user_login(server, cb, cb_data):
             return weechat.WEECHAT_RC_ERROR
         params["token"] = token
 
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "failonerror": "1",
@@ -2295,7 +2539,7 @@ def run_user_login(server, cb, cb_data):
 
 def run_get_channel(channel_id, server, cb, cb_data):
     url = server.url + "/api/v4/channels/{}".format(channel_id)
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "failonerror": "1",
@@ -2308,7 +2552,7 @@ def run_get_channel(channel_id, server, cb, cb_data):
 
 def run_get_user_team_channels(team_id, server, cb, cb_data):
     url = server.url + "/api/v4/users/me/teams/{}/channels".format(team_id)
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "failonerror": "1",
@@ -2329,7 +2573,7 @@ def run_post_post(post, server, cb, cb_data):
     if "root_id" in post:
         params["root_id"] = post["root_id"]
 
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "failonerror": "1",
@@ -2349,7 +2593,7 @@ def run_post_command(team_id, channel_id, command, server, cb, cb_data):
         "command": command,
     }
 
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "failonerror": "1",
@@ -2363,7 +2607,7 @@ def run_post_command(team_id, channel_id, command, server, cb, cb_data):
 
 def run_get_channel_posts_around_oldest_unread(channel_id, server, cb, cb_data):
     url = server.url + "/api/v4/users/me/channels/{}/posts/unread".format(channel_id)
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "failonerror": "1",
@@ -2380,7 +2624,7 @@ def run_get_channel_posts_after(post_id, channel_id, server, cb, cb_data):
     else:
         url = server.url + "/api/v4/channels/{}/posts".format(channel_id)
 
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "failonerror": "1",
@@ -2393,7 +2637,7 @@ def run_get_channel_posts_after(post_id, channel_id, server, cb, cb_data):
 
 def run_get_channel_members(channel_id, server, page, cb, cb_data):
     url = server.url + "/api/v4/channels/{}/members?per_page=200&page={}".format(channel_id, str(page))
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "failonerror": "1",
@@ -2406,7 +2650,7 @@ def run_get_channel_members(channel_id, server, page, cb, cb_data):
 
 def run_get_user_channel_members(server, page, cb, cb_data):
     url = server.url + "/api/v4/users/me/channel_members?pageSize=100&page={}".format(str(page))
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "failonerror": "1",
@@ -2419,7 +2663,7 @@ def run_get_user_channel_members(server, page, cb, cb_data):
 
 def run_post_users_status_ids(user_ids, server, cb, cb_data):
     url = server.url + "/api/v4/users/status/ids"
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "postfields": json.dumps(user_ids),
@@ -2437,7 +2681,7 @@ def run_post_channel_view(channel_id, server, cb, cb_data):
         "channel_id": channel_id,
     }
 
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "postfields": json.dumps(params),
@@ -2458,7 +2702,7 @@ def run_post_reaction(emoji_name, post_id, server, cb, cb_data):
         "create_at": int(time.time() * 1000),
     }
 
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "postfields": json.dumps(params),
@@ -2473,7 +2717,7 @@ def run_post_reaction(emoji_name, post_id, server, cb, cb_data):
 def run_delete_reaction(emoji_name, post_id, server, cb, cb_data):
     url = server.url + "/api/v4/users/me/posts/{}/reactions/{}".format(post_id, emoji_name)
 
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "customrequest": "DELETE",
@@ -2488,7 +2732,7 @@ def run_delete_reaction(emoji_name, post_id, server, cb, cb_data):
 def run_delete_post(post_id, server, cb, cb_data):
     url = server.url + "/api/v4/posts/{}".format(post_id)
 
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "customrequest": "DELETE",
@@ -2503,7 +2747,7 @@ def run_delete_post(post_id, server, cb, cb_data):
 def run_get_file(file_id, file_out_path, server, cb, cb_data):
     url = server.url + "/api/v4/files/{}".format(file_id)
 
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "failonerror": "1",
@@ -2518,7 +2762,7 @@ def run_get_file(file_id, file_out_path, server, cb, cb_data):
 def run_get_preferences(server, cb, cb_data):
     url = server.url + "/api/v4/users/me/preferences"
 
-    weechat.hook_process_hashtable(
+    hook_process_hashtable(
         "url:" + url,
         {
             "failonerror": "1",
@@ -2597,6 +2841,7 @@ def handle_lost_connection(server):
     server.print("Connection lost.")
     close_worker(server.worker)
     server.worker = None
+    EVENTROUTER.forget_server(server.id)
 
 def ws_ping_cb(server_id, remaining_calls):
     server = servers[server_id]
@@ -2824,12 +3069,14 @@ default_emojis = []
 
 REQUEST_TIMEOUT_MS = 30 * 1000
 
+MAX_REQUESTS_IN_FLIGHT = 4
+
 mentions = ["@here", "@channel", "@all"]
 
 WEECHAT_SCRIPT_NAME = "wee_most"
 WEECHAT_SCRIPT_DESCRIPTION = "Mattermost integration"
 WEECHAT_SCRIPT_AUTHOR = "Damien Tardy-Panis <damien.dev@tardypad.me>"
-WEECHAT_SCRIPT_VERSION = "0.3.0"
+WEECHAT_SCRIPT_VERSION = "0.3.3"
 WEECHAT_SCRIPT_LICENSE = "GPL3"
 
 weechat.register(